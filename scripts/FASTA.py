@@ -25,6 +25,53 @@ class FASTA:
     def __len__(self):
         return len(self._seq)
 
+# CompactFASTA is the FASTA version of CompactFASTQ (see FASTQ.py): it uses __slots__
+# instead of an attribute dictionary, and it doesn't split a defline into fields until 
+# a field is needed.  Deflines written by pandaseq are Illumina deflines with the index
+# sequence in place of the pair end fields, so the field names are the first seven
+# names used for FASTQ sequences; the index is the last field.
+
+import re
+
+class CompactFASTA:
+    """
+    FASTA sequence class, optimized for space
+    """
+    __slots__ = ('_def', '_seq', '_fields')
+    
+    fields = ['instrument', 'run_id', 'flowcell_id', 'lane', 'tile', 'x', 'y']
+    
+    def __init__(self, defline, sequence):
+        self._def = defline
+        self._seq = sequence
+        self._fields = None
+    
+    def defline(self):
+        "Return the defline string for this object."
+        return self._def
+        
+    def sequence(self):
+        "Return the sequence string for this object."
+        return self._seq
+        
+    def field(self, name):
+        "Return the value of a defline field; the defline is split the first time a field is needed."
+        if self._fields is None:
+            self._fields = tuple(re.split(r'[\s:;]+', self._def.lstrip('>')))
+        if name == 'index':
+            return self._fields[-1]
+        return self._fields[CompactFASTA.fields.index(name)]
+        
+    def unique_defline(self):
+        "Return a string with the lane, tile, and x and y coordinates from the defline"
+        return ':'.join(self.field(x) for x in ['lane', 'tile', 'x', 'y'])
+            
+    def __repr__(self):
+        return '\n'.join([self._def, self._seq])
+
+    def __len__(self):
+        return len(self._seq)
+
 # A FASTAReader is a type of text file.  It adds a readseq method that returns a FASTA object
 # for the next sequence in the file.  It also implements the iterator pattern so users can
 # iterate over the file.
@@ -33,20 +80,22 @@ class FASTA:
 # in the first column.  If not, it skips ahead to the next line that starts with '>'.  The
 # method allows sequences to be spread across multiple lines.
 
+# Files compressed with gzip, BGZF, or zstd are uncompressed automatically (see 
+# compressed.py).
+
 import io
-import sys
+
+from compressed import open_input
 
 class FASTAReader(io.TextIOWrapper):
     def __init__(self, fn):
-        "Make a new FASTAReader for sequences in file 'fn'"
-        super().__init__(open(fn, 'rb'))
-        # is there a way to read from stdin?  this code leads to an error ("underlying read
-        # should have returned a bytes object") that was fixed by using 'rb' when opening
-        # a file....
-        # if isinstance(fn, str):
-        #     super().__init__(open(fn, 'rb'))
-        # else:
-        #     super().__init__(sys.stdin)
+        "Make a new FASTAReader for sequences in file 'fn' (a name or a binary stream)"
+        if isinstance(fn, str):
+            super().__init__(open_input(fn))
+        else:
+            super().__init__(fn)
+        # a stream has to be opened in binary mode, e.g. use sys.stdin.buffer to read
+        # from stdin or the stdout attribute of a subprocess started with stdout=PIPE
         self._buffer = self.readline()             # initialize the buffer
 
     def __iter__(self):
@@ -65,10 +114,10 @@ class FASTAReader(io.TextIOWrapper):
         if len(self._buffer) == 0:
             return None
         defline = self._buffer.strip()
-        sequence = ''
+        lines = [ ]
         self._buffer = self.readline()
         while len(self._buffer) > 0 and self._buffer[0] != '>':
-            sequence += self._buffer.strip()
+            lines.append(self._buffer.strip())
             self._buffer = self.readline()
-        return FASTA(defline, sequence)
+        return FASTA(defline, ''.join(lines))
         
\ No newline at end of file
@@ -43,7 +43,18 @@
 # (x,y) coords, which will be sufficient to distinguish this read from all others
 # in its data set.  
 
-# The unique_id method is the same as unique_defline but it returns an integer.
+# The unique_id method is the same as unique_defline but it returns an integer.  The
+# lane, tile, and x and y coordinates are packed into a 63-bit integer (so it can be
+# saved in a SQLite INTEGER column); see the comment before defline_id for the layout.
+# Scripts use these integers instead of defline strings as keys in dictionaries and 
+# database tables.  Deflines that aren't in Illumina format (e.g. '@SRR1234.1 1 length=150'
+# from the SRA) don't have these fields; for those unique_id returns None and scripts
+# use the defline itself as the key (see defline_key).
+
+# The encoding used by pack and unpack is implemented by a set of functions defined
+# after the class.  encode and decode work on a single sequence; pack_many and 
+# unpack_many compress or uncompress a whole list of FASTQ objects in one call, which
+# is much faster than calling pack or unpack for each object.
 
 import re
 
@@ -99,8 +110,8 @@ class FASTQ:
             return None
     
     def unique_id(self):
-        "Return a unique identifying integer for this sequence"
-        raise Exception('TBD')
+        "Return a unique identifying integer for this sequence, or None if the defline isn't in Illumina format"
+        return FASTQ.try_defline_id(self._def)
 
     int2char = 'ACTGN'
     char2int = {'A': 0, 'C':1, 'T':2, 'G':3, 'N':4}
@@ -108,10 +119,7 @@ class FASTQ:
     
     def pack(self):
         "Use a lossless encoding scheme to compress the sequence and quality strings into a single byte array."
-        self._blob = bytearray()
-        for i in range(len(self._seq)):
-            self._blob.append(50*FASTQ.char2int[self._seq[i]] + ord(self._qual[i])-FASTQ.qbase)
-        self._blob = bytes(self._blob)
+        self._blob = encode(self._seq, self._qual)
         delattr(self, '_seq')
         delattr(self, '_qual')
         
@@ -120,10 +128,7 @@ class FASTQ:
         self._seq = ''
         self._qual = ''
         if self._blob is not None:
-            for byte in self._blob:
-                s, q = divmod(byte, 50)
-                self._seq += FASTQ.int2char[s]
-                self._qual += chr(FASTQ.qbase + q)
+            self._seq, self._qual = decode(self._blob)
         delattr(self, '_blob')
     
     def __repr__(self):
@@ -148,8 +153,236 @@ class FASTQ:
         formed from the lane, tile number, and x and y coordinates.
         """
         x = s.split(':')
+        if len(x) < 7:
+            return s.split()[0].lstrip('@>')
         return ':'.join(x[3:7])
     
+    # The integer form of a defline has 4 bits for the lane, 17 bits for the tile number,
+    # and 21 bits each for the x and y coordinates, which covers the ranges used by MiSeq,
+    # HiSeq, NextSeq, and NovaSeq instruments.
+
+    id_fields = [('lane', 4), ('tile', 17), ('x', 21), ('y', 21)]
+
+    @staticmethod
+    def defline_id(s):
+        """
+        Return an integer made from the lane, tile number, and x and y coordinates in a defline.
+        The argument can be an Illumina defline (from a FASTQ file or a FASTA file written
+        by pandaseq) or a shorter defline made by parse_defline.
+        """
+        x = s.split()[0].lstrip('@>').split(':')
+        if len(x) > 4:
+            x = x[3:7]
+        if len(x) != 4:
+            raise ValueError('not an Illumina defline: {}'.format(s))
+        res = 0
+        for (name, bits), val in zip(FASTQ.id_fields, x):
+            n = int(val)
+            if not 0 <= n < (1 << bits):
+                raise ValueError('{} out of range in defline {}'.format(name, s))
+            res = (res << bits) | n
+        return res
+        
+    @staticmethod
+    def try_defline_id(s):
+        "Return defline_id(s), or None if s isn't an Illumina defline"
+        try:
+            return FASTQ.defline_id(s)
+        except (ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def defline_key(s):
+        "Return the key for a sequence in a unique_id_map: the integer ID if s is an Illumina defline, otherwise the defline made by parse_defline"
+        res = FASTQ.try_defline_id(s)
+        return FASTQ.parse_defline(s) if res is None else res
+
+    @staticmethod
+    def id_defline(n):
+        "The inverse of defline_id:  return the lane:tile:x:y string for an integer ID"
+        res = []
+        for name, bits in reversed(FASTQ.id_fields):
+            n, val = divmod(n, 1 << bits)
+            res.append(str(val))
+        return ':'.join(reversed(res))
+    
+###
+# The codec behind pack and unpack.  Each byte in a blob is 50*b + q where b is the
+# index of a base in FASTQ.int2char and q is the quality character minus FASTQ.qbase.
+# Instead of looping over characters the functions use translation tables so each
+# step is done by a single call to a bytes method.
+#
+# To pack a sequence the letters and quality characters are translated into two byte
+# strings, one with the 50*b terms and one with the q terms.  No byte in the sum can
+# be larger than 4*50+49, so adding the two byte strings as big integers adds them
+# byte by byte without carries.  Characters that can't be encoded are translated to
+# 255, which can never be part of a valid code, so a single search finds any errors.
+
+_invalid = 255
+
+_base_code = bytes(50*FASTQ.char2int[chr(i)] if chr(i) in FASTQ.char2int else _invalid for i in range(256))
+_qual_code = bytes(i-FASTQ.qbase if 0 <= i-FASTQ.qbase < 50 else _invalid for i in range(256))
+
+_base_char = bytes(ord(FASTQ.int2char[min(i//50, 4)]) for i in range(256))
+_qual_char = bytes(FASTQ.qbase + i%50 for i in range(256))
+
+def _ascii(x):
+    "Return the bytes in a string, byte string, or memoryview"
+    return x.encode('ascii') if isinstance(x, str) else bytes(x)
+
+def encode(seq, qual):
+    "Return the blob for a sequence string and its quality string (either can also be bytes or a memoryview)."
+    if len(seq) != len(qual):
+        raise ValueError('sequence and quality strings have different lengths')
+    s = _ascii(seq).translate(_base_code)
+    q = _ascii(qual).translate(_qual_code)
+    if _invalid in s or _invalid in q:
+        raise ValueError('sequence or quality string has characters that cannot be packed')
+    return (int.from_bytes(s, 'big') + int.from_bytes(q, 'big')).to_bytes(len(s), 'big')
+
+def decode(blob):
+    "Return the sequence and quality strings encoded in a blob."
+    blob = bytes(blob)
+    return blob.translate(_base_char).decode('ascii'), blob.translate(_qual_char).decode('ascii')
+
+def _split(data, lengths):
+    "Cut a string into consecutive pieces with the specified lengths"
+    res = []
+    i = 0
+    for n in lengths:
+        res.append(data[i:i+n])
+        i += n
+    return res
+
+def _join(items):
+    "Concatenate a list of strings or a list of byte strings"
+    return ''.join(items) if items and isinstance(items[0], str) else b''.join(items)
+
+def encode_many(seqs, quals):
+    "Return a list of blobs for a list of sequence strings and a list of quality strings."
+    lengths = [len(x) for x in seqs]
+    if lengths != [len(x) for x in quals]:
+        raise ValueError('sequence and quality strings have different lengths')
+    return _split(encode(_join(seqs), _join(quals)), lengths)
+
+def decode_many(blobs):
+    "Return a list of sequence strings and a list of quality strings for a list of blobs."
+    lengths = [len(x) for x in blobs]
+    seq, qual = decode(b''.join(blobs))
+    return _split(seq, lengths), _split(qual, lengths)
+
+def pack_many(seqs):
+    "Compress a list of FASTQ objects, return the list of blobs (same result as calling pack for each object)"
+    blobs = encode_many([x._seq for x in seqs], [x._qual for x in seqs])
+    for x, blob in zip(seqs, blobs):
+        x._blob = blob
+        delattr(x, '_seq')
+        delattr(x, '_qual')
+    return blobs
+
+def unpack_many(seqs):
+    "Uncompress a list of compressed FASTQ objects (same result as calling unpack for each object)"
+    packed = [x for x in seqs if x._blob is not None]
+    letters, quals = decode_many([x._blob for x in packed])
+    for x in seqs:
+        x._seq = ''
+        x._qual = ''
+    for x, s, q in zip(packed, letters, quals):
+        x._seq = s
+        x._qual = q
+    for x in seqs:
+        delattr(x, '_blob')
+
+# A CompactFASTQ object holds the same information as a FASTQ object but uses much 
+# less memory, which matters when a script keeps a large number of sequences in a
+# dictionary or list.  The class uses __slots__, so objects don't have a dictionary 
+# of attributes, and the Illumina defline fields are not extracted until one of them
+# is needed.  At that point the fields are saved in a single tuple instead of eleven
+# separate attributes.
+
+# The getter methods are the same as the ones in the FASTQ class.  To get a defline
+# field call the field method with a name from CompactFASTQ.fields, e.g. 
+# seq.field('tile').  The unique_defline method works without a separate call to 
+# parse_defline.  Short deflines that only have the lane, tile, x, and y fields (the 
+# form saved in the panda table) are also recognized.
+
+class CompactFASTQ:
+    "A DNA string with quality scores, optimized for space"
+    
+    __slots__ = ('_def', '_seq', '_qual', '_blob', '_fields')
+    
+    fields = ['instrument', 'run_id', 'flowcell_id', 'lane', 'tile', 'x', 'y', 'pair_end', 'filtered', 'control_bits', 'index']
+    
+    def __init__(self, arg):
+        "arg can be a string containing 4 lines read from a FASTQ file or a byte array containing a compressed sequence"
+        if isinstance(arg, str):
+            self._def, self._seq, dummy, self._qual = arg.split('\n')
+        else:
+            self._def = ''
+            self._blob = arg
+        self._fields = None
+        
+    def defline(self):
+        "Return the defline read from a FASTQ file."
+        return self._def
+
+    def sequence(self):
+        "Return the sequence string for this object, or None if the object is compressed."
+        return self._seq if hasattr(self, '_seq') else None
+    
+    def quality(self):
+        "Return the quality string for this object, or None if the object is compressed."
+        return self._qual if hasattr(self, '_qual') else None
+    
+    def blob(self):
+        "Return the packed byte string if the object is compressed, otherwise None."
+        return self._blob if hasattr(self, '_blob') else None
+        
+    def _parse(self):
+        "Split the defline the first time a field is needed, return the tuple of fields"
+        if self._fields is None:
+            self._fields = tuple(re.split(r'[\s:]+', self._def.lstrip('@')))
+        return self._fields
+        
+    def field(self, name):
+        "Return the value of an Illumina defline field"
+        return self._parse()[CompactFASTQ.fields.index(name)]
+        
+    def filtered(self):
+        "Return True if the defline contains ':Y:'"
+        return ':Y:' in self._def
+        
+    def unique_defline(self):
+        "Return a string with the unique identifying parts of this sequence"
+        fields = self._parse()
+        return ':'.join(fields if len(fields) == 4 else fields[3:7])
+        
+    def unique_id(self):
+        "Return a unique identifying integer for this sequence, or None if the defline isn't in Illumina format"
+        return FASTQ.try_defline_id(self._def)
+        
+    def pack(self):
+        "Compress the sequence and quality strings (using the same encoding as FASTQ.pack)."
+        self._blob = encode(self._seq, self._qual)
+        delattr(self, '_seq')
+        delattr(self, '_qual')
+        
+    def unpack(self):
+        "Uncompress a compressed object."
+        self._seq = ''
+        self._qual = ''
+        if self._blob is not None:
+            self._seq, self._qual = decode(self._blob)
+        delattr(self, '_blob')
+        
+    def __repr__(self):
+        a = [self._def]
+        b = [self._seq, '+', self._qual] if hasattr(self, '_seq') else [str(self._blob)]
+        return '\n'.join(a+b)
+        
+    def __len__(self):
+        return len(self._seq) if hasattr(self, '_seq') else len(self._blob)
+
 # A FASTQReader is a type of text file.  It adds a readseq method that returns a FASTQ object
 # for the next sequence in the file.  It also implements the iterator pattern so users can
 # iterate over the file.
@@ -157,12 +390,17 @@ class FASTQ:
 # The readsseq method checks to make sure the sequence starts with a line that has a '@'
 # in the first column.  If not, it skips ahead to the next line that starts with '@'.
 
+# Files compressed with gzip, BGZF, or zstd are uncompressed automatically (see 
+# compressed.py).
+
 import io
 
+from compressed import open_input
+
 class FASTQReader(io.TextIOWrapper):
     def __init__(self, fn):
         "Make a new FASTQReader for sequences in file 'fn'"
-        super().__init__(open(fn, 'rb'))
+        super().__init__(open_input(fn))
 
     def __iter__(self):
         return self
@@ -184,5 +422,203 @@ class FASTQReader(io.TextIOWrapper):
             res += self.readline()
         return FASTQ(res.strip())
 
+# A FASTQBlockReader is a faster alternative to FASTQReader for large files.  Instead of
+# calling readline four times per sequence it reads the file in large blocks of bytes
+# (8MB by default) and splits each block into lines with a single call.  The lines from
+# a block are saved in a FASTQBatch object, which has three parallel lists of byte
+# strings: the deflines, the sequence letters, and the quality letters.  No strings or
+# FASTQ objects are made while parsing.
+
+# The batches method is a generator that returns one batch per block, and readbatch
+# returns the next batch (an empty batch at the end of the file).  Scripts that handle 
+# one sequence at a time can iterate over the reader to get FASTQView objects; a view
+# refers to one entry in a batch and has the same getter methods as a FASTQ object.  
+# Call the fastq method of a view to make a regular FASTQ object.
+
+# The argument passed to the constructor can be a file name or a file object opened 
+# in binary mode (e.g. sys.stdin.buffer).  Compressed files are uncompressed in a
+# background thread while the reader parses the data.  If every 4th line in a block starts with '@'
+# the block is split into sequences without looking at individual lines.  Otherwise
+# the reader does what FASTQReader does and skips lines until it finds one that starts 
+# with '@'.
+
+from itertools import repeat
+
+class FASTQView:
+    "A sequence in a batch read by a FASTQBlockReader"
+    
+    __slots__ = ('_def', '_seq', '_qual')
+    
+    def __init__(self, defline, sequence, quality):
+        self._def = defline
+        self._seq = sequence
+        self._qual = quality
+        
+    def defline(self):
+        "Return the defline string."
+        return self._def.decode('ascii')
+        
+    def sequence(self):
+        "Return the sequence string."
+        return self._seq.decode('ascii')
+        
+    def quality(self):
+        "Return the quality string."
+        return self._qual.decode('ascii')
+        
+    def blob(self):
+        "Return the packed form of the sequence and quality (same as FASTQ.pack)."
+        return encode(self._seq, self._qual)
+        
+    def filtered(self):
+        "Return True if the defline contains ':Y:'"
+        return self._def.find(b':Y:') >= 0
+        
+    def unique_id(self):
+        "Return a unique identifying integer for this sequence (see FASTQ.defline_id), or None if the defline isn't in Illumina format"
+        return FASTQ.try_defline_id(self._def.decode('ascii'))
+        
+    def raw(self):
+        "Return a tuple with the defline, sequence, and quality as byte strings."
+        return (self._def, self._seq, self._qual)
+        
+    def fastq(self):
+        "Return a new FASTQ object for this sequence."
+        return FASTQ(repr(self))
+        
+    def __repr__(self):
+        return '\n'.join([self.defline(), self.sequence(), '+', self.quality()])
+        
+    def __bytes__(self):
+        "The 4-line record, with a newline at the end, as a byte string"
+        return b'\n'.join([self._def, self._seq, b'+', self._qual, b''])
+        
+    def __len__(self):
+        return len(self._seq)
+
+def view_blobs(views):
+    "Return a list with the packed form of each sequence in a list of views."
+    return encode_many([x._seq for x in views], [x._qual for x in views])
+
+class FASTQBatch:
+    "Deflines, sequences, and quality strings (as byte strings) for a set of sequences"
+    
+    __slots__ = ('deflines', 'sequences', 'qualities')
+    
+    def __init__(self, deflines, sequences, qualities):
+        self.deflines = deflines
+        self.sequences = sequences
+        self.qualities = qualities
+        
+    def __len__(self):
+        return len(self.deflines)
+        
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return FASTQBatch(self.deflines[i], self.sequences[i], self.qualities[i])
+        return FASTQView(self.deflines[i], self.sequences[i], self.qualities[i])
+        
+    def __iter__(self):
+        return map(FASTQView, self.deflines, self.sequences, self.qualities)
+        
+    def blobs(self):
+        "Return a list with the packed form of each sequence."
+        return encode_many(self.sequences, self.qualities)
+
+class FASTQBlockReader:
+    
+    def __init__(self, fn, blocksize=8*1024*1024):
+        "Make a new FASTQBlockReader for sequences in file 'fn'"
+        self._file = open_input(fn) if isinstance(fn, str) else fn
+        self._blocksize = blocksize
+        self._rest = b''
+        self._views = iter([])
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exc):
+        self.close()
+        
+    def close(self):
+        self._file.close()
+        
+    def __iter__(self):
+        return self
+        
+    def __next__(self):
+        for x in self._views:
+            return x
+        batch = self.readbatch()
+        if len(batch) == 0:
+            raise StopIteration
+        self._views = iter(batch)
+        return next(self._views)
+        
+    def batches(self):
+        "Generate FASTQBatch objects, one for each block in the file."
+        batch = self.readbatch()
+        while len(batch) > 0:
+            yield batch
+            batch = self.readbatch()
+        
+    def readbatch(self):
+        "Return a FASTQBatch with the sequences in the next block; the batch is empty at the end of the file."
+        res = FASTQBatch([], [], [])
+        while len(res) == 0:
+            data = self._file.read(self._blocksize)
+            if not data:
+                if self._rest:
+                    res = self._parse(self._rest + b'\n')
+                    self._rest = b''
+                return res
+            res = self._parse(self._rest + data)
+        return res
+            
+    # The records in a batch are bytes objects made by splitting the block, not
+    # memoryview slices of it.  bytes.split does the copying in C in one pass, and the
+    # batch items need bytes methods that memoryview doesn't have (callers use
+    # startswith, translate, and decode, and use the items as dictionary keys).  A
+    # slice would also keep the whole block alive as long as any one read is in use.
+    # Files with Windows line endings are converted a block at a time (a CR at the end
+    # of a block is in the leftover bytes, so it's joined with the LF in the next block).
+
+    def _parse(self, data):
+        "Make a batch from the complete sequences in data, save any leftover bytes for the next block"
+        if b'\r' in data:
+            data = data.replace(b'\r\n', b'\n')
+        lines = data.split(b'\n')
+        partial = lines.pop()
+        n = 4 * (len(lines) // 4)
+        deflines = lines[0:n:4]
+        separators = lines[2:n:4]
+        if all(map(bytes.startswith, deflines, repeat(b'@'))) and all(map(bytes.startswith, separators, repeat(b'+'))):
+            res = FASTQBatch(deflines, lines[1:n:4], lines[3:n:4])
+        else:
+            res = FASTQBatch([], [], [])
+            n = 0
+            while n + 3 < len(lines):
+                if not lines[n].startswith(b'@'):
+                    n += 1
+                    continue
+                res.deflines.append(lines[n])
+                res.sequences.append(lines[n+1])
+                res.qualities.append(lines[n+3])
+                n += 4
+        self._rest = b'\n'.join(lines[n:] + [partial])
+        return res
 
+###
+# Reads from the two files for a set of paired-end reads are in the same order, but
+# blocks from the two files usually hold different numbers of reads.  This generator
+# splits the batches so the reads in each pair of batches match up.
 
+def paired_batches(reader1, reader2):
+    "Generate pairs of FASTQBatch objects with the same number of reads from two files"
+    b1 = reader1.readbatch()
+    b2 = reader2.readbatch()
+    while len(b1) > 0 and len(b2) > 0:
+        n = min(len(b1), len(b2))
+        yield b1[:n], b2[:n]
+        b1 = b1[n:] if n < len(b1) else reader1.readbatch()
+        b2 = b2[n:] if n < len(b2) else reader2.readbatch()
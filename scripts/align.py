@@ -0,0 +1,65 @@
+# Sequence comparison functions used by the built-in clustering engine
+
+# kmers returns the set of distinct k-letter substrings in a sequence.  The number of
+# k-mers two sequences share is used to decide if they are worth aligning:  each
+# difference between two sequences can destroy at most k of the shared k-mers, so a
+# pair with d differences shares at least (number of k-mers) - k*d of them.
+
+# edit_distance computes the number of differences (substitutions, insertions, and
+# deletions) between two sequences using the bit-parallel algorithm of Myers (1999)
+# as adapted for global alignment by Hyyrö (2001).  A column of the dynamic
+# programming matrix is represented by bit vectors (Python integers), so each letter
+# in the second sequence is processed with a few integer operations no matter how
+# long the first sequence is.  The computation stops as soon as the distance is
+# known to be larger than a limit.
+
+# identity is the fraction of positions that are not differences, relative to the
+# length of the longer sequence.
+
+def kmers(seq, k):
+    "Return the set of k-mers in a sequence"
+    return { seq[i:i+k] for i in range(len(seq) - k + 1) }
+
+def max_diffs(len1, len2, identity):
+    "Return the number of differences allowed between sequences of the given lengths"
+    return int((1.0 - identity) * max(len1, len2) + 1e-9)
+
+def edit_distance(s1, s2, limit=None):
+    "Return the edit distance between s1 and s2, or None if it's more than limit"
+    m = len(s1)
+    n = len(s2)
+    if m == 0 or n == 0:
+        d = max(m, n)
+        return d if limit is None or d <= limit else None
+    if limit is not None and abs(m - n) > limit:
+        return None
+    peq = { }
+    for i, ch in enumerate(s1):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = full
+    mv = 0
+    score = m
+    for j, ch in enumerate(s2):
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (full ^ (xh | pv))
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        if limit is not None and score - (n - j - 1) > limit:
+            return None
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (full ^ (xv | ph))
+        mv = ph & xv
+    return score
+
+def identity(s1, s2, limit=None):
+    "Return the identity of two sequences, or None if the edit distance is more than limit"
+    d = edit_distance(s1, s2, limit)
+    return None if d is None else 1.0 - d / max(len(s1), len(s2))
@@ -10,12 +10,20 @@
 
 import sqlite3
 import argparse
+import collections
+import multiprocessing
 import os
 import os.path
+import queue
+import shlex
+import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from common import *
 from FASTQ import *
+from FASTA import FASTAReader
+from merger import merge_batch
 
 # File names used in calls to pandaseq
 
@@ -23,46 +31,36 @@ log_file_pattern = 'log.{}.txt'
 merge_file_pattern = 'merged.{}.fasta'
 
 ###
-# Fetch the primer sequences from the database
-
-def fetch_primers(db):
-    """
-    Read the primer sequences from the database
-    """
-    primers = { }
-    for n, seq in db.execute("SELECT pair_end, sequence FROM primers"):
-        primers[int(n)] = seq
-    return primers
-
-###
-# Run PANDAseq using options specified on the command line
+# Make the shell command that runs PANDAseq using options specified on the command line.
+# In streaming mode there is no -w option so pandaseq writes the merged sequences to
+# its standard output.
 # TBD: write to /dev/null?  -N??
 
-def run_panda(args, sid, fn1, fn2, primers):
+def panda_command(args, sid, fn1, fn2, primers):
     cmnd = 'pandaseq'
     if args.algorithm:
         cmnd += ' -A ' + args.algorithm
     cmnd += ' -N'                           # throw out seqs with N's
     cmnd += ' -f ' + os.path.join(args.directory, fn1)
     cmnd += ' -r ' + os.path.join(args.directory, fn2)
-    if len(primers) > 0:
+    if len(primers) > 0 and not args.noprimers:
         cmnd += ' -p ' + primers[1]
         cmnd += ' -q ' + primers[2]
-    cmnd += ' -w ' + os.path.join(args.workspace, merge_file_pattern.format(sid))
+    if not args.stream:
+        cmnd += ' -w ' + os.path.join(args.workspace, merge_file_pattern.format(sid))
     cmnd += ' -g ' + os.path.join(args.workspace, log_file_pattern.format(sid))
     if args.minlength is not None:
         cmnd += ' -l ' + str(args.minlength)
     if args.minoverlap is not None:
         cmnd += ' -o ' + str(args.minoverlap)
-    print(cmnd)
-    if not args.norun:
-        record_metadata(db, 'exec', cmnd, commit=True)
-        res = os.system(cmnd)
+    if args.threads is not None:
+        cmnd += ' -T ' + str(args.threads)
+    return cmnd
 
 ###
 # Import the assembled sequences
 
-insert_sequence = 'INSERT INTO panda (sample_id, defline, sequence) VALUES (?, ?, ?)'
+insert_sequence = 'INSERT INTO panda (sample_id, unique_id, defline, sequence, digest) VALUES (?, ?, ?, ?, ?)'
 
 def import_results(db, args, sid):
     file = open(os.path.join(args.workspace, merge_file_pattern.format(sid)))
@@ -70,25 +68,191 @@ def import_results(db, args, sid):
     count = 0
     limit = int(args.limit) if args.limit else None
     while len(defline) > 0:
+        uid = FASTQ.try_defline_id(defline)
         defline = FASTQ.parse_defline(defline)
-        sequence = file.readline()
-        db.execute(insert_sequence, (sid, defline, sequence.strip()))
+        sequence = file.readline().strip()
+        db.execute(insert_sequence, (sid, uid, defline, sequence, sequence_digest(sequence)))
         count += 1
         if args.limit and count >= limit:
             break
         defline = file.readline()
 
+###
+# Streaming mode: instead of waiting for pandaseq to write a file and then reading the
+# file, read the merged sequences from pandaseq's standard output while it is running.
+# Each pandaseq process is managed by a thread from a pool; the thread parses the
+# output and puts batches of rows in a queue, and the main thread takes the batches
+# out of the queue and inserts them in the panda table.  The queue is bounded so
+# pandaseq is paused (by the pipe filling up) if it gets too far ahead of the database.
+#
+# Items in the queue are tuples of the form (sid, rows, status).  A thread puts a
+# final item with rows = None and the exit status of pandaseq when its process ends.
+#
+# When a sample reaches the --limit the thread kills its pandaseq process, and so does
+# any error in the thread, so pandaseq never outlives the script.  The merged
+# sequences are saved in the workspace only if --keep_merged is specified.
+
+stream_batch_size = 10000
+
+def stream_panda(args, sid, cmnd, results):
+    "Thread body: run pandaseq, put batches of merged sequences in the results queue."
+    status = None
+    proc = None
+    merged = None
+    try:
+        merged = open(os.path.join(args.workspace, merge_file_pattern.format(sid)), 'w') if args.keep_merged else None
+        proc = subprocess.Popen(shlex.split(cmnd), stdout=subprocess.PIPE)
+        limit = int(args.limit) if args.limit else None
+        rows = []
+        count = 0
+        for seq in FASTAReader(proc.stdout):
+            defline = seq.defline()
+            if merged:
+                print(defline, seq.sequence(), sep='\n', file=merged)
+            rows.append((sid, FASTQ.try_defline_id(defline), FASTQ.parse_defline(defline), seq.sequence(), sequence_digest(seq.sequence())))
+            count += 1
+            if len(rows) == stream_batch_size:
+                results.put((sid, rows, None))
+                rows = []
+            if limit and count >= limit:
+                proc.kill()
+                break
+        if rows:
+            results.put((sid, rows, None))
+        proc.stdout.close()
+        status = proc.wait()
+        if limit and count >= limit:
+            status = 0
+    except Exception as err:
+        status = str(err)
+    finally:
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if merged:
+            merged.close()
+        results.put((sid, None, status))
+
+def stream_results(db, args, jobs):
+    "Run pandaseq for each (sid, sname, cmnd) in jobs, importing sequences as they are made."
+    results = queue.Queue(4 * args.jobs)
+    names = { sid: sname for sid, sname, cmnd in jobs }
+    with ThreadPoolExecutor(args.jobs) as pool:
+        for sid, sname, cmnd in jobs:
+            pool.submit(stream_panda, args, sid, cmnd, results)
+        running = len(jobs)
+        while running > 0:
+            sid, rows, status = results.get()
+            if rows is not None:
+                db.executemany(insert_sequence, rows)
+                continue
+            running -= 1
+            if status != 0:
+                print('pandaseq failed for sample', names[sid])
+                record_metadata(db, 'error', 'pandaseq exit status {} for sample {}'.format(status, names[sid]))
+                db.execute('DELETE FROM panda WHERE sample_id = ?', (sid,))
+
+###
+# Built-in merger (--algorithm builtin): instead of running pandaseq, read batches of
+# pairs from the FASTQ files and merge them with a pool of worker processes (see
+# merger.py).  At most 2*jobs batches are in the pool at any time, and results are
+# saved in the order the batches were read.  With --noimport the merged sequences are
+# written to the workspace the same way pandaseq would write them.
+
+merge_block_size = 1024 * 1024
+
+def save_merged(db, args, sid, rows, merged, room):
+    "Save up to room (None means no limit) merged sequences, return the number saved"
+    if room is not None:
+        rows = rows[:room]
+    if merged:
+        for uid, defline, sequence in rows:
+            print(defline, sequence, sep='\n', file=merged)
+    if not args.noimport:
+        db.executemany(insert_sequence, [(sid, uid, FASTQ.parse_defline(defline), sequence, sequence_digest(sequence)) for uid, defline, sequence in rows])
+    return len(rows)
+
+def builtin_merge(db, args, sid, sname, fn1, fn2, pool):
+    "Merge the pairs for one sample with the built-in merger"
+    r1 = FASTQBlockReader(os.path.join(args.directory, fn1), merge_block_size)
+    r2 = FASTQBlockReader(os.path.join(args.directory, fn2), merge_block_size)
+    merged = None
+    if args.keep_merged or args.noimport:
+        merged = open(os.path.join(args.workspace, merge_file_pattern.format(sid)), 'w')
+    limit = int(args.limit) if args.limit and not args.noimport else None
+    
+    total = count = 0
+    window = collections.deque()
+    for b1, b2 in paired_batches(r1, r2):
+        window.append(pool.apply_async(merge_batch, (b1, b2, args.minoverlap, args.minlength, args.maxee)))
+        total += len(b1)
+        if len(window) >= 2 * args.jobs:
+            count += save_merged(db, args, sid, window.popleft().get(), merged, limit and limit - count)
+        if limit and count >= limit:
+            break
+    while window:
+        count += save_merged(db, args, sid, window.popleft().get(), merged, limit and limit - count)
+    
+    for f in [r1, r2, merged]:
+        if f:
+            f.close()
+    print('{}: {} of {} pairs merged'.format(sname, count, total))
+    record_metadata(db, 'merge', '{}: {} of {} pairs merged'.format(sname, count, total))
+
 ###
 # Top level function: initialize the workspace directory, get sample parameters from
-# the database, run PANDAseq for all specified samples
+# the database, run PANDAseq for all specified samples.
+#
+# Up to args.jobs copies of PANDAseq run at the same time (each one can use several
+# threads if --threads is specified).  The commands are started by a pool of threads
+# and the results for a sample are imported as soon as its command finishes.  All
+# database operations are done by the main thread.  With --stream the results are
+# imported while the commands are running (see stream_results).
 
 def assemble_pairs(db, args):
     init_workspace(args)
     primers = fetch_primers(db)
-    for sid, sname, fn1, fn2 in sample_list(db, args):
-        run_panda(args, sid, fn1, fn2, primers)
+    if args.algorithm == 'builtin':
+        with multiprocessing.Pool(args.jobs) as pool:
+            for sid, sname, fn1, fn2 in sample_list(db, args):
+                print('merging', fn1, fn2)
+                if not args.norun:
+                    builtin_merge(db, args, sid, sname, fn1, fn2, pool)
         if not args.noimport and not args.norun:
-            import_results(db, args, sid)
+            ensure_unique_ids(db, 'panda')
+            ensure_digest(db, 'panda')
+        return
+    if args.stream:
+        jobs = [ ]
+        for sid, sname, fn1, fn2 in sample_list(db, args):
+            cmnd = panda_command(args, sid, fn1, fn2, primers)
+            print(cmnd)
+            if not args.norun:
+                record_metadata(db, 'exec', cmnd, commit=True)
+                jobs.append((sid, sname, cmnd))
+        stream_results(db, args, jobs)
+        if not args.norun:
+            ensure_unique_ids(db, 'panda')
+            ensure_digest(db, 'panda')
+        return
+    running = { }
+    with ThreadPoolExecutor(args.jobs) as pool:
+        for sid, sname, fn1, fn2 in sample_list(db, args):
+            cmnd = panda_command(args, sid, fn1, fn2, primers)
+            print(cmnd)
+            if not args.norun:
+                record_metadata(db, 'exec', cmnd, commit=True)
+                running[pool.submit(subprocess.call, cmnd, shell=True)] = (sid, sname)
+        for job in as_completed(running):
+            sid, sname = running[job]
+            if job.result() != 0:
+                print('pandaseq failed for sample', sname)
+                record_metadata(db, 'error', 'pandaseq exit status {} for sample {}'.format(job.result(), sname))
+            elif not args.noimport:
+                import_results(db, args, sid)
+    if not args.noimport and not args.norun:
+        ensure_unique_ids(db, 'panda')
+        ensure_digest(db, 'panda')
 
 ###
 # Check the combination of command line options to make sure they're sensible
@@ -97,6 +261,15 @@ def validate_options(args):
     # if we're not loading data the limit option is superfluous
     if args.noimport and args.limit:
         print('Warning: options ignored: with --noimport the following options are ignored: --limit')
+    # streaming only makes sense if the sequences are imported
+    if args.stream and args.noimport:
+        argparse.ArgumentParser.exit(1, 'Error: --stream and --noimport cannot be used together\n')
+    if args.keep_merged and not (args.stream or args.algorithm == 'builtin'):
+        print('Warning: --keep_merged is only used with --stream or --algorithm builtin (merged sequences are always saved otherwise)')
+    if args.algorithm == 'builtin' and (args.stream or args.threads):
+        print('Warning: options ignored: with --algorithm builtin the following options are ignored: --stream --threads')
+    if args.maxee is not None and args.algorithm != 'builtin':
+        print('Warning: options ignored: --maxee is only used with --algorithm builtin')
 
 ###
 # Parse the command line arguments, call the top level function...
@@ -104,7 +277,7 @@ def validate_options(args):
 if __name__ == "__main__":
     
     args = init_api(
-        desc = "Run PANDAseq to filter low quality sequences, and find overlapping ends of pairs of reads. The default algorithm is pandaseq; alternatives are simple_bayesian, ea_util, flash, pear, rdp_mle, stitch, and uparse.",
+        desc = "Run PANDAseq to filter low quality sequences, and find overlapping ends of pairs of reads. The default algorithm is pandaseq; alternatives are simple_bayesian, ea_util, flash, pear, rdp_mle, stitch, and uparse, or builtin to merge pairs without running pandaseq.",
         with_limits = True,
         specs = [
             ('directory',    { 'metavar': 'dir', 'help' : 'name of directory containing FASTQ files' } ),
@@ -112,7 +285,13 @@ if __name__ == "__main__":
             ('algorithm',    { 'metavar': 'name', 'help' : 'algorithm for computing overlaps'} ),
             ('minlength',    { 'metavar': 'N', 'help' : 'minimum assembled sequence length', 'type' : int} ),
             ('minoverlap',   { 'metavar': 'N', 'help' : 'minimum overlap length', 'type' : int} ),
+            ('maxee',        { 'metavar': 'x', 'help' : 'maximum expected errors in a merged sequence (builtin algorithm only)', 'type' : float} ),
+            ('noprimers',    { 'action': 'store_true', 'help' : "don't pass the primer sequences to pandaseq (e.g. after trim_primers.py)"} ),
             ('norun',        { 'action': 'store_true', 'help' : "print shell commands but don't execute them"} ),
+            ('jobs',         { 'metavar': 'N', 'type' : int, 'default' : 1, 'help' : 'number of samples to assemble at the same time, or worker processes for the builtin algorithm (default 1)'} ),
+            ('threads',      { 'metavar': 'N', 'type' : int, 'help' : 'number of threads for each run of pandaseq (pandaseq -T)'} ),
+            ('stream',       { 'action': 'store_true', 'help' : 'import merged sequences from the output of pandaseq instead of a file'} ),
+            ('keep_merged',  { 'action': 'store_true', 'help' : 'with --stream or the builtin algorithm, also save the merged sequences in the workspace'} ),
         ]
     )
     
@@ -121,7 +300,7 @@ if __name__ == "__main__":
     record_metadata(db, 'start', ' '.join(sys.argv[1:]))
     
     try:
-        panda_spec = [('sample_id', 'foreign', 'samples'), ('defline', 'TEXT'),  ('sequence', 'TEXT')]
+        panda_spec = [('sample_id', 'foreign', 'samples'), ('unique_id', 'INTEGER'), ('defline', 'TEXT'),  ('sequence', 'TEXT'), ('digest', 'INTEGER')]
         init_table(db, 'panda', 'panda_id', panda_spec, args.force, args.sample)
     except Exception as err:
         print('Error while initializing output table:', err)
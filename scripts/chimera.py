@@ -0,0 +1,303 @@
+# Chimera detection for OTU centroids
+
+# This is the built-in alternative to usearch -uchime_ref (see filter_chimeras.py
+# --builtin).  A query sequence is a chimera if it is more similar to a model made by
+# joining the left part of one parent with the right part of another than it is to
+# any single parent.
+
+# Candidate parents are found with a k-mer index.  The query is split into chunks and
+# the parents with the most k-mers in common with each chunk are the candidates, so a
+# parent that only matches one end of the query can still be found.
+
+# Each candidate is aligned with the query (a banded alignment near the diagonal
+# suggested by the shared k-mers) and the alignment is reduced to a list of votes, one
+# for each query position, that is 1 if the parent has the same base as the query.
+# The part of the parent in the band is padded with a character that matches nothing,
+# so the whole band is inside the window even when the diagonal runs off either end
+# of the parent.  A candidate is skipped if its diagonal puts more than half of the
+# query off the parent or if it matches less than min_parent_identity of the query
+# (usually a diagonal made by a few chance k-mer matches with an unrelated sequence).
+# For each pair of candidates the votes are turned into running totals, so the number
+# of positions that favor each parent on the left and right side of every breakpoint
+# is found with one pass over the query.  The score for a breakpoint follows UCHIME
+# (Edgar et al. 2011):  on each side Y is the number of positions that agree with
+# the parent assigned to that side but not the other parent, N the number that agree
+# with the other parent, and A the number that agree with neither, and the score is
+# the smaller of Y / (beta * (N + pseudo) + A) for the two sides.
+
+# The verdict for a query is Y if the best model has a score of at least minh, is at
+# least mindiv percent more similar to the query than the best single parent, and
+# has at least mindiffs votes on each side; ? if the score is high enough but one of
+# the other tests fails; and N otherwise.
+
+# Results have the same columns as the usearch -uchimeout file:  score, query, parent
+# A, parent B, top hit, idQM, idQA, idQB, idAB, idQT, LY, LN, LA, RY, RN, RA, div, and
+# the verdict.
+
+# Usage:
+#
+#    index = ParentIndex()
+#    for rec in FASTAReader(reference):
+#        index.add(rec.defline()[1:], rec.sequence())
+#    for res in reference_chimeras(queries, index, params, pool, jobs):
+#        ...
+#
+# where queries is a sequence of (name, sequence) pairs.
+
+# denovo_chimeras does not need a reference.  The queries are (name, sequence,
+# abundance) triples sorted by decreasing abundance, and the candidate parents for a
+# query are the earlier queries that are at least abskew times more abundant and
+# were not found to be chimeras.  Parents are added to the index as they are found, and
+# the abundance of each parent is saved so the number of parents that are abundant
+# enough is found with a binary search.  To limit memory use the de novo index only
+# saves every parent_step'th k-mer of each parent, and when candidates are counted
+# the posting lists are cut off at the last eligible parent.
+
+# Queries are checked in batches, and a batch ends before the first query that could
+# be a parent of a query in the batch, so all the parents of a query are in the index
+# before it is checked and the results are the same as checking one query at a time.
+
+import bisect
+import collections
+from array import array
+from itertools import accumulate, combinations, islice
+
+kmer_length = 8
+chunk_count = 4
+hits_per_chunk = 2
+band = 16
+off_parent = ' '
+min_overlap = 0.5
+min_parent_identity = 0.6
+batch_size = 1000
+parent_step = 4
+default_abskew = 2.0
+
+Params = collections.namedtuple('Params', ['minh', 'mindiv', 'mindiffs', 'beta', 'pseudo'])
+default_params = Params(minh=0.28, mindiv=0.8, mindiffs=3, beta=8.0, pseudo=1.4)
+
+base_code = { 'A': 0, 'C': 1, 'G': 2, 'T': 3, 'a': 0, 'c': 1, 'g': 2, 't': 3 }
+
+def kmer_codes(seq, k=kmer_length):
+    "Return a list with a 2-bit code for the k-mer starting at each position, -1 if it has a letter other than ACGT"
+    mask = (1 << (2 * k)) - 1
+    res = [ ]
+    x = run = 0
+    for ch in seq:
+        b = base_code.get(ch)
+        if b is None:
+            x = run = 0
+        else:
+            x = ((x << 2) | b) & mask
+            run += 1
+        res.append(x if run >= k else -1)
+    return res[k-1:]
+
+class ParentIndex:
+
+    def __init__(self, k=kmer_length, step=1):
+        "Make an empty index; every step'th k-mer of a parent is indexed"
+        self._k = k
+        self._step = step
+        self._postings = [ None ] * (1 << (2 * k))
+        self._names = [ ]
+        self._seqs = [ ]
+
+    def __len__(self):
+        return len(self._seqs)
+
+    def parent(self, i):
+        "Return the (name, sequence) of parent i"
+        return self._names[i], self._seqs[i]
+
+    def add(self, name, seq):
+        "Add a parent, return its number"
+        i = len(self._seqs)
+        self._names.append(name)
+        self._seqs.append(seq)
+        for x in set(kmer_codes(seq, self._k)[::self._step]):
+            if x >= 0:
+                p = self._postings[x]
+                if p is None:
+                    p = self._postings[x] = array('i')
+                p.append(i)
+        return i
+
+    def candidates(self, seq, limit=None):
+        "Return the numbers of the best parents for each chunk of seq, considering only the first limit parents"
+        codes = kmer_codes(seq, self._k)
+        size = (len(codes) + chunk_count - 1) // chunk_count
+        res = [ ]
+        for i in range(0, len(codes), max(size, 1)):
+            counts = collections.Counter()
+            for x in set(codes[i:i+size]):
+                p = self._postings[x] if x >= 0 else None
+                if p is not None:
+                    counts.update(p if limit is None else p[:bisect.bisect_left(p, limit)])
+            for c, n in counts.most_common(hits_per_chunk):
+                if c not in res:
+                    res.append(c)
+        return res
+
+###
+# Alignment
+
+def diagonal(qcodes, pcodes):
+    "Return the most common offset of k-mers shared by a query and parent, or None if they share none"
+    first = { }
+    for i, x in enumerate(qcodes):
+        if x >= 0 and x not in first:
+            first[x] = i
+    counts = collections.Counter(j - first[x] for j, x in enumerate(pcodes) if x in first)
+    return counts.most_common(1)[0][0] if counts else None
+
+def match_votes(query, parent, diag, pad=band):
+    "Align the query with the parent near a diagonal, return a list with 1 for each query position that matches"
+    n = len(query)
+    start = diag - pad
+    t = off_parent * max(0, -start) + parent[max(0, start):diag + n + pad]
+    t += off_parent * (n + 2 * pad - len(t))
+    width = 2 * pad + 1
+    inf = len(t) + n + 1
+    prev = [0] * width
+    ptrs = [ ]
+    for i in range(1, n + 1):
+        qc = query[i-1]
+        cur = [inf] * width
+        ptr = bytearray(width)
+        for k in range(width):
+            best = prev[k+1] + 1 if k + 1 < width else inf
+            p = 1
+            x = prev[k] + (qc != t[i+k-1])
+            if x <= best:
+                best, p = x, 0
+            if k > 0 and cur[k-1] + 1 < best:
+                best, p = cur[k-1] + 1, 2
+            cur[k] = best
+            ptr[k] = p
+        ptrs.append(ptr)
+        prev = cur
+    k = min(range(width), key=prev.__getitem__)
+    votes = [0] * n
+    i = n
+    while i > 0:
+        p = ptrs[i-1][k]
+        if p == 0:
+            votes[i-1] = int(query[i-1] == t[i+k-1])
+            i -= 1
+        elif p == 1:
+            i -= 1
+            k += 1
+        else:
+            k -= 1
+    return votes
+
+###
+# Scoring
+
+def segment_score(y, n, a, params):
+    return y / (params.beta * (n + params.pseudo) + a)
+
+def best_model(va, vb, params):
+    "Return (score, a_left, breakpoint, counts) for the best model made from two parents"
+    n = len(va)
+    ya = list(accumulate((int(x > y) for x, y in zip(va, vb)), initial=0))
+    yb = list(accumulate((int(y > x) for x, y in zip(va, vb)), initial=0))
+    ab = list(accumulate((1 - (x | y) for x, y in zip(va, vb)), initial=0))
+    best = None
+    for a_left, yl, yr in [(True, ya, yb), (False, yb, ya)]:
+        scores = [min(segment_score(yl[i], yr[i], ab[i], params), segment_score(yr[n] - yr[i], yl[n] - yl[i], ab[n] - ab[i], params)) for i in range(1, n)]
+        if scores:
+            h = max(scores)
+            if best is None or h > best[0]:
+                i = scores.index(h) + 1
+                counts = (yl[i], yr[i], ab[i], yr[n] - yr[i], yl[n] - yl[i], ab[n] - ab[i])
+                best = (h, a_left, i, counts)
+    return best
+
+def percent(x, n):
+    return round(100.0 * x / n, 1) if n else 0.0
+
+def check(name, seq, parents, params):
+    "Compare a query with a list of (name, sequence) candidate parents, return a result row"
+    qcodes = kmer_codes(seq)
+    n = len(seq)
+    votes = [ ]
+    for pname, pseq in parents:
+        d = diagonal(qcodes, kmer_codes(pseq))
+        if d is not None and min(len(pseq), d + n) - max(0, d) >= min_overlap * n:
+            v = match_votes(seq, pseq, d)
+            if sum(v) >= min_parent_identity * n:
+                votes.append((pname, v))
+    if not votes:
+        return (0.0, name, '*', '*', '*', '*', '*', '*', '*', '*', 0, 0, 0, 0, 0, 0, '*', 'N')
+    top, vt = max(votes, key=lambda x: sum(x[1]))
+    idqt = percent(sum(vt), n)
+    best = None
+    for (na, va), (nb, vb) in combinations(votes, 2):
+        model = best_model(va, vb, params)
+        if model is not None and (best is None or model[0] > best[0][0]):
+            best = (model, na, va, nb, vb)
+    if best is None:
+        return (0.0, name, '*', '*', top, '*', '*', '*', '*', idqt, 0, 0, 0, 0, 0, 0, '*', 'N')
+    (h, a_left, i, counts), na, va, nb, vb = best
+    if not a_left:
+        na, va, nb, vb = nb, vb, na, va
+    idqm = percent(sum(va[:i]) + sum(vb[i:]), n)
+    idab = percent(n - sum(x != y for x, y in zip(va, vb)), n)
+    div = round(idqm - idqt, 1)
+    ly, ln, la, ry, rn, ra = counts
+    if h >= params.minh and div >= params.mindiv and ly >= params.mindiffs and ry >= params.mindiffs:
+        verdict = 'Y'
+    elif h >= params.minh:
+        verdict = '?'
+    else:
+        verdict = 'N'
+    return (round(h, 4), name, na, nb, top, idqm, percent(sum(va), n), percent(sum(vb), n), idab, idqt, ly, ln, la, ry, rn, ra, div, verdict)
+
+def check_batch(work, params):
+    "Worker function: check each (name, sequence, parents) query in a batch"
+    return [check(name, seq, parents, params) for name, seq, parents in work]
+
+def run_batch(work, params, pool, jobs):
+    "Check a batch, using a pool of processes if there is one"
+    if pool is None or jobs < 2:
+        return check_batch(work, params)
+    size = (len(work) + jobs - 1) // jobs
+    chunks = [(work[i:i+size], params) for i in range(0, len(work), size)]
+    return [x for res in pool.starmap(check_batch, chunks) for x in res]
+
+def reference_chimeras(queries, index, params=default_params, pool=None, jobs=1):
+    "Check (name, sequence) queries against the parents in a ParentIndex, generate a result row for each query"
+    queries = iter(queries)
+    batch = list(islice(queries, batch_size))
+    while batch:
+        work = [(name, seq, [index.parent(c) for c in index.candidates(seq)]) for name, seq in batch]
+        yield from run_batch(work, params, pool, jobs)
+        batch = list(islice(queries, batch_size))
+
+def skew_batches(queries, abskew):
+    "Split (name, sequence, n) queries into batches where no query is abundant enough to be a parent of another"
+    batch = [ ]
+    for q in queries:
+        if batch and (len(batch) == batch_size or abskew * q[2] <= batch[0][2]):
+            yield batch
+            batch = [ ]
+        batch.append(q)
+    if batch:
+        yield batch
+
+def denovo_chimeras(queries, abskew=default_abskew, params=default_params, pool=None, jobs=1):
+    "Check (name, sequence, n) queries sorted by decreasing n, using more abundant queries as parents, generate a result row for each query"
+    index = ParentIndex(step=parent_step)
+    sizes = [ ]
+    for batch in skew_batches(queries, abskew):
+        work = [ ]
+        for name, seq, n in batch:
+            limit = bisect.bisect_right(sizes, -abskew * n)
+            work.append((name, seq, [index.parent(c) for c in index.candidates(seq, limit)]))
+        for (name, seq, n), res in zip(batch, run_batch(work, params, pool, jobs)):
+            if res[-1] != 'Y':
+                index.add(name, seq)
+                sizes.append(-n)
+            yield res
@@ -0,0 +1,130 @@
+# Cache of chimera verdicts shared by several projects
+
+# filter_chimeras.py --cache saves the result for each centroid it checks in an SQLite
+# database outside the project, so when the same sequence turns up in another project
+# (or the stage is run again) it doesn't have to be checked again.  A result depends
+# on the sequence, the reference sequences, and the detector settings, so entries are
+# keyed by the sequence digest (see common.sequence_digest), a checksum of the
+# reference file, and a digest of the settings.  The sequence is saved with the entry
+# and compared on lookup.
+
+# The result saved for a sequence is the line from the -uchimeout file without the
+# query name (different projects use different names for the same sequence).
+
+# Each entry has the time it was last used.  When the size of the saved sequences and
+# results is over the limit the least recently used entries are deleted.
+
+# Usage:
+#
+#    cache = ChimeraCache(fn, max_size)
+#    key = (file_checksum(reference), settings_digest('builtin', params))
+#    rows, misses = cache.split(key, queries)
+#    ... check the misses ...
+#    cache.save(key, [(seq, row), ...])
+#    cache.evict()
+#    cache.close()
+
+import hashlib
+import sqlite3
+import time
+
+from common import sequence_digest
+
+lookup_batch = 500
+entry_overhead = 64
+
+create_table = '''CREATE TABLE IF NOT EXISTS verdicts (
+    digest INTEGER, reference TEXT, params TEXT, sequence TEXT, result TEXT, size INTEGER, used REAL,
+    PRIMARY KEY (digest, reference, params))'''
+create_index = 'CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts (used)'
+
+def file_checksum(fn):
+    "Return a hex digest of the contents of a file"
+    h = hashlib.blake2b(digest_size=16)
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def settings_digest(*values):
+    "Return a hex digest of a list of detector settings"
+    return hashlib.blake2b(repr(values).encode(), digest_size=16).hexdigest()
+
+class ChimeraCache:
+
+    def __init__(self, fn, max_size):
+        "Open (or create) the cache in file fn, holding at most max_size bytes of sequences and results"
+        self._db = sqlite3.connect(fn, timeout=600)
+        self._db.execute(create_table)
+        self._db.execute(create_index)
+        self._db.commit()
+        self._max_size = max_size
+
+    def lookup(self, key, seqs):
+        "Return a dictionary mapping sequences in a list to their saved results"
+        digests = { sequence_digest(s): s for s in seqs }
+        sql = 'SELECT digest, sequence, result FROM verdicts WHERE reference = ? AND params = ? AND digest IN ({})'
+        sql = sql.format(','.join('?' * len(digests)))
+        found = { }
+        for d, seq, result in self._db.execute(sql, (*key, *digests)):
+            if digests[d] == seq:
+                found[seq] = result.split('\t')
+        sql = 'UPDATE verdicts SET used = ? WHERE reference = ? AND params = ? AND digest = ?'
+        self._db.executemany(sql, [(time.time(), *key, sequence_digest(s)) for s in found])
+        return found
+
+    def split(self, key, queries):
+        "Return the result rows for the (name, sequence) queries in the cache and a dictionary of the others"
+        rows = [ ]
+        misses = { }
+        batch = [ ]
+        for q in queries:
+            batch.append(q)
+            if len(batch) == lookup_batch:
+                self._split_batch(key, batch, rows, misses)
+                batch = [ ]
+        self._split_batch(key, batch, rows, misses)
+        self._db.commit()
+        return rows, misses
+
+    def _split_batch(self, key, batch, rows, misses):
+        found = self.lookup(key, [seq for name, seq in batch]) if batch else { }
+        for name, seq in batch:
+            res = found.get(seq)
+            if res is None:
+                misses[name] = seq
+            else:
+                rows.append([res[0], name] + res[1:])
+
+    def save(self, key, results):
+        "Save a list of (sequence, row) results"
+        sql = 'INSERT OR REPLACE INTO verdicts (digest, reference, params, sequence, result, size, used) VALUES (?,?,?,?,?,?,?)'
+        now = time.time()
+        data = [ ]
+        for seq, row in results:
+            result = '\t'.join(str(x) for x in [row[0]] + list(row[2:]))
+            data.append((sequence_digest(seq), *key, seq, result, len(seq) + len(result) + entry_overhead, now))
+        self._db.executemany(sql, data)
+        self._db.commit()
+
+    def size(self):
+        "Return the total size of the entries"
+        return self._db.execute('SELECT coalesce(sum(size), 0) FROM verdicts').fetchone()[0]
+
+    def evict(self):
+        "Delete the least recently used entries until the cache is below its size limit, return the number deleted"
+        excess = self.size() - self._max_size
+        if excess <= 0:
+            return 0
+        cutoff = None
+        for used, size in self._db.execute('SELECT used, size FROM verdicts ORDER BY used'):
+            cutoff = used
+            excess -= size
+            if excess <= 0:
+                break
+        n = self._db.execute('DELETE FROM verdicts WHERE used <= ?', (cutoff,)).rowcount
+        self._db.commit()
+        return n
+
+    def close(self):
+        self._db.close()
@@ -34,6 +34,29 @@ def init_api(desc, specs, epi=None, with_limits=False):
     args = parser.parse_args()
     return args
 
+# Scripts that load large amounts of data can add these arguments to the list passed
+# to init_api and call init_bulk_load right after connecting to the database (before 
+# any other statements, since some settings can't be changed in a transaction).  The
+# defaults are a write-ahead log (WAL mode stays set in the database file) and
+# synchronous = normal, which is safe if the script crashes or is interrupted and
+# only loses the last transactions if the computer crashes.  '--journal memory' or
+# '--journal off' is faster, but then the database can be corrupted if the script
+# dies in the middle of a transaction (SQLite writes changed pages to the file before
+# the transaction ends when a large transaction doesn't fit in the cache), and
+# '--synchronous off' means a computer crash can corrupt the database.
+
+bulk_load_specs = [
+    ('journal',      { 'metavar': 'mode', 'default': 'wal', 'help' : 'SQLite journal mode while loading data (default: wal; memory or off are faster but unsafe if the script is interrupted)'} ),
+    ('synchronous',  { 'metavar': 'mode', 'default': 'normal', 'help' : 'SQLite synchronous setting while loading data (default: normal)'} ),
+    ('cache',        { 'metavar': 'MB', 'type': int, 'default': 256, 'help' : 'SQLite page cache size in MB (default: 256)'} ),
+]
+
+def init_bulk_load(db, args):
+    "Set the SQLite options defined by bulk_load_specs"
+    db.execute('PRAGMA journal_mode = {}'.format(args.journal))
+    db.execute('PRAGMA synchronous = {}'.format(args.synchronous))
+    db.execute('PRAGMA cache_size = {}'.format(-1024 * args.cache))
+
 # Scripts early in the pipeline can restrict operations to a specified sample
 # (e.g. when testing the pipeline). This function returns a list of records from
 # the 'samples' table.  If a sample name is specfied on the command line
@@ -49,6 +72,18 @@ def sample_list(db, args):
         sql += ' WHERE name = "{}"'.format(args.sample)
     return db.execute(sql).fetchall()
 
+###
+# Fetch the primer sequences from the database (used by assemble_pairs.py and
+# trim_primers.py).  The result is a dictionary that maps a pair end (1 or 2) to the
+# primer sequence for that end.
+
+def fetch_primers(db):
+    "Read the primer sequences from the database"
+    primers = { }
+    for n, seq in db.execute("SELECT pair_end, sequence FROM primers"):
+        primers[int(n)] = seq
+    return primers
+
 ###
 # Initialize the directory where intermediate work products will be stored.
 
@@ -84,7 +119,7 @@ def init_workspace(args):
 
 # Parameters:
 
-def init_table(db, name, key, cols, replace, sample_name=None, has_primary=True):
+def init_table(db, name, key, cols, replace, sample_name=None, has_primary=True, keep=False):
     """Initialize the output table for this stage in the pipeline.  Parameters:
            db           reference to database
            name         output table name
@@ -92,6 +127,7 @@ def init_table(db, name, key, cols, replace, sample_name=None, has_primary=True)
            cols         an array of tuples with specs for remaining columns
            replace      flag that specifies whether --force is on the command line
            sample_name  (optional) sample to be processed
+           keep         (optional) keep existing records (for scripts that resume an earlier run)
     """
     
     def fetch_table_spec(db, name):
@@ -131,6 +167,15 @@ def init_table(db, name, key, cols, replace, sample_name=None, has_primary=True)
         record_metadata(db, 'query', sql)
         db.execute(sql)
         
+    def add_new_columns():
+        'Add columns defined in the spec that are not in a table made by an earlier version of the script'
+        current = [row[1] for row in db.execute('PRAGMA table_info({})'.format(name))]
+        for tup in cols:
+            if tup[0] not in current and tup[1] != 'foreign':
+                sql = 'ALTER TABLE {tbl} ADD COLUMN {col}'.format(tbl=name, col=col_spec(tup))
+                record_metadata(db, 'query', sql)
+                db.execute(sql)
+        
     # See if the table exists; if not, make it and return
     existing = fetch_table_spec(db, name)
     if not existing:
@@ -139,6 +184,10 @@ def init_table(db, name, key, cols, replace, sample_name=None, has_primary=True)
         db.execute(sql)
         return
     
+    add_new_columns()
+    if keep:
+        return
+    
     # If the table has a 'sample_id' column and the command line has a --sample
     # option map a sample name into a sample ID; if the name is invalid abort the script
     if existing.find('sample_id') and sample_name is not None:
@@ -179,7 +228,8 @@ def record_metadata(db, event, message, commit=False):
 
 ###
 # Create a map that associates a defline with the sequence ID in the 
-# panda table
+# panda table.  Scripts should use unique_id_map, which uses integer IDs 
+# made from deflines (see FASTQ.defline_id) as keys.
 
 fetch_from_panda = 'SELECT panda_id, defline FROM panda'
 
@@ -192,6 +242,79 @@ def defline_map(db, sample_id = None):
         dm[defline] = pid
     return dm
 
+# Sequences with deflines that aren't in Illumina format have a NULL unique_id, so
+# for those the key is the defline.  Look up sequences with FASTQ.defline_key.
+
+fetch_ids_from_panda = 'SELECT coalesce(unique_id, defline), panda_id FROM panda'
+
+def unique_id_map(db, sample_id = None):
+    query = fetch_ids_from_panda
+    if sample_id:
+        query += ' WHERE sample_id = {}'.format(sample_id)
+    return dict(db.execute(query))
+
+###
+# Index the unique_id column in the reads or panda table.  Scripts call this 
+# after loading data so the index is built once instead of updated on each insert.
+
+def index_unique_ids(db, table):
+    sql = 'CREATE INDEX IF NOT EXISTS {tbl}_uidx ON {tbl} (unique_id)'.format(tbl=table)
+    record_metadata(db, 'query', sql)
+    db.execute(sql)
+
+# A reads or panda table made by an earlier version of the pipeline gets a unique_id
+# column from init_table, but the column is NULL in the old rows.  ensure_unique_ids
+# fills it in from the deflines (rows without a defline, or with a defline that isn't
+# in Illumina format, stay NULL) and builds the index.
+
+from FASTQ import FASTQ
+
+def ensure_unique_ids(db, table):
+    "Make sure the rows in a table have a unique_id if their defline has one and the column is indexed"
+    cols = [row[1] for row in db.execute('PRAGMA table_info({})'.format(table))]
+    if 'unique_id' not in cols:
+        sql = 'ALTER TABLE {tbl} ADD COLUMN unique_id INTEGER'.format(tbl=table)
+        record_metadata(db, 'query', sql)
+        db.execute(sql)
+    db.create_function('defline_id', 1, FASTQ.try_defline_id, deterministic=True)
+    sql = 'UPDATE {tbl} SET unique_id = defline_id(defline) WHERE unique_id IS NULL AND defline IS NOT NULL'.format(tbl=table)
+    record_metadata(db, 'query', sql)
+    db.execute(sql)
+    index_unique_ids(db, table)
+
+###
+# Sequences are identified by a 64-bit digest (a signed integer so it can be saved in
+# an INTEGER column).  Scripts use the digest as a hash table key instead of the
+# sequence itself.
+
+import hashlib
+
+def sequence_digest(seq):
+    "Return the digest of a sequence (a string) as a 64-bit signed integer"
+    return int.from_bytes(hashlib.blake2b(seq.encode(), digest_size=8).digest(), 'big', signed=True)
+
+# Tables with a sequence column (panda, clusters) also have an indexed digest column so
+# queries can join or group on the digest and only compare sequences with the same
+# digest.  Scripts fill in the digest when they insert a sequence; ensure_digest adds
+# the column to a table made by an earlier version of the pipeline, computes any
+# missing digests, and builds the index.  The schema argument is the name of an
+# attached database.
+
+def ensure_digest(db, table, schema='main'):
+    "Make sure every row in a table has a digest and the digest column is indexed"
+    cols = [row[1] for row in db.execute('PRAGMA {}.table_info({})'.format(schema, table))]
+    queries = [ ]
+    if 'digest' not in cols:
+        queries.append('ALTER TABLE {s}.{t} ADD COLUMN digest INTEGER')
+    queries.append('CREATE INDEX IF NOT EXISTS {s}.{t}_digest ON {t} (digest)')
+    queries.append('UPDATE {s}.{t} SET digest = sequence_digest(sequence) WHERE digest IS NULL')
+    db.create_function('sequence_digest', 1, sequence_digest, deterministic=True)
+    for sql in queries:
+        sql = sql.format(s=schema, t=table)
+        if schema == 'main':
+            record_metadata(db, 'query', sql)
+        db.execute(sql)
+
 ###
 # Return a string containing the path to one of the project resource files
 #
@@ -13,9 +13,9 @@
 
 import argparse
 import sqlite3
-import os.path
 import sys
-import re
+
+from common import sequence_digest
 
 ##
 # Execute a query that returns a single value, e.g. a table size, or None if the result
@@ -55,15 +55,28 @@ def print_header(names, linespec):
     print(linespec.format(*seps))
     
 ## 
-# Prep:  make tables showing clusters in both DBs and in one DB but not the other
+# Prep:  make tables showing clusters in both DBs and in one DB but not the other.
+# Clusters are matched on the digest of the sequence and then on the sequence itself,
+# so sequences are only compared when the digests are equal.  The digests are computed
+# in temporary tables (Aseqs and Bseqs) so the input databases are never modified and
+# can be read-only.
+
+seqs = 'CREATE TEMP TABLE {d}seqs AS SELECT cluster_id, name, sequence, sequence_digest(sequence) AS digest FROM {d}.clusters'
+seqs_index = 'CREATE INDEX temp.{d}seqs_digest ON {d}seqs (digest)'
+
+same_sequence = '(Aseqs.digest = Bseqs.digest AND Aseqs.sequence = Bseqs.sequence)'
 
-a_and_b = 'CREATE TABLE AandB AS SELECT A.clusters.cluster_id as aid, A.clusters.name AS aname, B.clusters.cluster_id as bid, B.clusters.name AS bname FROM A.clusters JOIN B.clusters USING (sequence)'
-a_not_b = 'CREATE TABLE AnotB AS SELECT A.clusters.cluster_id as aid, A.clusters.name AS aname FROM A.clusters LEFT JOIN B.clusters USING (sequence) WHERE b.clusters.name IS NULL'
-b_not_a = 'CREATE TABLE BnotA AS SELECT B.clusters.cluster_id as bid, B.clusters.name AS bname FROM B.clusters LEFT JOIN A.clusters USING (sequence) WHERE a.clusters.name IS NULL'
+a_and_b = 'CREATE TABLE AandB AS SELECT Aseqs.cluster_id as aid, Aseqs.name AS aname, Bseqs.cluster_id as bid, Bseqs.name AS bname FROM Aseqs JOIN Bseqs ON ' + same_sequence
+a_not_b = 'CREATE TABLE AnotB AS SELECT Aseqs.cluster_id as aid, Aseqs.name AS aname FROM Aseqs LEFT JOIN Bseqs ON ' + same_sequence + ' WHERE Bseqs.name IS NULL'
+b_not_a = 'CREATE TABLE BnotA AS SELECT Bseqs.cluster_id as bid, Bseqs.name AS bname FROM Bseqs LEFT JOIN Aseqs ON ' + same_sequence + ' WHERE Aseqs.name IS NULL'
 
 taxa = 'CREATE TABLE {d}taxa AS SELECT cluster_id, genus.name AS genus FROM {d}.clusters LEFT JOIN {d}.taxonomy ON (cluster_id = otu_id) JOIN {d}.genus USING (genus_id)'
 
 def make_temp_tables(db):
+    db.create_function('sequence_digest', 1, sequence_digest, deterministic=True)
+    for d in ['A', 'B']:
+        db.execute(seqs.format(d=d))
+        db.execute(seqs_index.format(d=d))
     db.execute(a_and_b)
     db.execute(a_not_b)
     db.execute(b_not_a)
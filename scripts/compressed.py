@@ -0,0 +1,202 @@
+# Open sequence files that might be compressed
+
+# The open_input function opens a file in binary mode.  If the file is compressed
+# (gzip, BGZF, or zstd) the function returns a file object that reads the
+# uncompressed data.  The type of compression is determined from the first few
+# bytes in the file, not from the file name, so a .fastq.gz file is handled the
+# same way as a .fastq file.
+
+# Decompression is done by a background thread that puts uncompressed chunks of
+# data in a queue, so a script can parse one part of a file while the next part is
+# being decompressed.  zlib releases the interpreter lock while it works, so the
+# thread runs in parallel with the script.
+
+# BGZF files (the blocked gzip format used by samtools and bgzip) consist of
+# independent gzip blocks of at most 64KB.  The background thread for a BGZF file
+# uses a pool of threads to decompress a set of blocks in parallel.
+
+# zstd compression requires the 'zstandard' module, which is only imported when a
+# zstd file is opened.
+
+import io
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+gzip_magic = b'\x1f\x8b'
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+chunk_size = 1024 * 1024            # bytes of compressed data read at a time
+queue_depth = 8                     # max number of uncompressed chunks waiting to be read
+
+def open_input(fn, threads=4):
+    "Open file 'fn' for reading in binary mode, uncompressing it if necessary."
+    f = open(fn, 'rb')
+    magic = f.peek(18)[:18]
+    if magic.startswith(zstd_magic):
+        return io.BufferedReader(BackgroundReader(zstd_chunks(f)), chunk_size)
+    if not magic.startswith(gzip_magic):
+        return f
+    if is_bgzf(magic):
+        return io.BufferedReader(BackgroundReader(bgzf_chunks(f, threads)), chunk_size)
+    return io.BufferedReader(BackgroundReader(gzip_chunks(f)), chunk_size)
+
+###
+# A BackgroundReader is a raw binary stream that gets its data from a generator
+# that runs in a separate thread.  The generator passes chunks of data through a
+# bounded queue; if it raises an exception the exception is raised again in the
+# thread that reads from the stream.
+
+class BackgroundReader(io.RawIOBase):
+
+    def __init__(self, chunks):
+        "Make a stream for data produced by the generator 'chunks'"
+        self._queue = queue.Queue(queue_depth)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._produce, args=(chunks,), daemon=True)
+        self._thread.start()
+
+    def _produce(self, chunks):
+        "Body of the background thread"
+        try:
+            for data in chunks:
+                if data and not self._put(data):
+                    break
+            self._put(None)
+        except Exception as err:
+            self._put(err)
+        finally:
+            chunks.close()
+
+    def _put(self, item):
+        "Add an item to the queue unless the stream is closed; return False if it's closed"
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._chunk) == 0:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                self._eof = True
+                raise item
+            else:
+                self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._stop.set()
+        super().close()
+
+###
+# Generators that read compressed data from a file and produce uncompressed chunks.
+# A gzip file can have more than one member (e.g. files made with 'cat a.gz b.gz')
+# so when the decompressor reaches the end of one member it starts a new one.  As in
+# the gzip module, NUL bytes after a member are padding, and a file that ends in the
+# middle of a member is an error.
+
+def skip_padding(f, data):
+    "Return the data that follows any NUL bytes at the front of data, reading more from f if needed"
+    data = data.lstrip(b'\0')
+    while not data:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        data = data.lstrip(b'\0')
+    return data
+
+def gzip_chunks(f):
+    "Generate the uncompressed data in gzip file f"
+    try:
+        z = None
+        data = f.read(chunk_size)
+        while data:
+            if z is None:
+                z = zlib.decompressobj(31)
+            yield z.decompress(data)
+            if z.eof:
+                data = skip_padding(f, z.unused_data)
+                z = None
+            else:
+                data = f.read(chunk_size)
+        if z is not None:
+            yield z.flush()
+            raise EOFError('compressed file ended before the end-of-stream marker was reached')
+    finally:
+        f.close()
+
+def zstd_chunks(f):
+    "Generate the uncompressed data in zstd file f"
+    try:
+        import zstandard
+    except ImportError:
+        f.close()
+        raise Exception('the zstandard module is required to read zstd files')
+    try:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        data = reader.read(chunk_size)
+        while data:
+            yield data
+            data = reader.read(chunk_size)
+    finally:
+        f.close()
+
+###
+# A BGZF file is a gzip file where each member has an extra header field named 'BC'
+# that holds the size of the member.
+
+def is_bgzf(header):
+    "Return True if header is the start of a BGZF block"
+    return len(header) >= 18 and header[2:4] == b'\x08\x04' and header[12:14] == b'BC'
+
+def bgzf_blocks(f):
+    "Generate the compressed blocks in BGZF file f"
+    header = f.read(12)
+    while len(header) == 12:
+        xlen = int.from_bytes(header[10:12], 'little')
+        extra = f.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = int.from_bytes(extra[i+2:i+4], 'little')
+            if extra[i:i+2] == b'BC':
+                bsize = int.from_bytes(extra[i+4:i+6], 'little')
+            i += 4 + slen
+        if bsize is None:
+            raise Exception('BGZF block without a size field')
+        yield header + extra + f.read(bsize + 1 - 12 - xlen)
+        header = f.read(12)
+
+def inflate(block):
+    "Uncompress one BGZF block"
+    return zlib.decompress(block, 31)
+
+def bgzf_chunks(f, threads):
+    "Generate the uncompressed data in BGZF file f, decompressing blocks in parallel"
+    try:
+        blocks = bgzf_blocks(f)
+        with ThreadPoolExecutor(threads) as pool:
+            batch = list(islice(blocks, 16*threads))
+            while batch:
+                yield b''.join(pool.map(inflate, batch))
+                batch = list(islice(blocks, 16*threads))
+    finally:
+        f.close()
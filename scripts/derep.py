@@ -0,0 +1,176 @@
+# Find exact duplicates in a set of sequences
+
+# The dereplicate function makes a single pass over a sequence of (key, sequence)
+# pairs.  Sequences are looked up in a hash table using their digest (see
+# common.sequence_digest) and the sequence itself, since two different sequences can
+# have the same 64-bit digest; the first time a sequence is seen its key and sequence
+# are saved as the representative for the sequence, after that the count is incremented.
+
+# The result is a list of (key, sequence, n) tuples in the order the representatives
+# were first seen.  The key can be anything that identifies a sequence, e.g. a panda_id
+# or the defline from a FASTA file.
+
+from common import sequence_digest
+
+def dereplicate(records):
+    "Return a list of (key, sequence, n) for the unique sequences in a list of (key, sequence) pairs"
+    index = { }
+    reps = [ ]
+    counts = [ ]
+    for key, seq in records:
+        d = (sequence_digest(seq), seq)
+        i = index.get(d)
+        if i is None:
+            index[d] = len(reps)
+            reps.append((key, seq))
+            counts.append(1)
+        else:
+            counts[i] += 1
+    return [(key, seq, n) for (key, seq), n in zip(reps, counts)]
+
+###
+# External memory dereplication, for sets of sequences that might not fit in memory.
+# Records are numbered in the order they are read and written to one of several
+# spill files (partitions) based on their digest, so all copies of a sequence end up
+# in the same partition.  Each partition is then dereplicated in memory.  If the
+# unique sequences in a partition would use more than max_memory bytes the
+# partition is split again using a different part of the digest.
+#
+# The unique sequences from each partition are sorted by the number of the record
+# where they first appeared and saved in a result file; iterating over the
+# ExternalResults object merges the result files, so the order is the same as the
+# order from dereplicate.
+#
+# Memory use is estimated from the lengths of the keys and sequences plus a fixed
+# overhead for each entry in the hash table.  Records waiting to be written to spill
+# files use at most a quarter of max_memory.
+
+import heapq
+import os
+import pickle
+import re
+import tempfile
+
+partition_count = 16
+spill_batch = 10000
+entry_overhead = 200
+
+size_units = { '': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4 }
+
+def parse_size(s):
+    "Convert a string like '500M' or '4G' into a number of bytes"
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMGT]?)B?', s.strip().upper())
+    if m is None:
+        raise ValueError('bad memory size: ' + s)
+    return int(float(m.group(1)) * size_units[m.group(2)])
+
+def entry_size(key, seq):
+    return len(seq) + (len(key) if isinstance(key, str) else 0) + entry_overhead
+
+def write_batches(fn, items):
+    "Write a list of items to a file as pickled batches"
+    with open(fn, 'wb') as f:
+        for i in range(0, len(items), spill_batch):
+            pickle.dump(items[i:i+spill_batch], f, pickle.HIGHEST_PROTOCOL)
+
+def read_batches(fn):
+    "Generate the items in a file written by write_batches or a Partition"
+    with open(fn, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+class Partition:
+    "A spill file for records with the same digest bits"
+
+    def __init__(self, fn, buffer_size):
+        self.fn = fn
+        self._file = open(fn, 'wb')
+        self._buffer = [ ]
+        self._size = 0
+        self._limit = buffer_size
+
+    def add(self, item):
+        self._buffer.append(item)
+        self._size += entry_size(item[2], item[3])
+        if self._size >= self._limit:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            pickle.dump(self._buffer, self._file, pickle.HIGHEST_PROTOCOL)
+            self._buffer = [ ]
+            self._size = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+class ExternalResults:
+    "The unique sequences found by dereplicate_external, saved in temporary files"
+
+    def __init__(self, tmpdir, files, count):
+        self._tmpdir = tmpdir
+        self._files = files
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        "Generate (key, sequence, n) tuples in the order the sequences first appeared"
+        for order, key, seq, n in heapq.merge(*[read_batches(fn) for fn in self._files]):
+            yield key, seq, n
+
+    def close(self):
+        self._tmpdir.cleanup()
+
+def partition(items, prefix, level, max_memory):
+    "Write (order, digest, key, seq) items to spill files, return the file names"
+    buffer_size = max(max_memory // (4 * partition_count), 65536)
+    parts = [Partition('{}.{}'.format(prefix, i), buffer_size) for i in range(partition_count)]
+    shift = 4 * level
+    for item in items:
+        parts[(item[1] >> shift) % partition_count].add(item)
+    for p in parts:
+        p.close()
+    return [p.fn for p in parts]
+
+def dereplicate_partition(fn, max_memory):
+    "Return a list of (order, key, seq, n) for the items in a spill file, or None if they don't fit in max_memory"
+    table = { }
+    size = 0
+    for order, d, key, seq in read_batches(fn):
+        entry = table.get((d, seq))
+        if entry is None:
+            table[(d, seq)] = [order, key, seq, 1]
+            size += entry_size(key, seq)
+            if size > max_memory:
+                return None
+        else:
+            entry[3] += 1
+    return sorted(tuple(x) for x in table.values())
+
+def dereplicate_external(records, max_memory, dirname=None):
+    "Dereplicate (key, sequence) pairs using at most max_memory bytes for the hash table, return an ExternalResults object"
+    tmpdir = tempfile.TemporaryDirectory(prefix='derep.', dir=dirname)
+    items = ((i, sequence_digest(seq), key, seq) for i, (key, seq) in enumerate(records))
+    pending = [(fn, 1) for fn in partition(items, os.path.join(tmpdir.name, 'part'), 0, max_memory)]
+    results = [ ]
+    count = 0
+    while pending:
+        fn, level = pending.pop()
+        res = dereplicate_partition(fn, max_memory)
+        if res is None:
+            if level * 4 >= 64:
+                raise MemoryError('unique sequences do not fit in {} bytes'.format(max_memory))
+            pending += [(x, level + 1) for x in partition(read_batches(fn), fn, level, max_memory)]
+        else:
+            write_batches(fn + '.res', res)
+            results.append(fn + '.res')
+            count += len(res)
+        os.remove(fn)
+    return ExternalResults(tmpdir, results, count)
@@ -1,6 +1,9 @@
 #! /usr/bin/env python3
 
-# Run usearch to filter chimeras using a reference database
+# Run usearch to filter chimeras using a reference database.  With --builtin the
+# chimeras are found by the detector in chimera.py, running in this process and a
+# pool of worker processes.  With --denovo no reference is used; a centroid is
+# checked against the centroids that are at least abskew times more abundant.
 
 # John Conery / Kevin Xu Junjie
 # University of Oregon
@@ -12,8 +15,14 @@ import os
 import os.path
 import re
 import sys
+import multiprocessing
 
 from common import *
+from FASTA import FASTAReader
+from chimera import ParentIndex, default_params, default_abskew, reference_chimeras, denovo_chimeras
+import chimera
+from chimera_cache import ChimeraCache, file_checksum, settings_digest
+from derep import parse_size
 
 # Define filenames (may be referenced by more than one function)
 
@@ -21,33 +30,152 @@ result_file = 'results.uc'
 input_file = 'clusters.fasta'
 
 ###
-# Print the sequences to check; they're the centroids in the clusters saved in the clusters table
+# Print the sequences to check; they're the centroids in the clusters saved in the clusters table.
+# With --denovo the centroids are printed in order of decreasing abundance with the
+# abundance in the defline.
 
+fetch_clusters = 'SELECT name, sequence FROM clusters'
 
 def print_sequences(db, args):
-    fetch_clusters = 'SELECT name, sequence FROM clusters'
-    record_metadata(db, 'query', fetch_clusters)
     ff = open(os.path.join(args.workspace, input_file), 'w')
-    for name, sequence in db.execute(fetch_clusters):
-        print('>{}'.format(name), file=ff)
-        print(sequence, file=ff)    
+    if args.denovo:
+        for name, sequence, n in fetch_abundances(db):
+            print('>{};size={};'.format(name, n), file=ff)
+            print(sequence, file=ff)
+    else:
+        record_metadata(db, 'query', fetch_clusters)
+        for name, sequence in db.execute(fetch_clusters):
+            print('>{}'.format(name), file=ff)
+            print(sequence, file=ff)    
     ff.close()
 
+# The abundance of a centroid is the number of copies of its sequence, from the
+# seq_counts table if remove_duplicates.py made it, otherwise from uniq.  Centroids are
+# matched to sequences by digest and text; centroids that aren't in the table (e.g.
+# reference sequences added by form_otus.py) have an abundance of 0.
+
+find_sequence_table = 'SELECT name FROM sqlite_master WHERE type = "table" AND name = "seq_counts"'
+
+def fetch_abundances(db):
+    "Return a cursor for (name, sequence, n) for each centroid, in order of decreasing n"
+    ensure_digest(db, 'clusters')
+    if db.execute(find_sequence_table).fetchall():
+        sql = 'SELECT name, clusters.sequence, coalesce(sum(n), 0) AS count FROM clusters LEFT JOIN sequences ON (sequences.digest = clusters.digest AND sequences.sequence = clusters.sequence) LEFT JOIN seq_counts USING (seq_id)'
+    else:
+        ensure_digest(db, 'panda')
+        sql = 'SELECT name, clusters.sequence, coalesce(sum(n), 0) AS count FROM clusters LEFT JOIN panda ON (panda.digest = clusters.digest AND panda.sequence = clusters.sequence) LEFT JOIN uniq USING (panda_id)'
+    sql += ' GROUP BY cluster_id ORDER BY count DESC, cluster_id'
+    record_metadata(db, 'query', sql)
+    return db.execute(sql)
+
 ###
 # Run the app
 
-def run_uchime_ref(args):
-    cmnd = 'usearch -uchime_ref '
-    cmnd += os.path.join(args.workspace, input_file)
-    cmnd += ' -db ' + args.reference
-    cmnd += ' -strand plus'
+def run_uchime(args):
+    if args.denovo:
+        cmnd = 'usearch -uchime_denovo '
+        cmnd += os.path.join(args.workspace, input_file)
+        cmnd += ' -abskew {}'.format(args.abskew)
+    else:
+        cmnd = 'usearch -uchime_ref '
+        cmnd += os.path.join(args.workspace, input_file)
+        cmnd += ' -db ' + args.reference
+        cmnd += ' -strand plus'
     cmnd += ' -uchimeout ' + os.path.join(args.workspace, result_file)
     print(cmnd)
     record_metadata(db, 'exec', cmnd, commit=True)
     res = os.system(cmnd)
     
 ###
-# Parse the output file, save references to chimeric sequences in a new table.
+# Built-in detector.  The reference sequences are loaded into a k-mer index and the
+# centroids are checked in batches by a pool of worker processes.  With --denovo there
+# is no reference, the parents are the more abundant centroids.  The results are
+# written to the same file usearch would write, in the same format, so they are
+# imported the same way.
+
+def chimera_params(args):
+    return default_params._replace(minh=args.minh, mindiv=args.mindiv)
+
+def load_reference(fn):
+    index = ParentIndex()
+    for rec in FASTAReader(fn):
+        index.add(rec.defline()[1:].split()[0], rec.sequence())
+    return index
+
+def write_results(results, fn):
+    with open(fn, 'w') as f:
+        for res in results:
+            print(*res, sep='\t', file=f)
+
+def run_builtin(db, args, queries=None):
+    if args.denovo:
+        queries = fetch_abundances(db)
+        msg = 'builtin de novo chimera check, abskew {}'.format(args.abskew)
+    else:
+        if queries is None:
+            record_metadata(db, 'query', fetch_clusters)
+            queries = db.execute(fetch_clusters)
+        index = load_reference(args.reference)
+        msg = 'builtin chimera check against {} ({} sequences)'.format(args.reference, len(index))
+    msg += ', minh {}, mindiv {}'.format(args.minh, args.mindiv)
+    print(msg)
+    record_metadata(db, 'exec', msg, commit=True)
+    with multiprocessing.Pool(args.jobs) as pool:
+        if args.denovo:
+            results = denovo_chimeras(queries, args.abskew, chimera_params(args), pool, args.jobs)
+        else:
+            results = reference_chimeras(queries, index, chimera_params(args), pool, args.jobs)
+        write_results(results, os.path.join(args.workspace, result_file))
+
+###
+# With --cache the centroids are looked up in a cache shared with other projects (see
+# chimera_cache.py) and only the ones that aren't found are written to the input file
+# for usearch or passed to the built-in detector.  The new results are saved in the
+# cache and the cached results are added to the results file.  De novo results depend
+# on the other centroids in the project so they are not cached.  The key for built-in
+# results includes every setting in chimera.py that changes the scores or verdicts.
+
+def cache_key(args):
+    if args.builtin:
+        settings = settings_digest('builtin', tuple(chimera_params(args)), chimera.kmer_length, chimera.chunk_count, chimera.hits_per_chunk, chimera.band, chimera.off_parent, chimera.min_overlap, chimera.min_parent_identity)
+    else:
+        settings = settings_digest('usearch', '-uchime_ref -strand plus')
+    return file_checksum(args.reference), settings
+
+def read_results(fn):
+    with open(fn) as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+def run_cached(db, args):
+    cache = ChimeraCache(args.cache, parse_size(args.cache_size))
+    key = cache_key(args)
+    record_metadata(db, 'query', fetch_clusters)
+    rows, misses = cache.split(key, db.execute(fetch_clusters))
+    msg = '{} results found in {}, {} sequences to check'.format(len(rows), args.cache, len(misses))
+    print(msg)
+    record_metadata(db, 'cache', msg, commit=True)
+    fn = os.path.join(args.workspace, result_file)
+    new = [ ]
+    if misses:
+        if args.builtin:
+            run_builtin(db, args, misses.items())
+        else:
+            with open(os.path.join(args.workspace, input_file), 'w') as ff:
+                for name, sequence in misses.items():
+                    print('>{}'.format(name), file=ff)
+                    print(sequence, file=ff)
+            run_uchime(args)
+        new = read_results(fn)
+        cache.save(key, [(misses[row[1]], row) for row in new])
+    write_results(rows + new, fn)
+    n = cache.evict()
+    if n:
+        record_metadata(db, 'cache', '{} entries evicted from {}'.format(n, args.cache))
+    cache.close()
+
+###
+# Parse the output file, save references to chimeric sequences in a new table.  The
+# query names written by usearch -uchime_denovo end with the size annotation.
 
 insert_record = 'INSERT INTO chimeras (cluster_id, chimeric) VALUES (?,?)'
 
@@ -55,7 +183,7 @@ def import_results(db, args):
     cmap = make_cmap(db)
     for line in open(os.path.join(args.workspace, result_file)):
         res = line.split('\t')
-        defspec = res[1]
+        defspec = re.sub(r';size=\d+;?$', '', res[1])
         chimeric = res[-1].strip()
         db.execute(insert_record, (cmap[defspec], chimeric))
 
@@ -70,8 +198,13 @@ def make_cmap(db):
 
 def filter_chimeras(db, args):
     init_workspace(args)
-    print_sequences(db, args)
-    run_uchime_ref(args)
+    if args.cache and not args.denovo:
+        run_cached(db, args)
+    elif args.builtin:
+        run_builtin(db, args)
+    else:
+        print_sequences(db, args)
+        run_uchime(args)
     import_results(db, args)
 
 ###
@@ -84,6 +217,14 @@ if __name__ == "__main__":
         specs = [
             ('workspace',    { 'metavar': 'dir', 'help' : 'working directory', 'default' : 'chimeras' } ),
             ('reference',    { 'metavar': 'fn', 'help' : 'FASTA file containing reference sequences', 'default' : path_to_resource('gold.fa') } ),
+            ('denovo',       { 'action': 'store_true', 'help' : 'de novo detection, using more abundant centroids as parents instead of a reference'} ),
+            ('abskew',       { 'metavar': 'x', 'type' : float, 'default' : default_abskew, 'help' : 'minimum abundance ratio of parent to chimera with --denovo (default {})'.format(default_abskew)} ),
+            ('builtin',      { 'action': 'store_true', 'help' : 'use the built-in chimera detector instead of usearch'} ),
+            ('jobs',         { 'metavar': 'N', 'type' : int, 'default' : 1, 'help' : 'number of worker processes for --builtin (default 1)'} ),
+            ('cache',        { 'metavar': 'fn', 'help' : 'database of verdicts shared with other projects (not used with --denovo)'} ),
+            ('cache_size',   { 'metavar': 'size', 'default' : '1G', 'help' : 'maximum size of the cache, e.g. 500M or 2G (default 1G)'} ),
+            ('minh',         { 'metavar': 'x', 'type' : float, 'default' : default_params.minh, 'help' : 'minimum score for a chimera with --builtin (default {})'.format(default_params.minh)} ),
+            ('mindiv',       { 'metavar': 'x', 'type' : float, 'default' : default_params.mindiv, 'help' : 'minimum divergence (percent) from the closest parent with --builtin (default {})'.format(default_params.mindiv)} ),
         ]
     )
         
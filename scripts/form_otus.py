@@ -1,7 +1,8 @@
 #! /usr/bin/env python3
 
 # Run usearch to create de novo OTUs.  Each OTU will be represented by the 
-# "seed" sequence used by uclust to as the center of each OTU.
+# "seed" sequence used by uclust to as the center of each OTU.  With --builtin the
+# OTUs are made by a greedy clustering algorithm in this process (see greedy.py).
 
 # John Conery / Kevin Xu Junjie
 # University of Oregon
@@ -15,69 +16,76 @@ import os
 import os.path
 import re
 import sys
+import multiprocessing
+
+from FASTA import FASTAReader
+from greedy import greedy_clusters, map_to_centroids, default_identity
 
 # Define filenames (may be referenced by more than one function)
 
 input_file = 'seeds.fasta'
 cluster_file = 'clusters.fasta'
+uc_file = 'clusters.uc'
 
 ###
 # Print the sequences that will be clustered.  If a prior stage did a map to reference
 # sequences the results will be in a table named 'hits' and we need to merge that table
 # with the unique sequences.  Otherwise just print the unique sequences in order of 
-# decreasing frequency
+# decreasing frequency.  Reference sequences have ':ref' at the end of their names.
     
 find_ref_table = 'SELECT name FROM sqlite_master WHERE type = "table" AND name = "hits"'
 
 def print_sequences(db, args):
-    if db.execute(find_ref_table).fetchall():
-        merge_ref_with_unique(db, args)
-    else:
-        print_unique_sequences(db, args)
+    ff = open(os.path.join(args.workspace, input_file), 'w')
+    for name, n, sequence in input_sequences(db, args):
+        print('>{};size={}'.format(name, n), file=ff)
+        print(sequence, file=ff)
+    ff.close()
         
 # select_unique_sequences = 'SELECT panda_id, n, defline, sequence FROM uniq JOIN panda USING (panda_id)'
 
+# If remove_duplicates.py made the sequences and seq_counts tables the counts are
+# grouped by seq_id, otherwise by the digest and text of the sequence (sorting on the
+# digest first means sequences are only compared when their digests are equal).
+# With seq_counts the representative of a group is the copy with the smallest panda_id.
+
+find_sequence_table = 'SELECT name FROM sqlite_master WHERE type = "table" AND name = "seq_counts"'
+
 def fetch_unique_sequences(db, args):
-    sql = 'SELECT panda_id, sum(n) as count, defline, sequence FROM uniq JOIN panda USING (panda_id)'
-    if not args.singletons:
-        sql += ' WHERE n > 1'
-    sql += ' GROUP by sequence'
+    if db.execute(find_sequence_table).fetchall():
+        sql = 'SELECT seq_id, sum(n) AS count FROM seq_counts'
+        if not args.singletons:
+            sql += ' WHERE n > 1'
+        sql += ' GROUP BY seq_id'
+        sql = 'SELECT sequences.panda_id, count, defline, sequences.sequence, sequences.digest FROM ({}) JOIN sequences USING (seq_id) JOIN panda ON (panda.panda_id = sequences.panda_id)'.format(sql)
+    else:
+        ensure_digest(db, 'panda')
+        sql = 'SELECT panda_id, sum(n) as count, defline, sequence, digest FROM uniq JOIN panda USING (panda_id)'
+        if not args.singletons:
+            sql += ' WHERE n > 1'
+        sql += ' GROUP by digest, sequence'
     sql += ' ORDER by count DESC'
     record_metadata(db, 'query', sql)
     return db.execute(sql)
     
-def print_unique_sequences(db, args):
-    res = fetch_unique_sequences(db, args)
-    ff = open(os.path.join(args.workspace, input_file), 'w')
-    for pid, n, defline, sequence in res:
-        print_one_seq(ff, n, defline, sequence)
-    ff.close()
-
 select_hits = 'SELECT panda_id, identity, match_id, match_chars FROM hits'
 
-def merge_ref_with_unique(db, args):
-    record_metadata(db, 'query', select_hits)
-    
+def input_sequences(db, args, skip=None):
+    "Generate (name, n, sequence) for the sequences to cluster, leaving out sequences with (digest, sequence) pairs in skip (and their reference sequences)"
     hits = { }
-    for pid, pct, match_id, match_chars in db.execute(select_hits):
-        hits[pid] = { 'ident' : pct, 'id' : match_id, 'chars' : match_chars}
-    
-    ff = open(os.path.join(args.workspace, input_file), 'w')
+    if db.execute(find_ref_table).fetchall():
+        record_metadata(db, 'query', select_hits)
+        for pid, pct, match_id, match_chars in db.execute(select_hits):
+            hits[pid] = { 'ident' : pct, 'id' : match_id, 'chars' : match_chars}
     
-    for pid, n, defline, sequence in fetch_unique_sequences(db, args):
+    for pid, n, defline, sequence, digest in fetch_unique_sequences(db, args):
+        if skip is not None and (digest, sequence) in skip:
+            continue
         if pid in hits:
             target = hits[pid]
             if target['ident'] < 100.0:
-                print_one_seq(ff, n, target['id'], re.sub('-','',target['chars']), ref=True)
-        print_one_seq(ff, n, defline, sequence)
-        
-    ff.close()
-
-def print_one_seq(f, n, defline, seq, ref=False):
-    if ref:
-        defline += ':ref'
-    print('>{};size={}'.format(defline,n), file=f)
-    print(seq, file=f)    
+                yield target['id'] + ':ref', n, re.sub('-','',target['chars'])
+        yield defline, n, sequence
     
 ###
 # Run the app.  
@@ -86,55 +94,211 @@ def run_cluster_otus(args):
     cmnd = 'usearch -cluster_otus '
     cmnd += os.path.join(args.workspace, input_file)
     # cmnd += ' -otus ' + os.path.join(args.workspace, otu_file)
-    cmnd += ' -fastaout ' + os.path.join(args.workspace, cluster_file)
+    if args.uc:
+        cmnd += ' -uc ' + os.path.join(args.workspace, uc_file)
+    else:
+        cmnd += ' -fastaout ' + os.path.join(args.workspace, cluster_file)
     print(cmnd)
     record_metadata(db, 'exec', cmnd, commit=True)
     res = os.system(cmnd)
     
 ###
-# Populate the tables by importing the FASTA file produced by uclust.  
+# Populate the tables by importing the FASTA file produced by uclust.  The file is read
+# by a generator that produces one record at a time, and rows are inserted in batches.
+# The deflines have the sequence name followed by key=value pairs, e.g.
+# '>name;size=12;up=member;top=name2;diffsqm=1;dqt=1;dqm=0;'.
+#
+# Members are saved with the digest of their sequence so --incremental can tell which
+# sequences have already been clustered without looking up member names in panda.
+
+insert_cluster = 'INSERT INTO clusters (cluster_id, name, sequence, digest) VALUES (?,?,?,?)'
+insert_member = 'INSERT INTO members (cluster_id, name, diffsqm, dqt, dqm, digest) VALUES (?,?,?,?,?,?)'
 
-insert_cluster = 'INSERT INTO clusters (cluster_id, name, sequence) VALUES (?,?,?)'
-insert_member = 'INSERT INTO members (cluster_id, name, diffsqm, dqt, dqm) VALUES (?,?,?,?,?)'
+import_batch_size = 10000
+
+def cluster_records(fn):
+    "Generate (name, info, sequence) for each sequence in a FASTA file written by usearch"
+    for rec in FASTAReader(fn):
+        name, info = parse_defline(rec.defline()[1:])
+        yield name, info, rec.sequence()
+
+def parse_defline(s):
+    "Split a defline into the sequence name and a dictionary of key=value pairs"
+    parts = s.rstrip(';').split(';')
+    info = { }
+    for x in parts[1:]:
+        k, v = x.split('=', 1)
+        info[k] = v
+    return parts[0], info
+
+def save_rows(db, clusters, members):
+    "Insert a batch of cluster and member rows, clear the batch"
+    db.executemany(insert_cluster, clusters)
+    db.executemany(insert_member, members)
+    del clusters[:]
+    del members[:]
 
 def import_results(db, args):
-    f = open(os.path.join(args.workspace, cluster_file))
-    defline = f.readline()
+    if args.uc:
+        return import_uc(db, args)
     cid = 0
     cmap = { }
-
-    while defline:
-        sequence = ''
-        seqline = f.readline()
-        while seqline:
-            if seqline.startswith('>'):  break
-            sequence += seqline.strip()
-            seqline = f.readline()
-        # m = re.search(r'>(.*);size=(\d+)', defline)
-        # db.execute(insert_otu, (dm[m.group(1)], sequence))
-        d = parse_defline(defline.strip('>;\n'))
-        if d['up'] == 'otu':
-            db.execute(insert_cluster, (cid, d['name'], sequence))
-            cmap[d['name']] = cid
+    clusters = [ ]
+    members = [ ]
+    for name, info, sequence in cluster_records(os.path.join(args.workspace, cluster_file)):
+        if info['up'] == 'otu':
+            clusters.append((cid, name, sequence, sequence_digest(sequence)))
+            cmap[name] = cid
             cid += 1
-        elif d['up'] == 'member' and ':ref' not in d['name']:
-            db.execute(insert_member, (cmap[d['top']], d['name'], d['diffsqm'], d['dqt'], d['dqm']))
-        defline = seqline
+        elif info['up'] == 'member' and ':ref' not in name:
+            members.append((cmap[info['top']], name, info['diffsqm'], info['dqt'], info['dqm'], sequence_digest(sequence)))
+        if len(clusters) + len(members) >= import_batch_size:
+            save_rows(db, clusters, members)
+    save_rows(db, clusters, members)
 
-def parse_defline(s):
-    parts = s.split(';')
-    d = {'name' : parts[0]}                # first item is sequence name, remaining are k=v pairs
-    d.update(dict(map(lambda x: x.split('='), parts[1:])))
-    return d
+###
+# Import the tabular output written by usearch -uc.  'S' lines describe the centroid
+# (seed) of a cluster and 'H' lines describe members; the second column is the cluster
+# number and the ninth is the sequence label.  The .uc file doesn't have sequences, so
+# the centroid sequences are copied from the input file.  The percent identity of a
+# member is saved in the dqt column (the .uc file doesn't have usearch's difference
+# counts).  Member digests are also computed from the input file:  the names and
+# digests are saved in a temporary table and copied to the members table at the end.
+
+member_digest_table = 'CREATE TEMP TABLE IF NOT EXISTS member_digests (name TEXT PRIMARY KEY, digest INTEGER)'
+update_member_digests = 'UPDATE members SET digest = (SELECT digest FROM temp.member_digests WHERE member_digests.name = members.name) WHERE digest IS NULL'
+insert_member_digest = 'INSERT OR IGNORE INTO temp.member_digests (name, digest) VALUES (?,?)'
+
+def uc_records(fn):
+    "Generate the fields of the S and H lines in a .uc file"
+    with open(fn) as f:
+        for line in f:
+            if line[0] in 'SH':
+                yield line.rstrip('\n').split('\t')
+
+def import_uc(db, args):
+    centroids = { }
+    members = [ ]
+    for cols in uc_records(os.path.join(args.workspace, uc_file)):
+        name = cols[8].split(';')[0]
+        if cols[0] == 'S':
+            centroids[name] = int(cols[1])
+        elif ':ref' not in name:
+            members.append((int(cols[1]), name, None, float(cols[3]), None, None))
+            if len(members) >= import_batch_size:
+                save_rows(db, [ ], members)
+    save_rows(db, [ ], members)
+    db.execute(member_digest_table)
+    clusters = [ ]
+    digests = [ ]
+    for name, info, sequence in cluster_records(os.path.join(args.workspace, input_file)):
+        if name in centroids:
+            clusters.append((centroids[name], name, sequence, sequence_digest(sequence)))
+        elif ':ref' not in name:
+            digests.append((name, sequence_digest(sequence)))
+        if len(clusters) + len(digests) >= import_batch_size:
+            save_rows(db, clusters, [ ])
+            db.executemany(insert_member_digest, digests)
+            del digests[:]
+    save_rows(db, clusters, [ ])
+    db.executemany(insert_member_digest, digests)
+    db.execute(update_member_digests)
+    db.execute('DROP TABLE temp.member_digests')
+
+###
+# Built-in clustering (--builtin):  instead of running usearch, cluster the sequences
+# with the greedy algorithm in greedy.py and save the results directly in the clusters
+# and members tables.  As with usearch, clusters are numbered from 0, a centroid is not
+# listed as a member of its own cluster, and reference sequences are not members.
+# diffsqm is the number of differences between a member and its centroid.
+
+def builtin_clusters(db, args):
+    items = list(input_sequences(db, args))
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    clusters = [ ]
+    members = [ ]
+    for (name, n, seq), (cid, diffs) in zip(items, greedy_clusters((x[2] for x in items), args.identity, pool, args.jobs)):
+        if diffs is None:
+            clusters.append((cid, name, seq, sequence_digest(seq)))
+        elif ':ref' not in name:
+            members.append((cid, name, diffs, None, None, sequence_digest(seq)))
+    if pool:
+        pool.close()
+    db.executemany(insert_cluster, clusters)
+    db.executemany(insert_member, members)
+    print('{} sequences, {} clusters'.format(len(items), len(clusters)))
+
+###
+# Incremental clustering (--incremental):  add sequences that are not in the clusters
+# or members tables yet (e.g. from samples added since the last run) without changing
+# the existing clusters.  The new sequences are first compared to the existing
+# centroids, then the ones that don't match are clustered with the greedy algorithm
+# and the new clusters are numbered after the existing ones.  Sequences are matched
+# with the sequences in earlier results using their digests, and the text of the
+# sequences is compared as well so a digest collision can't leave a new sequence out
+# (members don't store their sequence; it comes from panda).  Reference sequences
+# that were members are not saved, so a reference sequence is left out when the
+# sequence it was made for has been clustered (both were in the same earlier run).
+#
+# Members tables made by earlier versions don't have digests (init_table adds the
+# column); ensure_member_digests fills them in once by matching member names with
+# panda deflines.
+
+fetch_clustered = 'SELECT digest, sequence FROM clusters UNION SELECT members.digest, panda.sequence FROM members JOIN panda ON panda.digest = members.digest AND panda.defline = members.name'
+
+def ensure_member_digests(db):
+    "Make sure every member has a digest"
+    if db.execute('SELECT 1 FROM members WHERE digest IS NULL LIMIT 1').fetchone():
+        db.execute(member_digest_table)
+        db.execute('INSERT OR IGNORE INTO temp.member_digests (name, digest) SELECT defline, digest FROM panda WHERE defline IS NOT NULL')
+        record_metadata(db, 'query', update_member_digests)
+        db.execute(update_member_digests)
+        db.execute('DROP TABLE temp.member_digests')
+
+def incremental_clusters(db, args):
+    ensure_digest(db, 'panda')
+    ensure_digest(db, 'clusters')
+    ensure_member_digests(db)
+    clustered = set(db.execute(fetch_clustered))
+    items = list(input_sequences(db, args, clustered))
+    centroids = db.execute('SELECT cluster_id, sequence FROM clusters').fetchall()
+    start = max((cid for cid, seq in centroids), default=-1) + 1
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
     
+    clusters = [ ]
+    members = [ ]
+    leftovers = [ ]
+    for (name, n, seq), (cid, diffs) in zip(items, map_to_centroids((x[2] for x in items), centroids, args.identity, pool, args.jobs)):
+        if cid is None:
+            leftovers.append((name, n, seq))
+        elif ':ref' not in name:
+            members.append((cid, name, diffs, None, None, sequence_digest(seq)))
+    mapped = len(members)
+    for (name, n, seq), (cid, diffs) in zip(leftovers, greedy_clusters((x[2] for x in leftovers), args.identity, pool, args.jobs, start)):
+        if diffs is None:
+            clusters.append((cid, name, seq, sequence_digest(seq)))
+        elif ':ref' not in name:
+            members.append((cid, name, diffs, None, None, sequence_digest(seq)))
+    if pool:
+        pool.close()
+    db.executemany(insert_cluster, clusters)
+    db.executemany(insert_member, members)
+    print('{} new sequences, {} added to existing clusters, {} new clusters'.format(len(items), mapped, len(clusters)))
+
 ###
 # Top level function: initialize the workspace directory, run the app
 
 def form_otus(db, args):
-    init_workspace(args)
-    print_sequences(db, args)
-    run_cluster_otus(args)
-    import_results(db, args)
+    if args.incremental:
+        incremental_clusters(db, args)
+    elif args.builtin:
+        builtin_clusters(db, args)
+    else:
+        init_workspace(args)
+        print_sequences(db, args)
+        run_cluster_otus(args)
+        import_results(db, args)
+    ensure_digest(db, 'clusters')
     
 ###
 # Parse the command line arguments, call the top level function...
@@ -142,10 +306,15 @@ def form_otus(db, args):
 if __name__ == "__main__":
     
     args = init_api(
-        desc = "Run uclust to create de novo OTUs.",
+        desc = "Run uclust (or the built-in greedy clustering algorithm) to create de novo OTUs.",
         specs = [
             ('workspace',    { 'metavar': 'dir', 'help' : 'working directory', 'default' : 'clusters' } ),
             ('singletons',   { 'action': 'store_true', 'help' : 'include singletons (default: disregard singletons)' } ),
+            ('uc',           { 'action': 'store_true', 'help' : 'import the cluster assignments from usearch -uc output' } ),
+            ('builtin',      { 'action': 'store_true', 'help' : 'use the built-in clustering algorithm instead of usearch' } ),
+            ('incremental',  { 'action': 'store_true', 'help' : 'add new sequences to existing clusters (uses the built-in algorithm)' } ),
+            ('identity',     { 'metavar': 'x', 'type' : float, 'default' : default_identity, 'help' : 'minimum identity for cluster members with --builtin (default 0.97)' } ),
+            ('jobs',         { 'metavar': 'N', 'type' : int, 'default' : 1, 'help' : 'number of worker processes with --builtin (default 1)' } ),
         ]
     )
         
@@ -153,10 +322,10 @@ if __name__ == "__main__":
     record_metadata(db, 'start', ' '.join(sys.argv[1:]))
 
     try:
-        cluster_spec = [('name', 'TEXT'), ('sequence', 'TEXT')]
-        init_table(db, 'clusters', 'cluster_id', cluster_spec, args.force)
-        member_spec = [('cluster_id', 'foreign', 'clusters'), ('name', 'TEXT'), ('diffsqm', 'INTEGER'), ('dqt', 'REAL'), ('dqm', 'REAL')]
-        init_table(db, 'members', 'member_id', member_spec, args.force)
+        cluster_spec = [('name', 'TEXT'), ('sequence', 'TEXT'), ('digest', 'INTEGER')]
+        init_table(db, 'clusters', 'cluster_id', cluster_spec, args.force, keep=args.incremental)
+        member_spec = [('cluster_id', 'foreign', 'clusters'), ('name', 'TEXT'), ('diffsqm', 'INTEGER'), ('dqt', 'REAL'), ('dqm', 'REAL'), ('digest', 'INTEGER')]
+        init_table(db, 'members', 'member_id', member_spec, args.force, keep=args.incremental)
     except Exception as err:
         print('Error while initializing output tables:', err)
         argparse.ArgumentParser.exit(1, 'Script aborted')
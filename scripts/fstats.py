@@ -13,6 +13,7 @@
 #
 
 import argparse
+import re
 
 from FASTA import *
 from FASTQ import *
@@ -25,7 +26,7 @@ def init_api():
         description="...",
         epilog="..."
     )
-    parser.add_argument('fn', help='name of sequence file (.fasta or .fastq)')
+    parser.add_argument('fn', help='name of sequence file (.fasta or .fastq, may be compressed)')
     return parser.parse_args()
 
 ###
@@ -34,12 +35,14 @@ def init_api():
 if __name__ == "__main__":
     args = init_api()
     
-    if args.fn.endswith('.fasta'):
+    fn = re.sub(r'\.(gz|bgz|zst)$', '', args.fn)         # compressed files are OK
+    
+    if fn.endswith('.fasta'):
         reader = FASTAReader(args.fn)
-    elif args.fn.endswith('.fastq'):
-        reader = FASTQReader(args.fn)
+    elif fn.endswith('.fastq'):
+        reader = FASTQBlockReader(args.fn)
     else:
-        print('file name must end with .fasta or .fastq')
+        print('file name must end with .fasta or .fastq (optionally followed by .gz, .bgz, or .zst)')
         exit(1)
         
     stats = { 'n' : 0, 'min': 10000, 'max': 0, 'sum' : 0}
@@ -0,0 +1,136 @@
+# Greedy clustering of sequences sorted by abundance
+
+# This is the built-in alternative to usearch -cluster_otus (see form_otus.py --builtin).
+# Sequences are processed in order of decreasing abundance.  Each sequence is compared
+# to the centroids found so far; if the most similar centroid is within the identity
+# threshold the sequence becomes a member of that centroid's cluster, otherwise it
+# becomes a new centroid.
+
+# Centroids are kept in a k-mer index.  A centroid is a candidate for a sequence only if
+# they share enough k-mers to be within the threshold (see align.py), and only the
+# candidates are aligned.  Ties are broken in favor of the older centroid.
+
+# Sequences are handled in batches.  For each batch the main process finds the
+# candidates among the existing centroids and a pool of worker processes aligns the
+# sequences with their candidates.  Then the main process goes through the batch in
+# order, comparing each sequence with centroids created earlier in the same batch, so
+# the clusters are the same as they would be if sequences were handled one at a time.
+
+# Usage:
+#
+#    for c, d in greedy_clusters(seqs, identity, pool):
+#        ...
+#
+# generates one pair for each sequence:  c is the number of the cluster (clusters
+# are numbered from 0, or from the start argument, in the order they are created) and
+# d is the number of differences between the sequence and the centroid, or None if
+# the sequence is the centroid.
+
+# map_to_centroids compares sequences to a fixed set of centroids (e.g. clusters made
+# by an earlier run) without making new clusters.
+
+import collections
+from itertools import islice
+
+from align import kmers, max_diffs, edit_distance
+
+default_identity = 0.97
+kmer_length = 8
+batch_size = 1000
+
+class CentroidIndex:
+
+    def __init__(self, offset=0, k=kmer_length):
+        "Make an empty index; centroids are numbered starting from offset"
+        self._offset = offset
+        self._k = k
+        self._postings = { }
+        self._seqs = [ ]
+
+    def __len__(self):
+        return len(self._seqs)
+
+    def sequence(self, c):
+        "Return the sequence of centroid c"
+        return self._seqs[c - self._offset]
+
+    def add(self, seq):
+        "Add a centroid, return its number"
+        c = self._offset + len(self._seqs)
+        self._seqs.append(seq)
+        for km in kmers(seq, self._k):
+            self._postings.setdefault(km, []).append(c)
+        return c
+
+    def candidates(self, seq, identity):
+        "Return a list of (c, sequence) for the centroids that share enough k-mers with seq"
+        qk = kmers(seq, self._k)
+        counts = collections.Counter()
+        for km in qk:
+            p = self._postings.get(km)
+            if p:
+                counts.update(p)
+        res = [ ]
+        for c, n in counts.items():
+            cseq = self.sequence(c)
+            if n >= len(qk) - self._k * max_diffs(len(seq), len(cseq), identity):
+                res.append((c, cseq))
+        res.sort()
+        return res
+
+def best_centroid(seq, candidates, identity):
+    "Return (c, d, identity) for the candidate closest to seq, or None if none are within the threshold"
+    best = None
+    for c, cseq in candidates:
+        n = max(len(seq), len(cseq))
+        d = edit_distance(seq, cseq, max_diffs(len(seq), len(cseq), identity))
+        if d is not None and (best is None or 1.0 - d / n > best[2]):
+            best = (c, d, 1.0 - d / n)
+    return best
+
+def score_batch(work, identity):
+    "Worker function: find the best candidate for each (sequence, candidates) pair"
+    return [best_centroid(seq, cand, identity) for seq, cand in work]
+
+def score(work, identity, pool, jobs):
+    "Score a batch, using a pool of processes if there is one"
+    if pool is None or jobs < 2:
+        return score_batch(work, identity)
+    size = (len(work) + jobs - 1) // jobs
+    chunks = [(work[i:i+size], identity) for i in range(0, len(work), size)]
+    return [x for res in pool.starmap(score_batch, chunks) for x in res]
+
+def map_to_centroids(seqs, centroids, identity=default_identity, pool=None, jobs=1):
+    "Generate (cluster, differences) for each sequence, using a list of (cluster, sequence) centroids; cluster is None if there is no match"
+    index = CentroidIndex()
+    ids = [ ]
+    for cid, seq in centroids:
+        index.add(seq)
+        ids.append(cid)
+    seqs = iter(seqs)
+    batch = list(islice(seqs, batch_size))
+    while batch:
+        for hit in score([(seq, index.candidates(seq, identity)) for seq in batch], identity, pool, jobs):
+            yield (None, None) if hit is None else (ids[hit[0]], hit[1])
+        batch = list(islice(seqs, batch_size))
+
+def greedy_clusters(seqs, identity=default_identity, pool=None, jobs=1, start=0):
+    "Cluster sequences (sorted by decreasing abundance), generate (cluster, differences) for each one"
+    index = CentroidIndex()
+    seqs = iter(seqs)
+    batch = list(islice(seqs, batch_size))
+    while batch:
+        work = [(seq, index.candidates(seq, identity)) for seq in batch]
+        hits = score(work, identity, pool, jobs)
+        local = CentroidIndex(offset=len(index))
+        for seq, hit in zip(batch, hits):
+            new = best_centroid(seq, local.candidates(seq, identity), identity)
+            if new is not None and (hit is None or new[2] > hit[2]):
+                hit = new
+            if hit is None:
+                yield start + local.add(seq), None
+            else:
+                yield start + hit[0], hit[1]
+        for c in range(len(index), len(index) + len(local)):
+            index.add(local.sequence(c))
+        batch = list(islice(seqs, batch_size))
@@ -73,8 +73,9 @@ def init_api():
 is used the program looks for the pattern in sequence characters, otherwise it looks for the pattern in
 deflines.  Patterns are specified using PERL regular expression syntax.         
 If the inputs are named files the program will infer the sequence type from the filename extension 
-(.fa, .fn, or .fasta for FASTA files, .fastq for FASTQ files).  If the input is coming from stdin the 
-sequence type must be defined with the --fasta or --fastq option.  
+(.fa, .fn, or .fasta for FASTA files, .fastq for FASTQ files).  Compressed files are recognized 
+automatically, and .gz, .bgz, or .zst at the end of a name is ignored.  If the input is coming from 
+stdin the sequence type must be defined with the --fasta or --fastq option.  
 """
 )
     parser.add_argument('pattern', help='pattern to find')
@@ -91,9 +92,18 @@ reader_type = {
     '.fa'    : FASTAReader,
     '.fn'    : FASTAReader,
     '.fasta' : FASTAReader,
-    '.fastq' : FASTQReader,
+    '.fastq' : FASTQBlockReader,
 }
 
+compression_extensions = ['.gz', '.bgz', '.zst']
+
+def file_type(fn):
+    'Return the filename extension that defines the sequence type, skipping compression extensions'
+    base, ext = os.path.splitext(fn)
+    if ext in compression_extensions:
+        ext = os.path.splitext(base)[1]
+    return ext
+
 # The string %s inserted into this pattern will be printed in red (or the terminal's ANSI color #1)
 
 ESC = chr(27)
@@ -110,7 +120,7 @@ def validate(args):
             argparse.ArgumentParser.exit(1, 'specify either --fasta or --fastq when reading from stdin')
     # all file names need to end in a recognized extension
     for fn in args.files:
-        if os.path.splitext(fn)[1] not in reader_type:
+        if file_type(fn) not in reader_type:
             argparse.ArgumentParser.exit(1, 'invalid filename extension: ' + fn)
 
 ###
@@ -146,12 +156,11 @@ if __name__ == "__main__":
     print_to_tty = os.isatty(sys.stdout.fileno())
     
     if len(args.files) == 0:
-        reader = FASTAReader(sys.stdin) if args.fasta else FASTQReader(sys.stdin)
+        reader = FASTAReader(sys.stdin.buffer) if args.fasta else FASTQBlockReader(sys.stdin.buffer)
         scan_file(reader, pattern, print_to_tty, args)
     else:
         for fn in args.files:
-            ext = os.path.splitext(fn)[1]
-            cls = reader_type.get(ext)
+            cls = reader_type.get(file_type(fn))
             scan_file(cls(fn), pattern, print_to_tty, args)
     
 
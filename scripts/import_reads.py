@@ -13,69 +13,254 @@ import sqlite3
 import argparse
 import os.path
 import sys
+import time
+import multiprocessing
+import hashlib
 
 from common import *
 from FASTQ import *
+from readstore import *
 
 ###
-# Read the sequences from a pair of files (R1 and R2) for a specified sample.  Create
-# a FASTQ object for each read, compress it, and insert the compressed form into the 
-# reads table.
+# Read the sequences from a pair of files (R1 and R2) for a specified sample.  The
+# generator named read_batches packs the sequences and returns lists of rows for
+# the reads table; each list has the rows for up to args.batch pairs of reads.  The
+# rows for the two reads in a pair are next to each other, R1 first.
 
-insert_blob = 'INSERT INTO reads (sample_id, read) VALUES (?, ?)'
-insert_blob_and_def = 'INSERT INTO reads (sample_id, read, defline) VALUES (?, ?, ?)'
-    
-def load_sequences(db, fn1, fn2, sid, args):
-    "Load files fn1 and fn2 into the reads table"
-    
-    if not (os.path.exists(fn1) and os.path.exists(fn2)):
-        return
-    
-    file1 = FASTQReader(fn1)
-    file2 = FASTQReader(fn2)
-    count = 0
-    
+def read_batches(fn1, fn2, sid, args):
+    "Generate lists of rows for the reads table from files fn1 and fn2"
+    file1 = FASTQBlockReader(fn1)
+    file2 = FASTQBlockReader(fn2)
     limit = int(args.limit) if args.limit else None
-
-    seq1 = file1.readseq()
-    seq2 = file2.readseq()
+    count = 0
+    seqs = []
     
-    while seq1 is not None and seq2 is not None:
-        for seq in [seq1, seq2]:
-            if args.quality and seq.filtered() == 'Y':
-                blob = None
-            else:
-                seq.pack()
-                blob = seq.blob()
-            if args.deflines:
-                # db.execute(insert_blob_and_def, (sid, blob, seq.unique_defline()))
-                db.execute(insert_blob_and_def, (sid, blob, seq.defline()))
-            else:
-                db.execute(insert_blob, (sid, blob))
+    for seq1, seq2 in zip(file1, file2):
+        seqs.append(seq1)
+        seqs.append(seq2)
         count += 1
         if limit and count >= limit:
             break
-        seq1 = file1.readseq()
-        seq2 = file2.readseq()
-        
+        if len(seqs) >= 2*args.batch:
+            yield make_rows(seqs, sid, args)
+            seqs = []
+    
+    if seqs:
+        yield make_rows(seqs, sid, args)
     file1.close()
     file2.close()
+
+def make_rows(seqs, sid, args):
+    "Pack a list of sequences, return the rows to insert"
+    if args.quality:
+        blobs = iter(view_blobs([x for x in seqs if not x.filtered()]))
+        blobs = [None if x.filtered() else next(blobs) for x in seqs]
+    else:
+        blobs = view_blobs(seqs)
+    if args.deflines:
+        return [(sid, blob, x.unique_id(), x.defline()) for x, blob in zip(seqs, blobs)]
+    else:
+        return [(sid, blob, x.unique_id()) for x, blob in zip(seqs, blobs)]
+
+###
+# Insert the rows for a sample, one batch at a time.  Returns the number of rows.
+#
+# If --store is specified the packed reads are written to a ReadStore (see 
+# readstore.py) and the reads table gets the location of each read in the store 
+# instead of the read itself.
+
+def insert_query(args):
+    "Make the INSERT statement for the columns used in this run"
+    cols = ['sample_id', 'read', 'unique_id']
+    if args.deflines:
+        cols.append('defline')
+    if args.store:
+        cols += ['read_offset', 'read_length']
+    return 'INSERT INTO reads ({}) VALUES ({})'.format(', '.join(cols), ', '.join('?' * len(cols)))
     
+def insert_batches(db, batches, args, store=None):
+    sql = insert_query(args)
+    count = 0
+    for rows in batches:
+        if store:
+            locs = store.append_many([row[1] for row in rows])
+            rows = [row[:1] + (None,) + row[2:] + loc for row, loc in zip(rows, locs)]
+        db.executemany(sql, rows)
+        count += len(rows)
+    return count
+
+def sample_batches(fn1, fn2, sid, args):
+    "Generate the batches of rows for a sample (none if either file is missing)"
+    if os.path.exists(fn1) and os.path.exists(fn2):
+        yield from read_batches(fn1, fn2, sid, args)
+
+def load_sequences(db, fn1, fn2, sid, args):
+    "Load files fn1 and fn2 into the reads table, return the number of reads loaded"
+    return insert_batches(db, sample_batches(fn1, fn2, sid, args), args)
+
 ###
-# The main function -- iterate over the names of the samples, call
-# load_sequences to import the sequences from the FASTQ files.
+# With --jobs N the files are read and packed by a pool of N worker processes.  Each
+# sample has its own bounded queue; the worker for a sample puts batches of rows in
+# the queue and the main process, which is the only process that writes to the 
+# database, takes them out.  The main process empties the queues in the same order 
+# as the sample list, so the reads table ends up with the same rows in the same order
+# as a serial import.  Workers for later samples stop when their queues are full,
+# which limits the amount of memory used for batches waiting to be inserted.
+
+queue_size = 4
+
+def pack_sample(fn1, fn2, sid, args, q):
+    "Worker process: put the batches for one sample in q, followed by None"
+    try:
+        for rows in sample_batches(fn1, fn2, sid, args):
+            q.put(rows)
+        q.put(None)
+    except Exception as err:
+        q.put(Exception('{}: {}'.format(fn1, err)))
+
+def queued_batches(q):
+    "Generate the batches a worker puts in q"
+    rows = q.get()
+    while rows is not None:
+        if isinstance(rows, Exception):
+            raise rows
+        yield rows
+        rows = q.get()
+
+def start_workers(files, args):
+    "Start a worker for each sample, return the list of generators that collect batches from the workers"
+    manager = multiprocessing.Manager()
+    pool = multiprocessing.Pool(args.jobs)
+    res = []
+    for sid, sname, fn1, fn2 in files:
+        q = manager.Queue(queue_size)
+        pool.apply_async(pack_sample, (fn1, fn2, sid, args, q))
+        res.append(queued_batches(q))
+    pool.close()
+    return res
     
-def import_files(db, samples, args):
+###
+# Indexes on the reads table.  With --defer_index the indexes are dropped before 
+# loading any data, so SQLite doesn't have to update them on every insert, and 
+# then created again when all the data has been loaded.
+
+read_indexes = [
+    ('defx', 'CREATE INDEX IF NOT EXISTS defx ON reads (defline)'),
+]
+
+def drop_indexes(db):
+    for name, sql in read_indexes:
+        db.execute('DROP INDEX IF EXISTS {}'.format(name))
+    db.execute('DROP INDEX IF EXISTS reads_uidx')
+
+def create_indexes(db):
+    for name, sql in read_indexes:
+        db.execute(sql)
+    ensure_unique_ids(db, 'reads')
+
+###
+# The imports table is a manifest that records the status of each FASTQ file.  Before
+# loading a sample the script saves a "fingerprint" of each file (size, modification
+# time, and a hash of the first and last megabyte) with status 'partial', and when all
+# the reads are loaded it changes the status to 'complete' and commits the database.
+#
+# If an import is interrupted, run the script again with --resume.  Samples with 
+# complete records for files with the same size and hash are skipped, and samples 
+# that were partially loaded (or whose files have changed) are deleted and loaded 
+# again.  --resume can't be used with '--journal memory' or '--journal off', since then
+# an interrupted import can leave the database corrupted (see common.bulk_load_specs).
+
+manifest_spec = [('sample_id', 'foreign', 'samples'), ('pair_end', 'INTEGER'), ('path', 'TEXT'), ('size', 'INTEGER'), ('mtime', 'REAL'), ('hash', 'TEXT'), ('reads', 'INTEGER'), ('status', 'TEXT')]
+
+fingerprint_bytes = 1024 * 1024
+
+def fingerprint(fn):
+    "Return a tuple with the path, size, modification time, and fast hash of a file"
+    size = os.path.getsize(fn)
+    h = hashlib.blake2b(str(size).encode())
+    with open(fn, 'rb') as f:
+        h.update(f.read(fingerprint_bytes))
+        if size > fingerprint_bytes:
+            f.seek(max(fingerprint_bytes, size - fingerprint_bytes))
+            h.update(f.read())
+    return (os.path.abspath(fn), size, os.path.getmtime(fn), h.hexdigest())
+
+def completed(db, sid, prints):
+    "Return True if the manifest shows the files for this sample were loaded completely"
+    sql = 'SELECT pair_end, size, hash FROM imports WHERE sample_id = ? AND status = "complete"'
+    found = { pe: (size, h) for pe, size, h in db.execute(sql, (sid,)) }
+    return all(found.get(i+1) == (fp[1], fp[3]) for i, fp in enumerate(prints))
+
+def start_manifest(db, sid, prints):
+    "Delete old manifest records for a sample, save new records with status 'partial'"
+    db.execute('DELETE FROM imports WHERE sample_id = ?', (sid,))
+    for i, fp in enumerate(prints):
+        db.execute('INSERT INTO imports (sample_id, pair_end, path, size, mtime, hash, status) VALUES (?,?,?,?,?,?,"partial")', (sid, i+1) + fp)
+    db.commit()
+
+def finish_manifest(db, sid, n):
+    "Mark the files for a sample as complete and save the changes"
+    db.execute('UPDATE imports SET status = "complete", reads = ? WHERE sample_id = ?', (n, sid))
+    db.commit()
+
+def select_files(db, samples, args):
+    "Return a list of samples to load, along with their file names and fingerprints"
+    res = []
     for sid, sname, fastq1, fastq2 in samples:
         fn1 = os.path.join(args.directory, fastq1)
         fn2 = os.path.join(args.directory, fastq2)
-        if not args.noimport:
-            load_sequences(db, fn1, fn2, sid, args)
-            record_metadata(db, 'import', '{}, {}'.format(fn1,fn2))
+        if not (os.path.exists(fn1) and os.path.exists(fn2)):
+            continue
+        prints = [fingerprint(fn1), fingerprint(fn2)]
+        if args.resume:
+            if completed(db, sid, prints):
+                print('{}: already imported'.format(sname))
+                continue
+            db.execute('DELETE FROM reads WHERE sample_id = ?', (sid,))
+        res.append((sid, sname, fn1, fn2, prints))
+    return res
+
+###
+# The main function -- iterate over the names of the samples, insert the batches
+# of sequences from the FASTQ files (made here, or by worker processes if --jobs
+# was specified).
+    
+def import_files(db, samples, args):
+    if args.noimport:
+        return
+        
+    selected = select_files(db, samples, args)
+    files = [x[:4] for x in selected]
+    if args.jobs > 1:
+        sources = start_workers(files, args)
+    else:
+        sources = [sample_batches(fn1, fn2, sid, args) for sid, sname, fn1, fn2 in files]
+        
+    if args.defer_index:
+        drop_indexes(db)
+    
+    store = None
+    if args.store:
+        store = ReadStore(read_store_name(args.dbname), 'a')
+        if db.execute('SELECT count(*) FROM reads').fetchall()[0][0] == 0:
+            store.truncate()
+        
+    for (sid, sname, fn1, fn2, prints), batches in zip(selected, sources):
+        start_manifest(db, sid, prints)
+        t0 = time.time()
+        n = insert_batches(db, batches, args, store)
+        dt = time.time() - t0
+        print('{}: {} reads in {:.1f} sec ({:.0f} reads/sec)'.format(sname, n, dt, n/dt if dt > 0 else 0))
+        record_metadata(db, 'import', '{}, {}'.format(fn1,fn2))
+        if store:
+            store.flush()
+        finish_manifest(db, sid, n)
+        
+    if store:
+        store.close()
 
     # TBD: consider making the index a command line option
-    if not args.noimport:
-        db.execute('CREATE INDEX IF NOT EXISTS defx ON reads (defline)')
+    create_indexes(db)
 
 ###
 # Check the combination of command line options to make sure they're sensible
@@ -84,6 +269,9 @@ def validate_options(args):
     # if we're not loading data the limit, defline, and quality options are superfluous
     if args.noimport and (args.limit or args.deflines or args.quality):
         print('Warning: options ignored: with --noimport the following options are ignored: --limit, --defline, --quality')
+    # resuming only works if an interrupted import leaves the database intact
+    if args.resume and args.journal.lower() in ['memory', 'off']:
+        argparse.ArgumentParser.exit(1, 'Error: --resume needs a journal that survives an interrupted import (use --journal wal or delete)\n')
 
 ###
 # Parse the command line arguments, call the top level function...
@@ -100,16 +288,23 @@ if __name__ == "__main__":
             ('directory',    { 'required' : True, 'metavar': 'dir', 'help' : '(required) name of directory containing FASTQ files' } ),
             ('quality', { 'action': 'store_true', 'help' : "don't import sequences flagged as low quality"} ),
             ('deflines', { 'action': 'store_true', 'help' : 'include deflines with sequences'} ),
-        ]
+            ('batch',    { 'metavar': 'N', 'type': int, 'default': 10000, 'help' : 'number of read pairs inserted with one SQLite call (default 10000)'} ),
+            ('jobs',     { 'metavar': 'N', 'type': int, 'default': 1, 'help' : 'number of worker processes that read and pack FASTQ files (default 1)'} ),
+            ('defer_index', { 'action': 'store_true', 'help' : 'drop indexes on the reads table before loading, rebuild them at the end'} ),
+            ('store',    { 'action': 'store_true', 'help' : 'save packed reads in a file next to the database instead of in the reads table'} ),
+            ('resume',   { 'action': 'store_true', 'help' : 'skip samples imported by an earlier run, reload samples that were partially imported'} ),
+        ] + bulk_load_specs
     )
     
     validate_options(args)
     db = sqlite3.connect(args.dbname)
+    init_bulk_load(db, args)
     record_metadata(db, 'start', ' '.join(sys.argv[1:]))
     
     try:
-        read_spec = [('sample_id', 'foreign', 'samples'), ('read', 'BLOB'),  ('defline', 'TEXT DEFAULT NULL')]
-        init_table(db, 'reads', 'read_id', read_spec, args.force, args.sample)
+        read_spec = [('sample_id', 'foreign', 'samples'), ('read', 'BLOB'), ('unique_id', 'INTEGER'), ('defline', 'TEXT DEFAULT NULL'), ('read_offset', 'INTEGER'), ('read_length', 'INTEGER')]
+        init_table(db, 'reads', 'read_id', read_spec, args.force, args.sample, keep=args.resume)
+        init_table(db, 'imports', 'import_id', manifest_spec, True, args.sample, keep=args.resume)
     except Exception as err:
         print('Error while initializing output table:', err)
         argparse.ArgumentParser.exit(1, 'Script aborted')
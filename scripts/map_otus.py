@@ -6,19 +6,20 @@
 # University of Oregon
 # 2014-06-05
 
-#  **** NOTE ****
-#  This version assumes the unique sequences are still in FASTA files in the working
-#  directory of the remove_duplicates script.  The default directory name is 'uniq'
-#  but an alternative can be specified with --directory.
+#  The unique sequences for each sample are fetched from the uniq and panda tables and
+#  written to a FASTA file in the workspace, so this script works no matter how
+#  remove_duplicates.py found them (the built-in dereplicator doesn't write FASTA
+#  files).  The --directory option is no longer used.
 #
-#  TBD: don't have a default directory; if no directory is specified write the sequences
-#  in the uniq table to the working directory for this script.
-#  ***************
+#  With --single the unique sequences for all samples are written to one FASTA file,
+#  and usearch is run once instead of once per sample, so the OTU index is only built
+#  once.  usearch uses all the cores unless --threads is given.
 
 import sqlite3
 import argparse
 import os
 import os.path
+import re
 import sys
 
 from common import *
@@ -29,6 +30,8 @@ from FASTQ import *
 result_file_pattern = 'readmap.{}.uc'
 input_file_pattern = 'unique.{}.fasta'
 ref_db_file = 'otus.fasta'
+combined_input_file = 'unique.all.fasta'
+combined_result_file = 'readmap.all.uc'
 
 ###
 # Make the reference "database" (FASTA file) from non-chimeric OTU seeds
@@ -48,7 +51,7 @@ def make_reference_db(db, args):
 
 def run_usearch_global(sid, args):
     cmnd = 'usearch -usearch_global '
-    cmnd += os.path.join(args.directory, input_file_pattern.format(sid))
+    cmnd += os.path.join(args.workspace, input_file_pattern.format(sid))
     cmnd += ' -db ' + os.path.join(args.workspace, ref_db_file)
     cmnd += ' -strand plus'
     cmnd += ' -id 0.97'
@@ -57,39 +60,91 @@ def run_usearch_global(sid, args):
     record_metadata(db, 'exec', cmnd, commit=True)
     res = os.system(cmnd)
 
-# Populate the table 
+# Populate the table.  The label for each sequence has the sample ID, the panda_id of
+# the sequence, and the number of times it was found in the sample, e.g.
+# '>S3_1234;size=12;', so the counts can be added up as the .uc file is read.
 
 insert_record = 'INSERT INTO otus (otu_id, sample_id, count) VALUES (?,?,?)'
-fetch_counts = 'SELECT defline, n FROM panda JOIN uniq USING (panda_id) where uniq.sample_id = {}'
+label_pattern = re.compile(r'S(\d+)_\d+;size=(\d+);')
 
-def import_results(db, args, sid):
-    cmap = defline_map(db, sid)            # map deflines to number of times seq found in this sample
+def print_labeled_sequences(ff, rows):
+    "Write (sample_id, panda_id, n, sequence) rows to a FASTA file"
+    for sid, pid, n, sequence in rows:
+        print('>S{}_{};size={};'.format(sid, pid, n), file=ff)
+        print(sequence, file=ff)
+
+def uc_counts(fn):
+    "Return a dictionary with the number of sequences in each (sample_id, otu_id) pair in a .uc file (otu_id 0 means no hit)"
     count = { }
-    for line in open(os.path.join(args.workspace, result_file_pattern.format(sid))):
+    for line in open(fn):
         res = line.split('\t')
+        if res[0] not in 'HN':
+            continue
         otu = res[-1].strip()
         otu_id = 0 if otu == '*' else int(otu.split('_')[-1])
-        defline = FASTQ.parse_defline(res[8])
-        count.setdefault(otu_id, 0)
-        count[otu_id] += cmap[defline]
-    for otu_id in sorted(count.keys()):
-        db.execute(insert_record, (otu_id, sid, count[otu_id]))
-
-def defline_map(db, sid):
-    dm = { }
-    query = fetch_counts.format(sid)
-    for defline, n in db.execute(query):
-        dm[defline] = n
-    return dm
-    
+        m = label_pattern.match(res[8])
+        key = (int(m.group(1)), otu_id)
+        count[key] = count.get(key, 0) + int(m.group(2))
+    return count
+
+def save_counts(db, count):
+    for sid, otu_id in sorted(count.keys()):
+        db.execute(insert_record, (otu_id, sid, count[(sid, otu_id)]))
+
+fetch_sample_unique = 'SELECT uniq.sample_id, panda_id, n, sequence FROM uniq JOIN panda USING (panda_id) WHERE uniq.sample_id = ?'
+
+def print_sample_sequences(db, args, sid):
+    ff = open(os.path.join(args.workspace, input_file_pattern.format(sid)), 'w')
+    print_labeled_sequences(ff, db.execute(fetch_sample_unique, (sid, )))
+    ff.close()
+
+def import_results(db, args, sid):
+    save_counts(db, uc_counts(os.path.join(args.workspace, result_file_pattern.format(sid))))
+
+###
+# Single run for all samples.
+
+fetch_all_unique = 'SELECT uniq.sample_id, panda_id, n, sequence FROM uniq JOIN panda USING (panda_id)'
+
+def print_all_sequences(db, args):
+    sql = fetch_all_unique
+    if args.sample:
+        sql += ' WHERE uniq.sample_id IN ({})'.format(','.join(str(row[0]) for row in sample_list(db, args)))
+    record_metadata(db, 'query', sql)
+    ff = open(os.path.join(args.workspace, combined_input_file), 'w')
+    print_labeled_sequences(ff, db.execute(sql))
+    ff.close()
+
+def run_usearch_combined(args):
+    cmnd = 'usearch -usearch_global '
+    cmnd += os.path.join(args.workspace, combined_input_file)
+    cmnd += ' -db ' + os.path.join(args.workspace, ref_db_file)
+    cmnd += ' -strand plus'
+    cmnd += ' -id 0.97'
+    if args.threads is not None:
+        cmnd += ' -threads {}'.format(args.threads)
+    cmnd += ' -uc ' + os.path.join(args.workspace, combined_result_file)
+    print(cmnd)
+    record_metadata(db, 'exec', cmnd, commit=True)
+    res = os.system(cmnd)
+
+def import_combined_results(db, args):
+    save_counts(db, uc_counts(os.path.join(args.workspace, combined_result_file)))
+
 ###
 # Top level function: initialize the workspace directory, run the app
 
 def map_otus(db, args):
     init_workspace(args)
     make_reference_db(db,args)
+    if args.single:
+        print_all_sequences(db, args)
+        run_usearch_combined(args)
+        import_combined_results(db, args)
+        return
     for row in sample_list(db, args):
         sid = row[0]
+        print_sample_sequences(db, args, sid)
         run_usearch_global(sid, args)
         import_results(db, args, sid)
 
@@ -102,8 +157,10 @@ if __name__ == "__main__":
         desc = "Run usearch to map merged sequences to one of the inferred clusters.",
         specs = [
             ('workspace',    { 'metavar': 'dir', 'help' : 'working directory', 'default' : 'map' } ),
-            ('directory',    { 'metavar': 'dir', 'help' : 'name of directory containing unique sequences', 'default' : 'uniq' } ),
-            ('sample',       { 'metavar': 'id', 'help' : 'process sequences from this sample only'} )
+            ('directory',    { 'metavar': 'dir', 'help' : 'not used (unique sequences are read from the database)' } ),
+            ('sample',       { 'metavar': 'id', 'help' : 'process sequences from this sample only'} ),
+            ('single',       { 'action': 'store_true', 'help' : 'run usearch once for all samples, using sequences from the database'} ),
+            ('threads',      { 'metavar': 'N', 'type' : int, 'help' : 'number of usearch threads with --single (default: all cores)'} ),
         ]
     )
         
@@ -8,6 +8,7 @@
 # 2014-10-30
 
 from common import *
+from FASTQ import FASTQ
 
 import sqlite3
 import argparse
@@ -137,14 +138,15 @@ def run_usearch_local(args):
 insert_hit = 'INSERT INTO {tbl} (panda_id, match_id, identity, query_length, match_pairs, match_start, match_end, match_chars) VALUES (?,?,?,?,?,?,?,?)'.format(tbl = table_name)
 
 def import_results(db, args):
-	dm = defline_map(db)					# maps query IDs (deflines) into panda_ids
+	ensure_unique_ids(db, 'panda')
+	dm = unique_id_map(db)					# maps integer forms of query IDs (deflines) into panda_ids
 	qlx = hit_fields.index('ql')			# where to find query length in output record
 	pairx = hit_fields.index('pairs')		# where to find number of matching columns
 	cutoff = float(args.match)
 	for row in open(os.path.join(args.workspace, output_file)):
 		cols = row.strip().split('\t')
 		if float(cols[pairx]) / float(cols[qlx]) > cutoff:
-			db.execute(insert_hit, tuple([dm[cols[0]]] + cols[1:]))
+			db.execute(insert_hit, tuple([dm[FASTQ.defline_key(cols[0])]] + cols[1:]))
 		# else:
 		# 	print(cols)
 
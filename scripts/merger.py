@@ -0,0 +1,188 @@
+# Merge the two ends of a paired-end read
+
+# This module is a built-in alternative to pandaseq (see assemble_pairs.py --algorithm
+# builtin).  The second read is reverse complemented and then slid along the first
+# read to find the overlap with the best score, where the score of an overlap is the
+# number of matching bases minus a penalty for each mismatch.  Overlaps shorter than
+# minoverlap or with too many mismatches are not considered.  When the second read
+# extends past the start of the first read (the fragment is shorter than the reads)
+# the overhanging parts of both reads are removed.
+
+# Bases in the overlap are combined using posterior probabilities (Edgar & Flyvbjerg,
+# Bioinformatics 2015).  If the two bases agree the error probability of the merged
+# base is p1*p2/3 / (1 - p1 - p2 + 4*p1*p2/3); if they disagree the base with the
+# higher quality is used and its error probability is p1*(1-p2/3) / (p1 + p2 - 4*p1*p2/3)
+# where p1 is the error probability of the chosen base.  The merged quality scores
+# are computed in advance and saved in tables indexed by pairs of quality characters.
+
+# To avoid trying every possible overlap, candidates are found by looking up k-mers
+# from the second read in a table of k-mers in the first read.  An overlap long
+# enough to have an error in every k-mer would be rejected anyway (too many mismatches).
+
+# Mismatches in a candidate overlap are counted several bases at a time:  the two
+# segments are converted to big integers and XORed, the bits of each byte of the
+# result are ORed into the low order bit of the byte, and the number of 1 bits is
+# the number of mismatches.  (NumPy would do the same thing with arrays, but this
+# way the pipeline doesn't need NumPy.)
+
+# Usage:
+#
+#    res = merge_batch(batch1, batch2, minoverlap, minlength, maxee)
+#
+# where batch1 and batch2 are FASTQBatch objects with matching reads from the R1 and
+# R2 files.  If maxee is given, merged sequences with more expected errors (the sum of
+# the error probabilities of the merged quality scores) are discarded.  The result is a list of (unique_id, defline, sequence) tuples for the
+# pairs that were merged, where the defline has the same format as pandaseq output.
+
+import math
+
+from FASTQ import FASTQ
+
+default_minoverlap = 10
+mismatch_penalty = 4            # score of an overlap is matches - penalty * mismatches
+max_mismatch_rate = 0.2         # fraction of the overlap that can be mismatches
+seed_length = 8                 # k-mers used to find candidate overlaps
+seed_step = 4                   # distance between k-mers taken from the second read
+
+phred_offset = 33
+max_quality = 41
+
+complement = bytes.maketrans(b'ACGTN', b'TGCAN')
+
+def reverse_complement(seq):
+    "Return the reverse complement of a sequence (a byte string)"
+    return seq.translate(complement)[::-1]
+
+###
+# Merged quality tables.  Entries are indexed by the ASCII codes of two quality
+# characters; the value is the ASCII code of the merged quality.
+
+def _prob(c):
+    return 10 ** (-max(c - phred_offset, 0) / 10)
+
+def _char(p):
+    return phred_offset + min(max_quality, int(round(-10 * math.log10(p))))
+
+def _match(c1, c2):
+    p1, p2 = _prob(c1), _prob(c2)
+    return _char((p1 * p2 / 3) / (1 - p1 - p2 + 4 * p1 * p2 / 3))
+
+def _mismatch(c1, c2):
+    p1, p2 = _prob(c1), _prob(c2)
+    return _char(p1 * (1 - p2 / 3) / (p1 + p2 - 4 * p1 * p2 / 3))
+
+quality_chars = range(phred_offset, 127)
+
+match_quality = [[_match(c1, c2) if c1 in quality_chars and c2 in quality_chars else 0 for c2 in range(128)] for c1 in range(128)]
+mismatch_quality = [[_mismatch(c1, c2) if c1 in quality_chars and c2 in quality_chars else 0 for c2 in range(128)] for c1 in range(128)]
+error_prob = [_prob(c) for c in range(128)]
+
+###
+# Overlap search
+
+def mismatches(a, b):
+    "Return the number of positions where byte strings a and b (of the same length) differ"
+    x = int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+    x |= x >> 4
+    x |= x >> 2
+    x |= x >> 1
+    return (x & int.from_bytes(b'\x01' * len(a), 'big')).bit_count()
+
+def diagonals(s1, s2, minoverlap):
+    """
+    Return a set of candidate placements of s2 on s1 (k is the offset of s1[0] in s2).  Long
+    overlaps are found from k-mers that occur in both sequences; overlaps too short
+    to be sure of containing a shared k-mer are all included.
+    """
+    first = len(s2) - minoverlap
+    last = minoverlap - len(s1)
+    short = seed_length * 3
+    cand = set(range(first, max(last, len(s2) - short) - 1, -1))
+    cand.update(range(min(first, short - len(s1)), last - 1, -1))
+    pos = { }
+    for i in range(len(s1) - seed_length + 1):
+        pos.setdefault(s1[i:i+seed_length], i)
+    for j in range(0, len(s2) - seed_length + 1, seed_step):
+        i = pos.get(s2[j:j+seed_length])
+        if i is not None and last <= j - i <= first:
+            cand.add(j - i)
+    return cand
+
+def best_overlap(s1, s2, minoverlap):
+    """
+    Find the best place to put s2 (the reverse complement of the second read) on s1.
+    Return a tuple (i, j, n) meaning s1[i:i+n] overlaps s2[j:j+n], or None.
+    """
+    best = None
+    best_score = 0
+    for k in sorted(diagonals(s1, s2, minoverlap), reverse=True):
+        i = max(-k, 0)
+        j = max(k, 0)
+        n = min(len(s1) - i, len(s2) - j)
+        mm = mismatches(s1[i:i+n], s2[j:j+n])
+        score = n - mismatch_penalty * mm
+        if mm <= max_mismatch_rate * n and score > best_score:
+            best = (i, j, n)
+            best_score = score
+    return best
+
+def merge_pair(s1, q1, s2, q2, minoverlap):
+    """
+    Merge two reads (the sequences and qualities are byte strings).  Return the merged
+    sequence and quality strings as byte strings, or None if there is no overlap.
+    """
+    s2 = reverse_complement(s2)
+    q2 = q2[::-1]
+    overlap = best_overlap(s1, s2, minoverlap)
+    if overlap is None:
+        return None
+    i, j, n = overlap
+    seq = bytearray(s1[:i])
+    qual = bytearray(q1[:i])
+    for a, qa, b, qb in zip(s1[i:i+n], q1[i:i+n], s2[j:j+n], q2[j:j+n]):
+        if a == b:
+            seq.append(a)
+            qual.append(match_quality[qa][qb])
+        elif qa >= qb:
+            seq.append(a)
+            qual.append(mismatch_quality[qa][qb])
+        else:
+            seq.append(b)
+            qual.append(mismatch_quality[qb][qa])
+    seq += s2[j+n:]
+    qual += q2[j+n:]
+    return bytes(seq), bytes(qual)
+
+###
+# Merge a batch of pairs.  This is the function called by worker processes.  Merged
+# sequences with an N or shorter than minlength are discarded (pandaseq -N -l), and
+# so are sequences with more than maxee expected errors.
+
+def merged_defline(defline):
+    "Make a pandaseq style defline (read name and index) from a FASTQ defline"
+    parts = defline.split()
+    if len(parts) < 2:
+        return '>' + parts[0][1:]
+    return '>' + parts[0][1:] + ':' + parts[1].split(':')[-1]
+
+def expected_errors(qual):
+    "Return the expected number of errors in a sequence with quality string qual (a byte string)"
+    return sum(error_prob[c] for c in qual)
+
+def merge_batch(batch1, batch2, minoverlap=None, minlength=None, maxee=None):
+    "Merge the pairs in two FASTQBatch objects, return a list of (unique_id, defline, sequence)"
+    minoverlap = minoverlap or default_minoverlap
+    minlength = minlength or 0
+    res = []
+    for d1, s1, q1, s2, q2 in zip(batch1.deflines, batch1.sequences, batch1.qualities, batch2.sequences, batch2.qualities):
+        merged = merge_pair(s1, q1, s2, q2, minoverlap)
+        if merged is None:
+            continue
+        seq, qual = merged
+        if b'N' in seq or len(seq) < minlength:
+            continue
+        if maxee is not None and expected_errors(qual) > maxee:
+            continue
+        defline = merged_defline(d1.decode())
+        res.append((FASTQ.try_defline_id(defline), defline, seq.decode()))
+    return res
@@ -0,0 +1,77 @@
+# Find primer sequences at the start of reads
+
+# A PrimerMatcher is made from a primer sequence that can include IUPAC ambiguity
+# letters (the same letters as gref.iupac_map).  Each letter in the primer is
+# compiled into a 4-bit mask with one bit for each base it matches, and each base in
+# a read is translated into a mask with a single bit (N is translated to 0, so it
+# never matches).  A primer letter matches a base if the AND of their masks is not 0.
+
+# The comparison is done for the whole primer at once:  the masks for the primer and
+# the start of the read are converted to big integers and ANDed, and the bits in each
+# byte of the result are ORed into the low order bit, so the number of 1 bits is the
+# number of matching positions.
+
+# Usage:
+#
+#    m = PrimerMatcher('GTGCCAGCMGCCGCGGTAA', mismatches=2, shift=1)
+#    n = m.match(seq)           # seq is a byte string
+#
+# The return value is the number of bases to remove from the front of the read (the
+# primer plus any bases before it), or None if the primer wasn't found.
+
+iupac_bits = {
+    'A' : 1,
+    'C' : 2,
+    'G' : 4,
+    'T' : 8,
+    'R' : 1 | 4,
+    'Y' : 2 | 8,
+    'S' : 2 | 4,
+    'W' : 1 | 8,
+    'K' : 4 | 8,
+    'M' : 1 | 2,
+    'B' : 2 | 4 | 8,
+    'D' : 1 | 4 | 8,
+    'H' : 1 | 2 | 8,
+    'V' : 1 | 2 | 4,
+    'N' : 1 | 2 | 4 | 8,
+}
+
+base_bits = bytes(iupac_bits[chr(i).upper()] if chr(i).upper() in 'ACGT' else 0 for i in range(256))
+
+class PrimerMatcher:
+
+    def __init__(self, primer, mismatches=0, shift=0):
+        "Make a matcher for a primer, allowing up to 'mismatches' mismatches and 'shift' bases before the primer"
+        self._primer = primer.upper()
+        self._length = len(primer)
+        self._mask = int.from_bytes(bytes(iupac_bits[ch] for ch in self._primer), 'big')
+        self._ones = int.from_bytes(b'\x01' * self._length, 'big')
+        self._mismatches = mismatches
+        self._shift = shift
+
+    def primer(self):
+        return self._primer
+
+    def __len__(self):
+        return self._length
+
+    def mismatches(self, seq, i=0):
+        "Return the number of mismatches when the primer is aligned with seq[i:]"
+        x = int.from_bytes(seq[i:i+self._length].translate(base_bits), 'big') & self._mask
+        x |= x >> 2
+        x |= x >> 1
+        return self._length - (x & self._ones).bit_count()
+
+    def match(self, seq):
+        "Return the number of bases to trim from the start of seq, or None if the primer isn't found"
+        if len(seq) < self._length:
+            return None
+        best = None
+        for i in range(min(self._shift, len(seq) - self._length) + 1):
+            n = self.mismatches(seq, i)
+            if n <= self._mismatches and (best is None or n < best[0]):
+                best = (n, i)
+                if n == 0:
+                    break
+        return best and best[1] + self._length
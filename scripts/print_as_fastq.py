@@ -8,23 +8,58 @@
 
 import sqlite3
 import argparse
+import os
 
 from FASTQ import *
+from readstore import *
 
 # fetch_reads = 'SELECT read_id, read FROM reads'
 fetch_reads = 'SELECT defline, read FROM reads'
+fetch_stored_reads = 'SELECT defline, read, read_offset, read_length FROM reads'
+
+# If the reads were imported with --store the packed reads are in a ReadStore file
+# next to the database; rows with a NULL read and a non-NULL offset refer to that file.
+
+def open_read_store(db, dbname):
+    "Return the ReadStore for the database, or None if the reads are all in the database"
+    cols = [row[1] for row in db.execute('PRAGMA table_info(reads)')]
+    fn = read_store_name(dbname)
+    if 'read_offset' in cols and os.path.exists(fn):
+        return ReadStore(fn)
+    return None
+
+def fetch_blob(row, store):
+    "Return the packed read for a row, either from the row itself or from the read store"
+    if store is None or row[1] is not None or row[2] is None:
+        return row[1]
+    return store.get(row[2], row[3])
     
+# Reads are fetched and uncompressed in batches of this size
+
+batch_size = 10000
+
 def print_sequences(args):
     db = sqlite3.connect(args.dbname)
-    sql = fetch_reads
+    store = open_read_store(db, args.dbname)
+    sql = fetch_stored_reads if store else fetch_reads
     if args.limit is not None:
         sql += ' LIMIT {}'.format(args.limit)
-    for defline, blob in db.execute(sql).fetchall():
-        x = FASTQ(blob)
-        # x._def = "{}".format(rid)
-        x._def = defline 
-        x.unpack()
-        print(x)
+    cursor = db.execute(sql)
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        batch = []
+        for row in rows:
+            defline = row[0]
+            x = FASTQ(fetch_blob(row, store))
+            # x._def = "{}".format(rid)
+            x._def = defline 
+            batch.append(x)
+        unpack_many(batch)
+        for x in batch:
+            print(x)
+        rows = cursor.fetchmany(batch_size)
+    if store:
+        store.close()
     
 ### 
 # Set up command line arguments
@@ -1,6 +1,6 @@
 #! /usr/bin/env python3
 
-# Run usearch -fastq_filter to remove low quality reads
+# Remove low quality reads, using the same expected error filter as usearch -fastq_filter
 
 # John Conery
 # University of Oregon
@@ -10,8 +10,11 @@ from FASTQ import *
 
 import sqlite3
 import argparse
+import collections
+import multiprocessing
 import os
 import os.path
+import re
 import sys
 
 ###
@@ -42,47 +45,76 @@ def fetch_sample_list(db, args):
 	return db.execute(sql).fetchall()
 
 ###
-# Run usearch on two FASTQ files, merge the results into two new files
-
-def filter_pair(args, sid, fn1, fn2):
-	tmp1 = os.path.join(args.workspace, "R1.fastq")
-	tmp2 = os.path.join(args.workspace, "R2.fastq")
+# Expected error filter.  The expected number of errors in a read is the sum of the
+# error probabilities of its bases, where the probability for a base with quality
+# score Q is 10^(-Q/10).  A read passes the filter if its expected number of errors
+# is at most args.ee (the same test as usearch -fastq_filter -fastq_maxee).
+#
+# Reads are filtered in pairs:  both files are read at the same time and a pair is
+# written to the output files only if both reads pass.  Quality strings are sent in
+# batches to a pool of worker processes.  At most 2*jobs batches are waiting to be
+# checked or written at any time, so memory use doesn't depend on the file size.
+#
+# Without NumPy the expected errors are computed with map over a 256-entry table of
+# error probabilities, which does the loop in C.  Translating the quality strings
+# into tables of fixed point digits (bytes.translate, then sum for each digit) gives
+# the same result but was about 1.6 times slower on 150 base reads.
+
+phred_offset = 33
+
+error_prob = [10 ** (-max(i - phred_offset, 0) / 10) for i in range(256)]
+
+def check_batch(quals1, quals2, maxee):
+	"Return a list of flags for a batch of quality string pairs, True if both reads pass"
+	err = error_prob.__getitem__
+	return [sum(map(err, q1)) <= maxee and sum(map(err, q2)) <= maxee for q1, q2 in zip(quals1, quals2)]
+
+def pair_batches(file1, file2, n):
+	"Generate lists of up to n pairs of reads from two FASTQ files"
+	batch = []
+	for pair in zip(file1, file2):
+		batch.append(pair)
+		if len(batch) == n:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+def write_batch(batch, flags, of1, of2):
+	"Write the pairs that pass the filter, return the number of pairs written"
+	passed = [pair for pair, ok in zip(batch, flags.get()) if ok]
+	of1.write(b''.join(bytes(x) for x, y in passed))
+	of2.write(b''.join(bytes(y) for x, y in passed))
+	return len(passed)
+
+def output_name(args, fn):
+	"Output files have the same names as the inputs, without a compression extension"
+	return os.path.join(args.workspace, re.sub(r'\.(gz|bgz|zst)$', '', fn))
+
+def filter_pair(args, sname, fn1, fn2, pool):
+	f1 = FASTQBlockReader(os.path.join(args.directory, fn1))
+	f2 = FASTQBlockReader(os.path.join(args.directory, fn2))
+	of1 = open(output_name(args, fn1), 'wb')
+	of2 = open(output_name(args, fn2), 'wb')
 	
-	if not (run_usearch(fn1, tmp1, args) and run_usearch(fn2, tmp2, args)):
-		print('usearch failed', fn1, fn2)
-		return
+	total = kept = 0
+	window = collections.deque()
+	for batch in pair_batches(f1, f2, args.batch):
+		quals1 = [x.raw()[2] for x, y in batch]
+		quals2 = [y.raw()[2] for x, y in batch]
+		window.append((batch, pool.apply_async(check_batch, (quals1, quals2, args.ee))))
+		total += len(batch)
+		if len(window) >= 2*args.jobs:
+			kept += write_batch(*window.popleft(), of1, of2)
+	while window:
+		kept += write_batch(*window.popleft(), of1, of2)
 		
-	f1 = open(tmp1)
-	d = dict()
-	x = FASTQ.read(f1)
-	while x is not None:
-		d[x.unique_defline()] = x
-		x = FASTQ.read(f1)
-	f1.close()
-	
-	of1 = open(os.path.join(args.workspace, fn1), "w")
-	of2 = open(os.path.join(args.workspace, fn2), "w")
-	
-	f2 = open(tmp2)
-	x = FASTQ.read(f2)
-	while x is not None:
-		if x.unique_defline() in d:
-			print(d[x.unique_defline()], file=of1)
-			print(x, file=of2)
-		x = FASTQ.read(f2)
-	f2.close()
-	of1.close()
-	of2.close()
-
-	
-def run_usearch(infile, outfile, args):
-	infile = os.path.join(args.directory, infile)
-	cmnd = 'usearch -fastq_filter {input} -fastqout {output} -fastq_maxee {ee}'.format(input=infile, output=outfile, ee=args.ee)
-	print(cmnd)
-	db.execute("INSERT INTO log VALUES (DATETIME('NOW'), ?, ?, ?)", (sys.argv[0], 'exec', cmnd))
+	for f in [f1, f2, of1, of2]:
+		f.close()
+	print('{}: {} of {} pairs passed'.format(sname, kept, total))
+	msg = '{}: {} of {} pairs with expected errors <= {}'.format(sname, kept, total, args.ee)
+	db.execute("INSERT INTO log VALUES (DATETIME('NOW'), ?, ?, ?)", (sys.argv[0], 'filter', msg))
 	db.commit()
-	return os.system(cmnd) == 0
-	
 
 ###
 # Import the assembled sequences
@@ -105,24 +137,29 @@ def import_results(db, args, sid):
 
 ###
 # Top level function: initialize the workspace directory, get sample parameters from
-# the database, run usearch for all specified samples
+# the database, filter the FASTQ files for all specified samples
 
 def filter_fastq_files(db, args):
 	init_workspace(args)
+	pool = multiprocessing.Pool(args.jobs)
 	for sid, sname, fn1, fn2 in fetch_sample_list(db, args):
-		filter_pair(args, sid, fn1, fn2)
+		filter_pair(args, sname, fn1, fn2, pool)
+	pool.close()
+	pool.join()
 
 ###
 # Set up command line arguments
 
 def init_api():
 	parser = argparse.ArgumentParser(
-		description="""Run usearch to filter low quality sequences, write new FASTQ files."""
+		description="""Filter low quality sequences, write new FASTQ files."""
 	)
 	parser.add_argument('dbname', help='the name of the SQLite database file')
 	parser.add_argument('-w', '--workspace', help='working directory', default='filtered')
 	parser.add_argument('-d', '--directory', help='directory with input FASTQ files', default='data')
 	parser.add_argument('-e', '--ee', help='max expected error cutoff', type=float, default=0.3)
+	parser.add_argument('-j', '--jobs', help='number of worker processes', type=int, default=1)
+	parser.add_argument('-b', '--batch', help='number of read pairs per batch', type=int, default=10000)
 	parser.add_argument('-s', '--sample', metavar='id', required=False, help='sample to filter')
 	parser.add_argument('-a', '--all', action='store_true', help='filter all samples')
 	return parser.parse_args()
@@ -0,0 +1,87 @@
+# Sidecar file for packed reads
+
+# A ReadStore is an alternative to saving each read as a BLOB in the reads table.
+# The packed reads (see FASTQ.pack) are appended to a binary file next to the
+# project database, and the reads table saves the location (offset and length) of
+# each read in the file instead of the read itself.  This keeps the database file
+# small, and scripts that scan all the reads can access them through a memory map
+# without making a copy of each read.
+
+# The store is append-only.  If the reads for a sample are replaced (e.g. by running
+# import_reads.py with --force and --sample) the old reads stay in the file but are
+# no longer referenced by the database.  When the reads table is emptied the file is
+# truncated.
+
+# Usage:
+#
+#    store = ReadStore(read_store_name(dbname), 'a')      # append new reads
+#    locs = store.append_many(blobs)                      # list of (offset, length)
+#    store.flush()
+#
+#    store = ReadStore(read_store_name(dbname))           # read existing reads
+#    blob = store.get(offset, length)                     # a memoryview of the map
+#    store.close()
+
+import mmap
+import os
+
+def read_store_name(dbname):
+    "Return the name of the read store for a database"
+    return dbname + '.reads'
+
+class ReadStore:
+
+    def __init__(self, fn, mode='r'):
+        "Open the store in file 'fn' to read ('r') or append ('a') reads"
+        self._fn = fn
+        self._map = None
+        self._view = None
+        if mode == 'a':
+            self._file = open(fn, 'ab')
+        else:
+            self._file = open(fn, 'rb')
+            if os.path.getsize(fn) > 0:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+
+    def truncate(self):
+        "Delete all the reads in a store opened for appending"
+        self._file.truncate(0)
+        self._file.seek(0)
+
+    def append_many(self, blobs):
+        "Write a list of blobs (None is allowed), return a list of (offset, length) tuples"
+        offset = self._file.tell()
+        res = []
+        for blob in blobs:
+            if blob is None:
+                res.append((None, None))
+            else:
+                res.append((offset, len(blob)))
+                offset += len(blob)
+        self._file.write(b''.join(x for x in blobs if x is not None))
+        return res
+
+    def flush(self):
+        "Make sure reads written so far are in the file (call before committing the database)"
+        self._file.flush()
+
+    def get(self, offset, length):
+        "Return a read as a memoryview of the memory mapped file"
+        return self._view[offset:offset+length]
+
+    # The map can't be closed while a memoryview returned by get is still in use.  In
+    # that case close drops the store's references to the map and it is closed when
+    # the last view is garbage collected.  Callers that keep reads after closing the
+    # store can use bytes(store.get(...)) to make a copy.
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._view = None
+            self._map = None
+        self._file.close()
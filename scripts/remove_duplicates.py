@@ -1,21 +1,24 @@
 #! /usr/bin/env python3
 
-# Run cd-hit-dup to find unique assembled reads.
+# Find unique assembled reads.
 
 # John Conery / Kevin Xu Junjie
 # University of Oregon
 # 2014-05-07
 
-#  **** NOTE ****
-#  This version assumes assemble_pairs was run with the --noimport flag and that
-#  paired sequences are in the panda directory, not the panda table in the database.
-#  That means this script must be run with --load_seqs so the unique sequences are
-#  loaded into the panda table.
+# The default is to use the built-in dereplicator (see derep.py), which counts exact
+# duplicates in a single pass without writing any intermediate files.  The sequences
+# for a sample come from one of two places:
 #
-#  TBD: make --load_seqs optional.  If not specified, it means the sequences to check
-#  are in the panda table.  Write them in FASTA format in the working directory before
-#  running cd-hit-dup.
-#  ***************
+#  * if assemble_pairs.py imported the sequences they are read from the panda table,
+#    and the uniq table gets the panda_id of the first copy of each sequence
+#
+#  * if assemble_pairs.py was run with --noimport the sequences are read from the
+#    merged FASTA files in the panda directory; use --load_seqs to load the unique
+#    sequences into the panda table
+#
+# With --cdhit the script runs cd-hit-dup on the merged FASTA files instead.  This
+# version of cd-hit-dup processing requires --load_seqs.
 
 import sqlite3
 import argparse
@@ -25,6 +28,8 @@ import sys
 
 from common import *
 from FASTQ import *
+from FASTA import FASTAReader
+from derep import dereplicate, dereplicate_external, parse_size
 
 ###
 # Run cd-hit-dup using options specified on the command line
@@ -51,12 +56,14 @@ def get_cluster(line, file, info):
     line = file.readline()
     seqinfo = line.split()[2]        # next line has defline of first seq in the cluster
     # defline = ':'.join(seqinfo[1:].split(':')[:-1])
-    defline = FASTQ.parse_defline(seqinfo)
+    if seqinfo.endswith('...'):
+        seqinfo = seqinfo[:-3]
+    uid = FASTQ.defline_key(seqinfo)
     count = 0
     while len(line) > 0 and line[0] != '>':
         count += 1
         line = file.readline()
-    info[defline] = count
+    info[uid] = count
     return line
 
 def parse_clusters(args, sid):
@@ -76,16 +83,17 @@ def parse_clusters(args, sid):
 # for a sample, so we need to delete any old sequences for that sample from the
 # panda table.
 
-insert_sequence = 'INSERT INTO panda (sample_id, defline, sequence) VALUES (?, ?, ?)'
+insert_sequence = 'INSERT INTO panda (sample_id, unique_id, defline, sequence, digest) VALUES (?, ?, ?, ?, ?)'
 
 def import_sequences(db, args, sid):
     db.execute('DELETE FROM panda WHERE sample_id = ?', (sid, ))
     file = open(os.path.join(args.workspace, output_file_pattern.format(sid)))
     defline = file.readline()
     while len(defline) > 0:
-        seq = file.readline()
+        seq = file.readline().strip()
+        uid = FASTQ.try_defline_id(defline)
         defline = FASTQ.parse_defline(defline)
-        db.execute(insert_sequence, (sid, defline, seq.strip()))
+        db.execute(insert_sequence, (sid, uid, defline, seq, sequence_digest(seq)))
         defline = file.readline()
 
 ###
@@ -97,22 +105,125 @@ insert_cluster = 'INSERT INTO uniq (panda_id, sample_id, n) VALUES (?, ?, ?)'
 def import_results(db, args, sid):
     if args.load_seqs:
         import_sequences(db, args, sid)
-    defmap = defline_map(db, sid)
+    idmap = unique_id_map(db, sid)
     clusters = parse_clusters(args, sid)
-    for defline, size in clusters.items():
-        db.execute(insert_cluster, (defmap[defline], sid, size))
+    for uid, size in clusters.items():
+        db.execute(insert_cluster, (idmap[uid], sid, size))
 
 ###
-# Top level function: run cd-hit-dup for each set of paired sequences, then save
-# the id of the first sequence in the cluster and the number of sequences in the
-# cluster.
+# Built-in dereplication.  The sequences for a sample are read from the panda table
+# or (with --load_seqs) from the merged FASTA file written by assemble_pairs.py, and
+# the results are saved with one bulk insert for each table.
+#
+# If --max_memory is specified the unique sequences are found with the external memory
+# algorithm in derep.py, which writes temporary files in the workspace so the hash
+# table never uses more than the specified amount of memory.  The results are the
+# same as the in-memory algorithm.
+
+fetch_sequences = 'SELECT panda_id, sequence FROM panda WHERE sample_id = ?'
+
+def fasta_records(args, sid):
+    "Generate (defline, sequence) pairs from the merged FASTA file for a sample"
+    for seq in FASTAReader(os.path.join(args.directory, input_file_pattern.format(sid))):
+        yield seq.defline(), seq.sequence()
+
+def find_unique(args, records):
+    "Return a list of (key, sequence, n) for the unique sequences in records"
+    if args.max_memory:
+        return dereplicate_external(records, parse_size(args.max_memory), args.workspace)
+    return dereplicate(records)
+
+def dereplicate_sample(db, args, sid):
+    if args.load_seqs:
+        db.execute('DELETE FROM panda WHERE sample_id = ?', (sid, ))
+        unique = find_unique(args, fasta_records(args, sid))
+        db.executemany(insert_sequence, ((sid, FASTQ.try_defline_id(d), FASTQ.parse_defline(d), seq, sequence_digest(seq)) for d, seq, n in unique))
+        idmap = unique_id_map(db, sid)
+        db.executemany(insert_cluster, ((idmap[FASTQ.defline_key(d)], sid, n) for d, seq, n in unique))
+    else:
+        unique = find_unique(args, db.execute(fetch_sequences, (sid, )))
+        db.executemany(insert_cluster, ((pid, sid, n) for pid, seq, n in unique))
+    print('sample {}: {} unique sequences'.format(sid, len(unique)))
+    if args.max_memory:
+        unique.close()
+
+###
+# The sequences table has one row for each distinct sequence in the project, found
+# using its digest and text (the digest index isn't unique because two sequences
+# can have the same digest), and seq_counts has the number of copies of each sequence in each
+# sample.  Later stages can use these tables to group sequences by an integer ID
+# instead of comparing sequences.  The tables are updated from the uniq and panda
+# tables after each sample is processed, so they're maintained the same way no
+# matter how the duplicates were found.
+#
+# The representative of a sequence (the panda_id in the sequences table) is the copy
+# with the smallest panda_id in any sample.  When a single sample is processed again
+# (--force with --sample) finish_sequences updates the representatives and removes
+# sequences that are no longer in any sample.
+
+fetch_sample_unique = 'SELECT panda_id, sequence, digest, n FROM uniq JOIN panda USING (panda_id) WHERE uniq.sample_id = ?'
+find_seq = 'SELECT seq_id FROM sequences WHERE digest = ? AND sequence = ?'
+insert_seq = 'INSERT INTO sequences (seq_id, digest, sequence, panda_id) VALUES (?, ?, ?, ?)'
+insert_count = 'INSERT INTO seq_counts (seq_id, sample_id, panda_id, n) VALUES (?, ?, ?, ?)'
+
+def index_sequences(db):
+    "Make sure the sequences table has a digest index (databases made by earlier versions have a unique index)"
+    for row in db.execute('PRAGMA index_list(sequences)').fetchall():
+        if row[1] == 'sequences_digest' and row[2]:
+            db.execute('DROP INDEX sequences_digest')
+    sql = 'CREATE INDEX IF NOT EXISTS sequences_digest ON sequences (digest)'
+    record_metadata(db, 'query', sql)
+    db.execute(sql)
+
+def update_sequences(db, sid):
+    "Add the unique sequences for a sample to the sequences and seq_counts tables"
+    next_id = (db.execute('SELECT max(seq_id) FROM sequences').fetchone()[0] or 0) + 1
+    new = [ ]
+    counts = [ ]
+    for pid, seq, d, n in db.execute(fetch_sample_unique, (sid, )).fetchall():
+        if d is None:
+            d = sequence_digest(seq)
+        row = db.execute(find_seq, (d, seq)).fetchone()
+        if row is None:
+            row = (next_id, )
+            new.append((next_id, d, seq, pid))
+            next_id += 1
+        counts.append((row[0], sid, pid, n))
+    db.executemany(insert_seq, new)
+    db.executemany(insert_count, counts)
+
+sequence_queries = [
+    'DELETE FROM sequences WHERE seq_id NOT IN (SELECT seq_id FROM seq_counts)',
+    'UPDATE sequences SET panda_id = (SELECT min(panda_id) FROM seq_counts WHERE seq_counts.seq_id = sequences.seq_id)',
+    'CREATE INDEX IF NOT EXISTS seq_counts_idx ON seq_counts (seq_id, sample_id)',
+]
+
+def finish_sequences(db, args):
+    for sql in sequence_queries[0 if args.sample else 2:]:
+        record_metadata(db, 'query', sql)
+        db.execute(sql)
+
+###
+# Top level function: find the unique sequences for each sample, then save the id of
+# the first copy of the sequence and the number of copies, and update the project's
+# sequence tables.
 
 def remove_duplicates(db, args):
-    init_workspace(args)
+    if args.cdhit or args.max_memory:
+        init_workspace(args)
+    ensure_digest(db, 'panda')
+    index_sequences(db)
     for row in sample_list(db, args):
         sid = row[0]
-        run_cd_hit_dup(sid, args)
-        import_results(db, args, sid)
+        if args.cdhit:
+            run_cd_hit_dup(sid, args)
+            import_results(db, args, sid)
+        else:
+            dereplicate_sample(db, args, sid)
+        update_sequences(db, sid)
+    finish_sequences(db, args)
+    if args.load_seqs:
+        ensure_unique_ids(db, 'panda')
             
 ###
 # Parse the command line arguments, call the top level function...
@@ -120,17 +231,19 @@ def remove_duplicates(db, args):
 if __name__ == "__main__":
     
     args = init_api(
-        desc = "Run cd-hit-dup to find unique assembled sequences.",
+        desc = "Find unique assembled sequences.",
         specs = [
             ('directory',    { 'metavar': 'dir', 'help' : 'name of directory containing assembled FASTQ files', 'default' : 'panda' } ),
             ('workspace',    { 'metavar': 'dir', 'help' : 'working directory', 'default' : 'uniq' } ),
             ('load_seqs',    { 'action': 'store_true', 'help' : 'load unique sequences into panda table'} ),
             ('sample',       { 'metavar': 'id', 'help' : 'process sequences from this sample only'} ),
+            ('cdhit',        { 'action': 'store_true', 'help' : 'run cd-hit-dup instead of the built-in dereplicator'} ),
+            ('max_memory',   { 'metavar': 'size', 'help' : 'limit the memory used by the built-in dereplicator, e.g. 500M or 8G (uses temporary files in the workspace)'} ),
         ]
     )
     
-    if not args.load_seqs:          # see note at the front of this file
-        print('This version requires --load_seqs (see documentation)')
+    if args.cdhit and not args.load_seqs:          # see note at the front of this file
+        print('cd-hit-dup processing requires --load_seqs (see documentation)')
         argparse.ArgumentParser.exit(1, 'Script aborted')
     
     db = sqlite3.connect(args.dbname)
@@ -139,6 +252,10 @@ if __name__ == "__main__":
     try:
         uniq_spec = [('panda_id', 'foreign', 'panda'), ('sample_id', 'foreign', 'samples'), ('n', 'INTEGER')]
         init_table(db, 'uniq', 'uniq_id', uniq_spec, args.force, args.sample)
+        seq_spec = [('digest', 'INTEGER'), ('sequence', 'TEXT'), ('panda_id', 'INTEGER')]
+        init_table(db, 'sequences', 'seq_id', seq_spec, args.force, keep=args.sample is not None)
+        count_spec = [('sample_id', 'foreign', 'samples'), ('panda_id', 'INTEGER'), ('n', 'INTEGER')]
+        init_table(db, 'seq_counts', 'seq_id', count_spec, args.force, args.sample, has_primary=False)
     except Exception as err:
         print('Error while initializing output table:', err)
         argparse.ArgumentParser.exit(1, 'Script aborted')
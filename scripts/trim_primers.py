@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+
+# Remove primer sequences from the start of paired-end reads.  The forward primer
+# (pair_end 1 in the primers table) is removed from the R1 reads and the reverse primer
+# (pair_end 2) from the R2 reads.  Pairs where either primer isn't found are discarded
+# unless --keep is specified, in which case they are written without trimming.
+
+# The trimmed reads are written to new FASTQ files in the workspace with the same names
+# as the input files, so the next stage can be run with --directory set to the
+# workspace, e.g.
+#
+#    trim_primers.py project.db --mismatches 2
+#    assemble_pairs.py project.db --directory trimmed --noprimers
+#
+# Since the primers are gone pandaseq should not be given the primer sequences, so
+# run assemble_pairs.py with --noprimers.
+
+# The number of reads that had each primer is saved in the primer_hits table.
+
+import sqlite3
+import argparse
+import collections
+import multiprocessing
+import os
+import os.path
+import re
+import sys
+
+from common import *
+from FASTQ import *
+from primers import PrimerMatcher
+
+###
+# Trim a batch of pairs.  This is the function called by worker processes.  The result
+# has one item for each pair, either a tuple with the number of bases to remove from
+# each read or None if a primer was missing.  The second part of the result has the
+# number of R1 and R2 reads that had a primer.
+
+def trim_batch(batch1, batch2, matcher1, matcher2, keep):
+    "Find the primers in two FASTQBatch objects, return the trim positions and hit counts"
+    res = []
+    hits1 = hits2 = 0
+    for s1, s2 in zip(batch1.sequences, batch2.sequences):
+        n1 = matcher1.match(s1)
+        n2 = matcher2.match(s2)
+        hits1 += n1 is not None
+        hits2 += n2 is not None
+        if n1 is not None and n2 is not None:
+            res.append((n1, n2))
+        elif keep:
+            res.append((0, 0))
+        else:
+            res.append(None)
+    return res, (hits1, hits2)
+
+def fastq_bytes(batch, i, n):
+    "Return read i in a batch as a FASTQ record, with n bases removed from the front"
+    return b''.join([batch.deflines[i], b'\n', batch.sequences[i][n:], b'\n+\n', batch.qualities[i][n:], b'\n'])
+
+def write_batch(b1, b2, result, of1, of2):
+    "Write the trimmed pairs, return the number of pairs written and the primer hit counts"
+    trim, hits = result.get()
+    kept = [(i, x) for i, x in enumerate(trim) if x is not None]
+    of1.write(b''.join(fastq_bytes(b1, i, n1) for i, (n1, n2) in kept))
+    of2.write(b''.join(fastq_bytes(b2, i, n2) for i, (n1, n2) in kept))
+    return len(kept), hits
+
+def output_name(args, fn):
+    "Output files have the same names as the inputs, without a compression extension"
+    return os.path.join(args.workspace, re.sub(r'\.(gz|bgz|zst)$', '', fn))
+
+###
+# Trim the reads for one sample.  Batches of pairs are sent to a pool of worker
+# processes; at most 2*jobs batches are waiting to be trimmed or written at any time.
+
+insert_hits = 'INSERT INTO primer_hits (sample_id, pairs, forward, reverse, kept) VALUES (?, ?, ?, ?, ?)'
+
+def trim_sample(db, args, sid, sname, fn1, fn2, matchers, pool):
+    r1 = FASTQBlockReader(os.path.join(args.directory, fn1))
+    r2 = FASTQBlockReader(os.path.join(args.directory, fn2))
+    of1 = open(output_name(args, fn1), 'wb')
+    of2 = open(output_name(args, fn2), 'wb')
+
+    total = kept = forward = reverse = 0
+    window = collections.deque()
+    for b1, b2 in paired_batches(r1, r2):
+        window.append((b1, b2, pool.apply_async(trim_batch, (b1, b2, *matchers, args.keep))))
+        total += len(b1)
+        if len(window) >= 2 * args.jobs:
+            n, (h1, h2) = write_batch(*window.popleft(), of1, of2)
+            kept, forward, reverse = kept + n, forward + h1, reverse + h2
+    while window:
+        n, (h1, h2) = write_batch(*window.popleft(), of1, of2)
+        kept, forward, reverse = kept + n, forward + h1, reverse + h2
+
+    for f in [r1, r2, of1, of2]:
+        f.close()
+    db.execute(insert_hits, (sid, total, forward, reverse, kept))
+    msg = '{}: {} pairs, forward primer in {}, reverse primer in {}, {} pairs written'.format(sname, total, forward, reverse, kept)
+    print(msg)
+    record_metadata(db, 'trim', msg, commit=True)
+
+###
+# Top level function: initialize the workspace directory, compile the primers, trim
+# the reads for all specified samples.
+
+def trim_primers(db, args):
+    primers = fetch_primers(db)
+    if not (1 in primers and 2 in primers):
+        argparse.ArgumentParser.exit(1, 'Error: the primers table needs forward (1) and reverse (2) primers\n')
+    matchers = [PrimerMatcher(primers[i], args.mismatches, args.shift) for i in [1, 2]]
+    init_workspace(args)
+    with multiprocessing.Pool(args.jobs) as pool:
+        for sid, sname, fn1, fn2 in sample_list(db, args):
+            trim_sample(db, args, sid, sname, fn1, fn2, matchers, pool)
+
+###
+# Parse the command line arguments, call the top level function...
+
+if __name__ == "__main__":
+
+    args = init_api(
+        desc = "Remove primer sequences from the start of paired-end reads, write new FASTQ files.",
+        specs = [
+            ('sample',       { 'metavar': 'id', 'help' : 'use data from this sample only' } ),
+            ('directory',    { 'metavar': 'dir', 'help' : 'name of directory containing FASTQ files', 'default' : 'data' } ),
+            ('workspace',    { 'metavar': 'dir', 'help' : 'directory for the trimmed FASTQ files', 'default' : 'trimmed' } ),
+            ('mismatches',   { 'metavar': 'N', 'type' : int, 'default' : 2, 'help' : 'number of mismatches allowed in a primer (default 2)'} ),
+            ('shift',        { 'metavar': 'N', 'type' : int, 'default' : 0, 'help' : 'number of bases allowed before a primer (default 0)'} ),
+            ('keep',         { 'action': 'store_true', 'help' : 'keep pairs without primers (untrimmed)'} ),
+            ('jobs',         { 'metavar': 'N', 'type' : int, 'default' : 1, 'help' : 'number of worker processes (default 1)'} ),
+        ]
+    )
+
+    db = sqlite3.connect(args.dbname)
+    record_metadata(db, 'start', ' '.join(sys.argv[1:]))
+
+    try:
+        hits_spec = [('sample_id', 'foreign', 'samples'), ('pairs', 'INTEGER'), ('forward', 'INTEGER'), ('reverse', 'INTEGER'), ('kept', 'INTEGER')]
+        init_table(db, 'primer_hits', 'hit_id', hits_spec, args.force, args.sample)
+    except Exception as err:
+        print('Error while initializing output table:', err)
+        argparse.ArgumentParser.exit(1, 'Script aborted')
+
+    trim_primers(db, args)
+    record_metadata(db, 'end', '')
+
+    db.commit()
@@ -0,0 +1,14 @@
+# Tests for the modules in the scripts directory.  Run them from the top level
+# directory with
+#
+#    python -m pytest test
+#
+# The scripts directory is added to the module search path so the tests can import
+# the modules the same way the scripts do.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
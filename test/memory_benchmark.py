@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+#
+# Compare the memory used by FASTQ and FASTA objects with the memory used by 
+# CompactFASTQ and CompactFASTA objects.
+#
+# Usage:
+#
+#    memory_benchmark.py [N]
+#
+# The script makes N copies (default 100,000) of each sequence in test.fastq, keeps 
+# them in a dictionary (the way quality_filter.py does), and uses tracemalloc to 
+# measure the amount of memory allocated.  Each class is tested with sequences that
+# are uncompressed, sequences after the defline fields have been extracted, and 
+# compressed sequences.
+
+import os
+import sys
+import tracemalloc
+
+# Use the modules in the scripts directory, not the copy of FASTQ.py in this directory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from FASTQ import FASTQ, CompactFASTQ, FASTQReader
+from FASTA import FASTA, CompactFASTA
+
+def make_sequences(records, n):
+    'Make n distinct 4-line records by changing the x coordinate in each defline'
+    res = []
+    for i in range(n):
+        r = records[i % len(records)]
+        fields = r.split(':')
+        fields[5] = str(i)
+        res.append(':'.join(fields))
+    return res
+
+def measure(make, records, setup=None):
+    'Return the number of bytes allocated to make a dictionary of objects'
+    tracemalloc.start()
+    d = { }
+    for i, r in enumerate(records):
+        x = make(r)
+        if setup:
+            setup(x)
+        d[i] = x
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+def parse_fastq(x):
+    'Set the attributes that were defined by the original FASTQ parse_defline method'
+    fields = x._def.split()
+    x._instrument, x._run_id, x._flowcell_id, x._lane, x._tile, x._x, x._y = fields[0].split(':')
+    x._pair_end, x._filtered, x._control_bits, x._index = fields[1].split(':')
+    x._parsed = True
+
+def print_result(label, base, compact, n):
+    print('{:24s} {:10.1f} {:10.1f} {:8.2f}'.format(label, base/n, compact/n, base/compact))
+    
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.fastq')
+    records = make_sequences([repr(x) for x in FASTQReader(fn)], n)
+    fasta = [tuple(r.split('\n')[:2]) for r in records]
+    
+    print('bytes per sequence         original    compact    ratio')
+    print('------------------         --------    -------    -----')
+    
+    base = measure(FASTQ, records)
+    compact = measure(CompactFASTQ, records)
+    print_result('FASTQ', base, compact, n)
+    
+    base = measure(FASTQ, records, parse_fastq)
+    compact = measure(CompactFASTQ, records, lambda x: x.unique_defline())
+    print_result('FASTQ, defline fields', base, compact, n)
+    
+    base = measure(FASTQ, records, lambda x: x.pack())
+    compact = measure(CompactFASTQ, records, lambda x: x.pack())
+    print_result('FASTQ, packed', base, compact, n)
+    
+    base = measure(lambda r: FASTA(*r), fasta)
+    compact = measure(lambda r: CompactFASTA(*r), fasta)
+    print_result('FASTA', base, compact, n)
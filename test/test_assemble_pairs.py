@@ -0,0 +1,73 @@
+# Tests for streaming import of pandaseq output (assemble_pairs.py --stream)
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from assemble_pairs import stream_results
+
+# A stand-in for pandaseq: writes its process ID to a file, then prints count merged
+# sequences (forever if count is 0) and exits with the given status
+fake_pandaseq = '''
+import os, sys, itertools
+pidfile, count, status = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+open(pidfile, 'w').write(str(os.getpid()))
+for i in (itertools.count() if count == 0 else range(count)):
+    print('>M1:1:FC:1:1101:{}:200:1'.format(i + 1))
+    print('ACGTACGTAC' + 'ACGT'[i % 4])
+    sys.stdout.flush()
+sys.exit(status)
+'''
+
+def make_database():
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE log (time timestamp, script text, event text, message text)')
+    db.execute('CREATE TABLE panda (panda_id INTEGER PRIMARY KEY, sample_id INTEGER, unique_id INTEGER, defline TEXT, sequence TEXT, digest INTEGER)')
+    return db
+
+def command(tmp_path, sid, count, status=0):
+    script = tmp_path / 'pandaseq.py'
+    script.write_text(fake_pandaseq)
+    return '{} {} {} {} {}'.format(sys.executable, script, tmp_path / 'pid.{}'.format(sid), count, status)
+
+def options(tmp_path, **kw):
+    opts = dict(jobs=2, limit=None, keep_merged=False, workspace=str(tmp_path))
+    opts.update(kw)
+    return argparse.Namespace(**opts)
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def test_stream_import(tmp_path):
+    db = make_database()
+    stream_results(db, options(tmp_path, keep_merged=True), [(1, 's1', command(tmp_path, 1, 25)), (2, 's2', command(tmp_path, 2, 7))])
+    counts = db.execute('SELECT sample_id, count(*) FROM panda GROUP BY sample_id').fetchall()
+    assert counts == [(1, 25), (2, 7)]
+    assert db.execute('SELECT defline, sequence FROM panda WHERE sample_id = 2 ORDER BY panda_id').fetchone() == ('1:1101:1:200', 'ACGTACGTACA')
+    assert (tmp_path / 'merged.1.fasta').read_text().count('>') == 25
+
+def test_stream_limit(tmp_path):
+    db = make_database()
+    stream_results(db, options(tmp_path, limit=10), [(1, 's1', command(tmp_path, 1, 0))])
+    assert db.execute('SELECT count(*) FROM panda').fetchone()[0] == 10
+    assert not running(int((tmp_path / 'pid.1').read_text()))
+
+def test_stream_failure(tmp_path, capsys):
+    db = make_database()
+    stream_results(db, options(tmp_path), [(1, 's1', command(tmp_path, 1, 5, 1)), (2, 's2', command(tmp_path, 2, 5))])
+    assert db.execute('SELECT DISTINCT sample_id FROM panda').fetchall() == [(2, )]
+    assert 'pandaseq failed for sample s1' in capsys.readouterr().out
+
+def test_merged_file_error(tmp_path, capsys):
+    # the merged file can't be opened, so pandaseq must not be started
+    db = make_database()
+    stream_results(db, options(tmp_path, keep_merged=True, workspace=str(tmp_path / 'missing')), [(1, 's1', command(tmp_path, 1, 0))])
+    assert 'pandaseq failed for sample s1' in capsys.readouterr().out
+    time.sleep(1.0)
+    assert not (tmp_path / 'pid.1').exists()
@@ -0,0 +1,55 @@
+# Tests for FASTQBlockReader and paired_batches (FASTQ.py)
+
+import io
+import os
+
+from conftest import test_dir
+from FASTQ import FASTQReader, FASTQBlockReader, paired_batches
+
+test_file = os.path.join(test_dir, 'test.fastq')
+
+def expected():
+    return [(s.defline(), s.sequence(), s.quality()) for s in FASTQReader(test_file)]
+
+def as_tuples(views):
+    return [(v.defline(), v.sequence(), v.quality()) for v in views]
+
+def test_same_as_fastq_reader():
+    with FASTQBlockReader(test_file) as r:
+        assert as_tuples(r) == expected()
+
+def test_records_split_across_blocks():
+    for size in [1, 7, 100, 333]:
+        with FASTQBlockReader(test_file, blocksize=size) as r:
+            assert as_tuples(r) == expected()
+
+def test_binary_stream_without_final_newline():
+    data = open(test_file, 'rb').read().rstrip(b'\n')
+    r = FASTQBlockReader(io.BytesIO(data), blocksize=50)
+    assert as_tuples(r) == expected()
+
+def test_skips_lines_before_first_record():
+    data = b'junk line\n' + open(test_file, 'rb').read()
+    r = FASTQBlockReader(io.BytesIO(data))
+    assert as_tuples(r) == expected()
+
+def test_batch_slices():
+    batch = FASTQBlockReader(test_file).readbatch()
+    assert len(batch) == 3
+    assert as_tuples(batch[1:]) == expected()[1:]
+    assert batch[0].fastq().sequence() == expected()[0][1]
+
+def test_paired_batches_line_up():
+    data = open(test_file, 'rb').read()
+    r1 = FASTQBlockReader(io.BytesIO(data), blocksize=300)
+    r2 = FASTQBlockReader(io.BytesIO(data), blocksize=700)
+    pairs = list(paired_batches(r1, r2))
+    assert sum(len(b1) for b1, b2 in pairs) == 3
+    for b1, b2 in pairs:
+        assert b1.deflines == b2.deflines
+
+def test_windows_line_endings():
+    data = open(test_file, 'rb').read().replace(b'\n', b'\r\n')
+    for size in [1, 7, 100, 1 << 20]:
+        r = FASTQBlockReader(io.BytesIO(data), blocksize=size)
+        assert as_tuples(r) == expected()
@@ -0,0 +1,107 @@
+# Tests for the built-in chimera detector (chimera.py)
+
+import random
+
+from chimera import ParentIndex, kmer_codes, diagonal, match_votes, reference_chimeras, denovo_chimeras
+
+def random_sequence(rng, n):
+    return ''.join(rng.choice('ACGT') for _ in range(n))
+
+def mutate(rng, seq, count):
+    seq = list(seq)
+    for i in rng.sample(range(len(seq)), count):
+        seq[i] = rng.choice('ACGT'.replace(seq[i], ''))
+    return ''.join(seq)
+
+def test_kmer_codes():
+    assert kmer_codes('ACGT', 2) == [1, 6, 11]
+    assert kmer_codes('ACNGT', 2) == [1, -1, -1, 11]
+
+def test_diagonal():
+    rng = random.Random(1)
+    p = random_sequence(rng, 200)
+    assert diagonal(kmer_codes(p[30:130]), kmer_codes(p)) == 30
+    assert diagonal(kmer_codes('A' * 20), kmer_codes('C' * 20)) is None
+
+def test_match_votes():
+    rng = random.Random(2)
+    p = random_sequence(rng, 200)
+    assert match_votes(p[20:150], p, 20) == [1] * 130
+    # a deletion and an insertion in the query
+    assert sum(match_votes(p[:50] + p[51:150], p, 0)) == 149
+    assert sum(match_votes(p[:50] + 'A' + p[50:150], p, 0)) == 150
+    # the query runs past the end of the parent
+    votes = match_votes(p[150:] + 'N' * 20, p, 150)
+    assert votes == [1] * 50 + [0] * 20
+
+def test_diagonal_off_parent():
+    rng = random.Random(3)
+    p = random_sequence(rng, 250)
+    q = random_sequence(rng, 250)
+    for d in [-400, -240, -5, 0, 240, 400]:
+        assert len(match_votes(q, p, d)) == len(q)
+
+def make_reference(rng):
+    parents = [random_sequence(rng, 240) for _ in range(4)]
+    index = ParentIndex()
+    for i, seq in enumerate(parents):
+        index.add('p{}'.format(i), seq)
+    return parents, index
+
+def test_reference_chimeras():
+    rng = random.Random(4)
+    parents, index = make_reference(rng)
+    chimera = parents[0][:120] + parents[1][120:]
+    queries = [('chimera', chimera), ('plain', mutate(rng, parents[2], 2))]
+    res = {row[1]: row for row in reference_chimeras(queries, index)}
+    assert res['chimera'][-1] == 'Y'
+    assert {res['chimera'][2], res['chimera'][3]} == {'p0', 'p1'}
+    assert res['plain'][-1] == 'N'
+    assert res['plain'][4] == 'p2'
+
+def test_few_shared_kmers():
+    # unrelated queries that share a few k-mers with the reference at random places
+    # (this used to raise IndexError when the diagonal ran off the parent)
+    rng = random.Random(5)
+    parents, index = make_reference(rng)
+    queries = [ ]
+    for i in range(64):
+        q = random_sequence(rng, 250)
+        p = rng.choice(parents)
+        a = rng.randrange(len(p) - 10)
+        b = rng.randrange(len(q) - 10)
+        queries.append(('q{}'.format(i), q[:b] + p[a:a+10] + q[b+10:]))
+    res = list(reference_chimeras(queries, index))
+    assert len(res) == len(queries)
+    assert all(row[-1] == 'N' for row in res)
+
+def test_denovo_chimeras():
+    rng = random.Random(6)
+    a = random_sequence(rng, 240)
+    b = random_sequence(rng, 240)
+    queries = [('a', a, 100), ('b', b, 80), ('ab', a[:120] + b[120:], 10), ('a1', mutate(rng, a, 2), 5)]
+    res = {row[1]: row[-1] for row in denovo_chimeras(queries)}
+    assert res == {'a': 'N', 'b': 'N', 'ab': 'Y', 'a1': 'N'}
+
+def test_denovo_abskew():
+    # the parents are not abundant enough, so the chimera is checked without them
+    rng = random.Random(7)
+    a = random_sequence(rng, 240)
+    b = random_sequence(rng, 240)
+    queries = [('a', a, 15), ('b', b, 12), ('ab', a[:120] + b[120:], 10)]
+    assert [row[-1] for row in denovo_chimeras(queries)] == ['N', 'N', 'N']
+
+def test_denovo_few_shared_kmers():
+    # unrelated sequences with a few chance k-mer matches (this used to raise IndexError)
+    rng = random.Random(8)
+    pool = [random_sequence(rng, 250) for _ in range(4)]
+    queries = [ ]
+    for i in range(64):
+        q = random_sequence(rng, 250)
+        p = rng.choice(pool + [x[1] for x in queries])
+        a = rng.randrange(len(p) - 10)
+        b = rng.randrange(len(q) - 10)
+        queries.append(('q{}'.format(i), q[:b] + p[a:a+10] + q[b+10:], 1000 - 10 * i))
+    res = list(denovo_chimeras(queries, abskew=1.0))
+    assert len(res) == len(queries)
+    assert all(row[-1] == 'N' for row in res)
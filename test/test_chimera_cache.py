@@ -0,0 +1,89 @@
+# Tests for the chimera verdict cache (chimera_cache.py)
+
+import argparse
+
+import pytest
+
+import chimera
+import chimera_cache
+from chimera_cache import ChimeraCache, file_checksum, settings_digest
+from filter_chimeras import cache_key
+
+def row(name, verdict='N'):
+    return [0.1, name, 'p1', 'p2', 'p1', 99.0, 98.0, 97.0, 96.0, 98.0, 5, 0, 1, 4, 0, 1, 1.0, verdict]
+
+@pytest.fixture
+def cache(tmp_path):
+    c = ChimeraCache(str(tmp_path / 'cache.db'), 1 << 20)
+    yield c
+    c.close()
+
+def test_checksums(tmp_path):
+    fn = tmp_path / 'ref.fasta'
+    fn.write_text('>a\nACGT\n')
+    x = file_checksum(str(fn))
+    fn.write_text('>a\nACGA\n')
+    assert file_checksum(str(fn)) != x
+    assert settings_digest('builtin', 0.28) == settings_digest('builtin', 0.28)
+    assert settings_digest('builtin', 0.28) != settings_digest('builtin', 0.3)
+
+def test_split(cache):
+    key = ('ref', 'params')
+    cache.save(key, [('ACGT', row('old1', 'Y')), ('ACGG', row('old2'))])
+    rows, misses = cache.split(key, [('q1', 'ACGT'), ('q2', 'TTTT'), ('q3', 'ACGG')])
+    # the saved results are returned with the new query names (as strings)
+    assert [(r[1], r[-1]) for r in rows] == [('q1', 'Y'), ('q3', 'N')]
+    assert rows[0][2:5] == ['p1', 'p2', 'p1']
+    assert misses == {'q2': 'TTTT'}
+    # results for other references or settings are not used
+    rows, misses = cache.split(('ref2', 'params'), [('q1', 'ACGT')])
+    assert rows == [ ] and misses == {'q1': 'ACGT'}
+
+def test_digest_collision(cache, monkeypatch):
+    monkeypatch.setattr(chimera_cache, 'sequence_digest', lambda s: 1)
+    key = ('ref', 'params')
+    cache.save(key, [('ACGT', row('old'))])
+    rows, misses = cache.split(key, [('q1', 'ACGG')])
+    assert rows == [ ] and misses == {'q1': 'ACGG'}
+
+def test_large_batches(cache, monkeypatch):
+    monkeypatch.setattr(chimera_cache, 'lookup_batch', 3)
+    key = ('ref', 'params')
+    seqs = ['ACGT' * (i + 1) for i in range(10)]
+    cache.save(key, [(s, row('x')) for s in seqs[::2]])
+    rows, misses = cache.split(key, [('q{}'.format(i), s) for i, s in enumerate(seqs)])
+    assert sorted(r[1] for r in rows) == sorted('q{}'.format(i) for i in range(0, 10, 2))
+    assert sorted(misses) == sorted('q{}'.format(i) for i in range(1, 10, 2))
+
+def test_evict(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(chimera_cache.time, 'time', lambda: now[0])
+    fn = str(tmp_path / 'cache.db')
+    cache = ChimeraCache(fn, 0)
+    key = ('ref', 'params')
+    for i, seq in enumerate(['AAAA', 'CCCC', 'GGGG']):
+        now[0] = 1000.0 + i
+        cache.save(key, [(seq, row('x'))])
+    entry = cache.size() // 3
+    cache.close()
+    # reopen with room for two entries
+    cache = ChimeraCache(fn, 2 * entry)
+    # using the oldest entry makes it the most recent one
+    now[0] = 2000.0
+    cache.split(key, [('q', 'AAAA')])
+    assert cache.evict() == 1
+    rows, misses = cache.split(key, [('a', 'AAAA'), ('c', 'CCCC'), ('g', 'GGGG')])
+    assert misses == {'c': 'CCCC'}
+    assert cache.evict() == 0
+    cache.close()
+
+@pytest.mark.parametrize('name', ['kmer_length', 'band', 'min_overlap', 'min_parent_identity'])
+def test_cache_key_settings(tmp_path, monkeypatch, name):
+    # changing any setting that affects the built-in scores gives a new key
+    fn = tmp_path / 'ref.fasta'
+    fn.write_text('>a\nACGT\n')
+    args = argparse.Namespace(builtin=True, reference=str(fn), minh=0.28, mindiv=0.8)
+    key = cache_key(args)
+    monkeypatch.setattr(chimera, name, getattr(chimera, name) * 2)
+    assert cache_key(args)[0] == key[0]
+    assert cache_key(args)[1] != key[1]
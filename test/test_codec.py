@@ -0,0 +1,48 @@
+# Tests for the pack/unpack codec (FASTQ.py)
+
+import os
+
+import pytest
+
+from conftest import test_dir
+from FASTQ import FASTQ, FASTQReader, encode, decode, encode_many, decode_many, pack_many, unpack_many
+
+records = [str(s) for s in FASTQReader(os.path.join(test_dir, 'test.fastq'))]
+
+def test_round_trip():
+    for r in records:
+        s = FASTQ(r)
+        assert decode(encode(s.sequence(), s.quality())) == (s.sequence(), s.quality())
+
+def test_all_letters_and_qualities():
+    seq = 'ACGTN' * 10
+    qual = ''.join(chr(ord('#') + i) for i in range(50))
+    blob = encode(seq, qual)
+    assert len(blob) == 50
+    assert decode(blob) == (seq, qual)
+    assert encode(seq.encode(), memoryview(qual.encode())) == blob
+
+def test_invalid_input():
+    with pytest.raises(ValueError):
+        encode('ACGX', 'FFFF')
+    with pytest.raises(ValueError):
+        encode('ACGT', 'FF F')
+    with pytest.raises(ValueError):
+        encode('ACGT', 'FFF')
+
+def test_many_same_as_one_at_a_time():
+    seqs = [FASTQ(r) for r in records]
+    blobs = encode_many([s.sequence() for s in seqs], [s.quality() for s in seqs])
+    assert blobs == [encode(s.sequence(), s.quality()) for s in seqs]
+    letters, quals = decode_many(blobs)
+    assert letters == [s.sequence() for s in seqs]
+    assert quals == [s.quality() for s in seqs]
+
+def test_pack_many_unpack_many():
+    seqs = [FASTQ(r) for r in records]
+    singles = [FASTQ(r) for r in records]
+    for s in singles:
+        s.pack()
+    assert pack_many(seqs) == [s.blob() for s in singles]
+    unpack_many(seqs)
+    assert [str(s) for s in seqs] == records
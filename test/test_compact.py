@@ -0,0 +1,44 @@
+# Tests for CompactFASTQ (FASTQ.py) and CompactFASTA (FASTA.py)
+
+import os
+
+from conftest import test_dir
+from FASTQ import FASTQ, CompactFASTQ, FASTQReader
+from FASTA import FASTA, CompactFASTA
+
+records = [str(s) for s in FASTQReader(os.path.join(test_dir, 'test.fastq'))]
+
+def test_getters_match_fastq():
+    for r in records:
+        a = FASTQ(r)
+        b = CompactFASTQ(r)
+        assert (a.defline(), a.sequence(), a.quality()) == (b.defline(), b.sequence(), b.quality())
+        assert a.filtered() == b.filtered()
+        assert repr(a) == repr(b)
+
+def test_fields():
+    b = CompactFASTQ(records[0])
+    assert b.field('lane') == '1'
+    assert b.field('tile') == '11101'
+    assert b.unique_defline() == '1:11101:6946:1002'
+    assert b.unique_id() == FASTQ(records[0]).unique_id()
+
+def test_pack_unpack():
+    for r in records:
+        a = FASTQ(r)
+        b = CompactFASTQ(r)
+        a.pack()
+        b.pack()
+        assert a.blob() == b.blob()
+        assert b.sequence() is None
+        b.unpack()
+        assert b.sequence() == FASTQ(r).sequence()
+        assert b.quality() == FASTQ(r).quality()
+
+def test_compact_fasta():
+    defline = '>NS500451:4:H04JNAFXX:1:11101:6946:1002:TAAGGCGA'
+    a = FASTA(defline, 'ACGT')
+    b = CompactFASTA(defline, 'ACGT')
+    assert (a.defline(), a.sequence(), len(a)) == (b.defline(), b.sequence(), len(b))
+    assert b.unique_defline() == '1:11101:6946:1002'
+    assert b.field('index') == 'TAAGGCGA'
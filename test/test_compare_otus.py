@@ -0,0 +1,29 @@
+# Tests for compare_otus.py
+
+import sqlite3
+
+from compare_otus import make_temp_tables
+
+def make_database(fn, clusters):
+    db = sqlite3.connect(fn)
+    db.execute('CREATE TABLE clusters (cluster_id INTEGER PRIMARY KEY, name TEXT, sequence TEXT)')
+    db.execute('CREATE TABLE taxonomy (otu_id INTEGER, genus_id INTEGER)')
+    db.execute('CREATE TABLE genus (genus_id INTEGER PRIMARY KEY, name TEXT)')
+    db.executemany('INSERT INTO clusters (name, sequence) VALUES (?, ?)', clusters)
+    db.commit()
+    db.close()
+
+def test_read_only_inputs(tmp_path):
+    a = str(tmp_path / 'a.db')
+    b = str(tmp_path / 'b.db')
+    make_database(a, [('a1', 'ACGT'), ('a2', 'ACGG')])
+    make_database(b, [('b1', 'ACGG'), ('b2', 'TTTT')])
+    db = sqlite3.connect(':memory:', uri=True)
+    db.execute("ATTACH DATABASE 'file:{}?mode=ro' AS A".format(a))
+    db.execute("ATTACH DATABASE 'file:{}?mode=ro' AS B".format(b))
+    make_temp_tables(db)
+    assert db.execute('SELECT aname, bname FROM AandB').fetchall() == [('a2', 'b1')]
+    assert db.execute('SELECT aname FROM AnotB').fetchall() == [('a1', )]
+    assert db.execute('SELECT bname FROM BnotA').fetchall() == [('b2', )]
+    cols = [row[1] for row in db.execute('PRAGMA A.table_info(clusters)')]
+    assert 'digest' not in cols
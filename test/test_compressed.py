@@ -0,0 +1,86 @@
+# Tests for open_input (compressed.py)
+
+import gzip
+import struct
+import zlib
+
+import pytest
+
+import compressed
+from compressed import open_input
+
+text = b''.join(b'@read%d\nACGTACGTAC\n+\nFFFFFFFFFF\n' % i for i in range(200))
+
+def write(tmp_path, name, data):
+    fn = tmp_path / name
+    fn.write_bytes(data)
+    return str(fn)
+
+def bgzf_block(data):
+    "Make a BGZF block (a gzip member with a BC field that has the block size)"
+    z = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = z.compress(data) + z.flush()
+    header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+    size = len(header) + 2 + len(cdata) + 8
+    return header + struct.pack('<H', size - 1) + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+def test_plain_file(tmp_path):
+    with open_input(write(tmp_path, 'a.fastq', text)) as f:
+        assert f.read() == text
+
+def test_gzip(tmp_path):
+    with open_input(write(tmp_path, 'a.fastq.gz', gzip.compress(text))) as f:
+        assert f.read() == text
+
+def test_multi_member_gzip(tmp_path):
+    parts = [text[:1000], text[1000:3000], text[3000:]]
+    data = b''.join(gzip.compress(x) for x in parts)
+    with open_input(write(tmp_path, 'cat.fastq.gz', data)) as f:
+        assert f.read() == text
+
+def test_member_ends_on_chunk_boundary(tmp_path, monkeypatch):
+    first = gzip.compress(text[:1001])
+    data = first + gzip.compress(text[1001:1013]) + gzip.compress(text[1013:])
+    monkeypatch.setattr(compressed, 'chunk_size', len(first))
+    with open_input(write(tmp_path, 'cat.fastq.gz', data)) as f:
+        assert f.read() == text
+
+def test_bgzf(tmp_path):
+    data = b''.join(bgzf_block(text[i:i+500]) for i in range(0, len(text), 500)) + bgzf_block(b'')
+    fn = write(tmp_path, 'a.fastq.bgz', data)
+    with open(fn, 'rb') as f:
+        assert compressed.is_bgzf(f.read(18))
+    with open_input(fn, threads=2) as f:
+        assert f.read() == text
+
+def test_corrupt_gzip_raises(tmp_path):
+    data = gzip.compress(text)
+    data = data[:40] + bytes(x ^ 0xff for x in data[40:60]) + data[60:]
+    with pytest.raises(Exception):
+        with open_input(write(tmp_path, 'bad.fastq.gz', data)) as f:
+            f.read()
+
+def test_zstd(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    data = zstandard.ZstdCompressor().compress(text)
+    with open_input(write(tmp_path, 'a.fastq.zst', data)) as f:
+        assert f.read() == text
+
+def test_truncated_gzip_raises(tmp_path):
+    data = gzip.compress(text)
+    with pytest.raises(EOFError):
+        with open_input(write(tmp_path, 'cut.fastq.gz', data[:len(data) // 2])) as f:
+            f.read()
+
+def test_truncated_second_member_raises(tmp_path):
+    data = gzip.compress(text[:1000]) + gzip.compress(text[1000:])[:-20]
+    with pytest.raises(EOFError):
+        with open_input(write(tmp_path, 'cut.fastq.gz', data)) as f:
+            f.read()
+
+def test_zero_padding(tmp_path, monkeypatch):
+    data = gzip.compress(text[:1000]) + bytes(10) + gzip.compress(text[1000:]) + bytes(5000)
+    assert gzip.decompress(data) == text
+    monkeypatch.setattr(compressed, 'chunk_size', 1024)
+    with open_input(write(tmp_path, 'pad.fastq.gz', data)) as f:
+        assert f.read() == text
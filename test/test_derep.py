@@ -0,0 +1,61 @@
+# Tests for the dereplicator (derep.py) and the project sequence tables (remove_duplicates.py)
+
+import random
+import sqlite3
+
+import pytest
+
+import derep
+from derep import dereplicate, dereplicate_external, parse_size
+from remove_duplicates import index_sequences, update_sequences
+
+def random_records(count=2000, distinct=150, seed=1):
+    rng = random.Random(seed)
+    seqs = [''.join(rng.choice('ACGT') for _ in range(rng.randint(20, 60))) for _ in range(distinct)]
+    return [(i, rng.choice(seqs)) for i in range(count)]
+
+def test_dereplicate():
+    res = dereplicate([('a', 'ACGT'), ('b', 'ACGG'), ('c', 'ACGT'), ('d', 'ACGT')])
+    assert res == [('a', 'ACGT', 3), ('b', 'ACGG', 1)]
+
+def test_external_matches_in_memory(tmp_path):
+    records = random_records()
+    expected = dereplicate(records)
+    # a limit this small forces the partitions to be split again
+    res = dereplicate_external(records, 1500, str(tmp_path))
+    assert len(res) == len(expected)
+    assert list(res) == expected
+    res.close()
+
+def test_digest_collisions(tmp_path, monkeypatch):
+    monkeypatch.setattr(derep, 'sequence_digest', lambda s: 42)
+    records = [('a', 'ACGT'), ('b', 'ACGG'), ('c', 'ACGT'), ('d', 'TTTT'), ('e', 'ACGG')]
+    expected = [('a', 'ACGT', 2), ('b', 'ACGG', 2), ('d', 'TTTT', 1)]
+    assert dereplicate(records) == expected
+    res = dereplicate_external(records, 1 << 20, str(tmp_path))
+    assert list(res) == expected
+    res.close()
+
+def test_parse_size():
+    assert parse_size('500') == 500
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5g') == 3 * 1024**3 // 2
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+def test_update_sequences_collisions():
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE log (time timestamp, script text, event text, message text)')
+    db.execute('CREATE TABLE panda (panda_id INTEGER PRIMARY KEY, sample_id INTEGER, sequence TEXT, digest INTEGER)')
+    db.execute('CREATE TABLE uniq (uniq_id INTEGER PRIMARY KEY, panda_id INTEGER, sample_id INTEGER, n INTEGER)')
+    db.execute('CREATE TABLE sequences (seq_id INTEGER PRIMARY KEY, digest INTEGER, sequence TEXT, panda_id INTEGER)')
+    db.execute('CREATE TABLE seq_counts (seq_id INTEGER, sample_id INTEGER, panda_id INTEGER, n INTEGER)')
+    db.execute('CREATE UNIQUE INDEX sequences_digest ON sequences (digest)')
+    # two different sequences with the same digest, both in sample 1 and one in sample 2
+    db.executemany('INSERT INTO panda VALUES (?,?,?,?)', [(1, 1, 'ACGT', 7), (2, 1, 'ACGG', 7), (3, 2, 'ACGG', 7)])
+    db.executemany('INSERT INTO uniq (panda_id, sample_id, n) VALUES (?,?,?)', [(1, 1, 5), (2, 1, 3), (3, 2, 4)])
+    index_sequences(db)
+    update_sequences(db, 1)
+    update_sequences(db, 2)
+    assert db.execute('SELECT seq_id, sequence FROM sequences ORDER BY seq_id').fetchall() == [(1, 'ACGT'), (2, 'ACGG')]
+    assert db.execute('SELECT seq_id, sample_id, n FROM seq_counts ORDER BY sample_id, seq_id').fetchall() == [(1, 1, 5), (2, 1, 3), (2, 2, 4)]
@@ -0,0 +1,126 @@
+# Tests for importing usearch results and incremental clustering in form_otus.py
+
+import argparse
+import os
+import random
+import sqlite3
+
+import pytest
+
+import form_otus
+
+from common import sequence_digest
+from form_otus import incremental_clusters, import_results
+
+def make_database(seqs, hits, members='digest INTEGER'):
+    "Make a workflow database with one sample of (defline, sequence, n) and a hits table"
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE log (time timestamp, script text, event text, message text)')
+    db.execute('CREATE TABLE panda (panda_id INTEGER PRIMARY KEY, sample_id INTEGER, defline TEXT, sequence TEXT, digest INTEGER)')
+    db.execute('CREATE TABLE uniq (uniq_id INTEGER PRIMARY KEY, panda_id INTEGER, sample_id INTEGER, n INTEGER)')
+    db.execute('CREATE TABLE hits (panda_id INTEGER, identity REAL, match_id TEXT, match_chars TEXT)')
+    for defline, seq, n in seqs:
+        pid = db.execute('INSERT INTO panda (sample_id, defline, sequence, digest) VALUES (1, ?, ?, ?)', (defline, seq, sequence_digest(seq))).lastrowid
+        db.execute('INSERT INTO uniq (panda_id, sample_id, n) VALUES (?, 1, ?)', (pid, n))
+    db.executemany('INSERT INTO hits VALUES (?, ?, ?, ?)', hits)
+    db.execute('CREATE TABLE clusters (cluster_id INTEGER PRIMARY KEY, name TEXT, sequence TEXT, digest INTEGER)')
+    db.execute('CREATE TABLE members (member_id INTEGER PRIMARY KEY, cluster_id INTEGER, name TEXT, diffsqm INTEGER, dqt REAL, dqm REAL, {})'.format(members))
+    return db
+
+def random_sequence(rng, n=100):
+    return ''.join(rng.choice('ACGT') for _ in range(n))
+
+args = argparse.Namespace(singletons=True, identity=0.97, jobs=1)
+
+def test_second_run_adds_nothing(capsys):
+    rng = random.Random(1)
+    a = random_sequence(rng)
+    b = random_sequence(rng)
+    ref = a[:50] + 'T' + a[51:] if a[50] != 'T' else a[:50] + 'A' + a[51:]
+    seqs = [('r1', a, 10), ('r2', b, 5), ('r3', a[:-1] + 'N', 3)]
+    # r1 has a reference hit that differs from it at one position, so the reference
+    # sequence ends up as a member of r1's cluster
+    db = make_database(seqs, [(1, 99.0, 'ref1', ref)])
+    incremental_clusters(db, args)
+    assert db.execute('SELECT count(*) FROM clusters').fetchone()[0] == 2
+    assert db.execute('SELECT count(*) FROM members WHERE digest IS NULL').fetchone()[0] == 0
+    capsys.readouterr()
+    incremental_clusters(db, args)
+    assert capsys.readouterr().out.startswith('0 new sequences')
+
+def test_old_members_table():
+    rng = random.Random(2)
+    a = random_sequence(rng)
+    # members made by an earlier version have no digest (init_table adds an empty column)
+    db = make_database([('r1', a, 10), ('r2', a[:-1] + 'N', 3)], [ ])
+    db.execute('INSERT INTO clusters (cluster_id, name, sequence, digest) VALUES (0, ?, ?, ?)', ('r1', a, sequence_digest(a)))
+    db.execute('INSERT INTO members (cluster_id, name, diffsqm) VALUES (0, ?, 1)', ('r2', ))
+    incremental_clusters(db, args)
+    assert db.execute('SELECT name, digest FROM members').fetchall() == [('r2', sequence_digest(a[:-1] + 'N'))]
+    assert db.execute('SELECT count(*) FROM clusters').fetchone()[0] == 1
+
+def test_digest_collision():
+    rng = random.Random(3)
+    a = random_sequence(rng)
+    b = random_sequence(rng)
+    # pretend b has the same digest as a sequence that was clustered in an earlier run
+    db = make_database([('r1', a, 10)], [ ])
+    incremental_clusters(db, args)
+    db.execute('INSERT INTO panda (sample_id, defline, sequence, digest) VALUES (1, ?, ?, ?)', ('r2', b, sequence_digest(a)))
+    db.execute('INSERT INTO uniq (panda_id, sample_id, n) VALUES (last_insert_rowid(), 1, 4)')
+    incremental_clusters(db, args)
+    assert db.execute('SELECT name FROM clusters ORDER BY cluster_id').fetchall() == [('r1', ), ('r2', )]
+
+###
+# The same clustering written by usearch as a FASTA file (-fastaout) and as a .uc file.
+# Cluster 1 has a reference sequence as its centroid, and a reference sequence is a
+# member of cluster 0 (reference members are not saved).
+
+def write_cluster_files(workspace, rng):
+    a, b, c = (random_sequence(rng) for _ in range(3))
+    r3 = a[:-1] + ('A' if a[-1] != 'A' else 'C')
+    seeds = [('r1', 10, a), ('ref1:ref', 10, c), ('r2', 5, c[1:]), ('r3', 3, r3), ('ref2:ref', 2, b), ('r4', 2, b[:-1])]
+    with open(os.path.join(workspace, 'seeds.fasta'), 'w') as f:
+        for name, n, seq in seeds:
+            f.write('>{};size={}\n{}\n'.format(name, n, seq))
+    with open(os.path.join(workspace, 'clusters.fasta'), 'w') as f:
+        f.write('>r1;size=10;up=otu;\n{}\n'.format(a))
+        f.write('>ref1:ref;size=10;up=otu;\n{}\n'.format(c))
+        f.write('>r2;size=5;up=member;top=ref1:ref;diffsqm=1;dqt=1;dqm=0;\n{}\n'.format(c[1:]))
+        f.write('>r3;size=3;up=member;top=r1;diffsqm=1;dqt=1;dqm=0;\n{}\n'.format(r3))
+        f.write('>ref2:ref;size=2;up=member;top=r1;diffsqm=2;dqt=2;dqm=0;\n{}\n'.format(b))
+        f.write('>r4;size=2;up=member;top=r1;diffsqm=2;dqt=2;dqm=0;\n{}\n'.format(b[:-1]))
+    uc = [
+        ['S', '0', '100', '*', '*', '*', '*', '*', 'r1;size=10', '*'],
+        ['S', '1', '100', '*', '*', '*', '*', '*', 'ref1:ref;size=10', '*'],
+        ['H', '1', '99', '99.0', '+', '0', '0', 'D99M', 'r2;size=5', 'ref1:ref;size=10'],
+        ['H', '0', '100', '99.0', '+', '0', '0', '100M', 'r3;size=3', 'r1;size=10'],
+        ['H', '0', '100', '98.0', '+', '0', '0', '100M', 'ref2:ref;size=2', 'r1;size=10'],
+        ['H', '0', '99', '97.5', '+', '0', '0', '99MI', 'r4;size=2', 'r1;size=10'],
+        ['C', '0', '4', '*', '*', '*', '*', '*', 'r1;size=10', '*'],
+        ['C', '1', '2', '*', '*', '*', '*', '*', 'ref1:ref;size=10', '*'],
+    ]
+    with open(os.path.join(workspace, 'clusters.uc'), 'w') as f:
+        for cols in uc:
+            f.write('\t'.join(cols) + '\n')
+
+def imported_rows(workspace, uc):
+    db = make_database([ ], [ ])
+    import_results(db, argparse.Namespace(workspace=workspace, uc=uc))
+    clusters = db.execute('SELECT cluster_id, name, sequence, digest FROM clusters ORDER BY cluster_id').fetchall()
+    members = db.execute('SELECT cluster_id, name, digest FROM members ORDER BY name').fetchall()
+    return db, clusters, members
+
+@pytest.mark.parametrize('batch_size', [10000, 1])
+def test_import_uc(tmp_path, monkeypatch, batch_size):
+    # rows are inserted in batches; a batch size of 1 saves each row on its own
+    monkeypatch.setattr(form_otus, 'import_batch_size', batch_size)
+    write_cluster_files(str(tmp_path), random.Random(4))
+    db, clusters, members = imported_rows(str(tmp_path), False)
+    udb, uclusters, umembers = imported_rows(str(tmp_path), True)
+    assert [x[1] for x in clusters] == ['r1', 'ref1:ref']
+    assert [x[:2] for x in members] == [(1, 'r2'), (0, 'r3'), (0, 'r4')]
+    assert uclusters == clusters
+    assert umembers == members
+    assert None not in [x[2] for x in members]
+    assert udb.execute('SELECT name, dqt FROM members ORDER BY name').fetchall() == [('r2', 99.0), ('r3', 99.0), ('r4', 97.5)]
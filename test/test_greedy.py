@@ -0,0 +1,93 @@
+# Tests for the built-in clustering engine (align.py and greedy.py)
+
+import multiprocessing
+import random
+
+import greedy
+from align import kmers, max_diffs, edit_distance, identity
+from greedy import greedy_clusters, map_to_centroids
+
+def naive_distance(s1, s2):
+    prev = list(range(len(s1) + 1))
+    for j, b in enumerate(s2, 1):
+        cur = [j]
+        for i, a in enumerate(s1, 1):
+            cur.append(min(prev[i] + 1, cur[i-1] + 1, prev[i-1] + (a != b)))
+        prev = cur
+    return prev[-1]
+
+def mutate(rng, seq, count):
+    seq = list(seq)
+    for _ in range(count):
+        i = rng.randrange(len(seq) + 1)
+        op = rng.randrange(3) if i < len(seq) else 2
+        if op == 0:
+            seq[i] = rng.choice('ACGT')
+        elif op == 1:
+            del seq[i]
+        else:
+            seq.insert(i, rng.choice('ACGT'))
+    return ''.join(seq)
+
+def random_sequences(rng, count, parents=5, length=120, diffs=4):
+    roots = [''.join(rng.choice('ACGT') for _ in range(length)) for _ in range(parents)]
+    return [mutate(rng, rng.choice(roots), rng.randint(0, diffs)) for _ in range(count)]
+
+def test_kmers():
+    assert kmers('ACGTA', 3) == {'ACG', 'CGT', 'GTA'}
+    assert kmers('AC', 3) == set()
+
+def test_edit_distance():
+    rng = random.Random(1)
+    for _ in range(200):
+        s1 = ''.join(rng.choice('ACGT') for _ in range(rng.randint(0, 80)))
+        s2 = mutate(rng, s1, rng.randint(0, 10))
+        d = naive_distance(s1, s2)
+        assert edit_distance(s1, s2) == d
+        assert edit_distance(s1, s2, d) == d
+        if d > 0:
+            assert edit_distance(s1, s2, d - 1) is None
+
+def test_identity():
+    assert identity('ACGTACGTAC', 'ACGTACGTAC') == 1.0
+    assert identity('ACGTACGTAC', 'ACGTACGTAA') == 0.9
+    assert identity('ACGTACGTAC', 'TTTTTTTTTT', 2) is None
+    assert max_diffs(100, 98, 0.97) == 3
+
+def naive_greedy(seqs, threshold):
+    "Compare each sequence with every centroid (edit_distance is checked against naive_distance above)"
+    centroids = [ ]
+    res = [ ]
+    for seq in seqs:
+        best = None
+        for c, cseq in enumerate(centroids):
+            n = max(len(seq), len(cseq))
+            d = edit_distance(seq, cseq)
+            if d <= max_diffs(len(seq), len(cseq), threshold) and (best is None or 1.0 - d / n > 1.0 - best[1] / max(len(seq), len(centroids[best[0]]))):
+                best = (c, d)
+        if best is None:
+            res.append((len(centroids), None))
+            centroids.append(seq)
+        else:
+            res.append(best)
+    return res
+
+def test_greedy_matches_naive(monkeypatch):
+    # small batches so centroids are found both in the index and in the current batch
+    monkeypatch.setattr(greedy, 'batch_size', 7)
+    seqs = random_sequences(random.Random(2), 60)
+    assert list(greedy_clusters(seqs, 0.97)) == naive_greedy(seqs, 0.97)
+
+def test_greedy_with_pool():
+    seqs = random_sequences(random.Random(3), 40)
+    with multiprocessing.Pool(2) as pool:
+        res = list(greedy_clusters(seqs, 0.97, pool, 2, start=10))
+    assert res == [(c + 10, d) for c, d in naive_greedy(seqs, 0.97)]
+
+def test_map_to_centroids():
+    rng = random.Random(4)
+    a = ''.join(rng.choice('ACGT') for _ in range(100))
+    b = ''.join(rng.choice('ACGT') for _ in range(100))
+    seqs = [mutate(rng, a, 0), b[:50] + a[50:], b[:99] + 'N']
+    res = list(map_to_centroids(seqs, [(7, a), (9, b)]))
+    assert res == [(7, 0), (None, None), (9, 1)]
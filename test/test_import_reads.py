@@ -0,0 +1,103 @@
+# Tests for import_reads.py
+
+import argparse
+import os
+import sqlite3
+
+import pytest
+
+import import_reads
+from conftest import test_dir
+from FASTQ import FASTQView, FASTQ
+from import_reads import make_rows, import_files, manifest_spec, validate_options
+from common import init_table
+
+good = FASTQView(b'@M1:1:FC:1:1101:100:200 1:N:0:1', b'ACGTACGT', b'FFFFFFFF')
+bad = FASTQView(b'@M1:1:FC:1:1101:100:201 1:Y:0:1', b'ACGTACGT', b'FFFFFFFF')
+
+def options(**kw):
+    opts = dict(quality=False, deflines=False, noimport=False, limit=None, batch=2, jobs=1, defer_index=False, store=False, resume=False, dbname=None)
+    opts.update(kw)
+    return argparse.Namespace(**opts)
+
+def test_make_rows():
+    rows = make_rows([good, bad], 3, options(deflines=True))
+    assert [row[0] for row in rows] == [3, 3]
+    assert all(row[1] is not None for row in rows)
+    assert rows[0][2] == FASTQ.defline_id(good.defline())
+    assert rows[1][3] == bad.defline()
+
+def test_quality_option():
+    # reads flagged by the instrument (':Y:') are saved without the sequence
+    rows = make_rows([good, bad, good], 1, options(quality=True))
+    assert [row[1] is None for row in rows] == [False, True, False]
+    assert rows[0][1] == make_rows([good], 1, options())[0][1]
+
+def make_project(tmp_path, count=3):
+    "Make a database with count samples, each with a pair of FASTQ files made from test.fastq"
+    tmp_path.mkdir(exist_ok=True)
+    records = open(os.path.join(test_dir, 'test.fastq')).read()
+    db = sqlite3.connect(str(tmp_path / 'project.db'))
+    db.execute('CREATE TABLE log (time timestamp, script text, event text, message text)')
+    db.execute('CREATE TABLE samples (sample_id INTEGER PRIMARY KEY, name TEXT, r1_file TEXT, r2_file TEXT)')
+    for i in range(1, count + 1):
+        for r in [1, 2]:
+            # give each sample different reads by changing the y coordinate
+            (tmp_path / 's{}_R{}.fastq'.format(i, r)).write_text(records.replace(':10', ':{}0'.format(i)) * i)
+        db.execute('INSERT INTO samples VALUES (?, ?, ?, ?)', (i, 's{}'.format(i), 's{}_R1.fastq'.format(i), 's{}_R2.fastq'.format(i)))
+    read_spec = [('sample_id', 'foreign', 'samples'), ('read', 'BLOB'), ('unique_id', 'INTEGER'), ('defline', 'TEXT DEFAULT NULL'), ('read_offset', 'INTEGER'), ('read_length', 'INTEGER')]
+    init_table(db, 'reads', 'read_id', read_spec, False)
+    init_table(db, 'imports', 'import_id', manifest_spec, False)
+    db.commit()
+    return db
+
+def samples(db):
+    return db.execute('SELECT sample_id, name, r1_file, r2_file FROM samples').fetchall()
+
+def reads(db):
+    return db.execute('SELECT read_id, sample_id, read, unique_id FROM reads ORDER BY read_id').fetchall()
+
+def test_worker_processes(tmp_path):
+    serial = make_project(tmp_path / 'a')
+    parallel = make_project(tmp_path / 'b')
+    import_files(serial, samples(serial), options(directory=str(tmp_path / 'a')))
+    import_files(parallel, samples(parallel), options(directory=str(tmp_path / 'b'), jobs=2))
+    assert len(reads(serial)) == 2 * 3 * (1 + 2 + 3)
+    assert reads(parallel) == reads(serial)
+
+def test_resume_after_interrupted_import(tmp_path, monkeypatch):
+    db = make_project(tmp_path)
+    expected = make_project(tmp_path / 'full')
+    import_files(expected, samples(expected), options(directory=str(tmp_path / 'full')))
+    # kill the import in the middle of the second sample
+    real_insert = import_reads.insert_batches
+    def interrupted(db, batches, args, store=None):
+        if db.execute('SELECT count(DISTINCT sample_id) FROM imports WHERE status = "complete"').fetchone()[0] == 1:
+            # worst case: some of the rows for the sample were saved
+            db.executemany(import_reads.insert_query(args), next(iter(batches)))
+            db.commit()
+            raise KeyboardInterrupt
+        return real_insert(db, batches, args, store)
+    monkeypatch.setattr(import_reads, 'insert_batches', interrupted)
+    try:
+        import_files(db, samples(db), options(directory=str(tmp_path)))
+    except KeyboardInterrupt:
+        pass
+    db.close()
+    monkeypatch.setattr(import_reads, 'insert_batches', real_insert)
+
+    db = sqlite3.connect(str(tmp_path / 'project.db'))
+    assert db.execute('SELECT DISTINCT sample_id, status FROM imports ORDER BY sample_id').fetchall() == [(1, 'complete'), (2, 'partial')]
+    args = options(directory=str(tmp_path), resume=True)
+    selected = import_reads.select_files(db, samples(db), args)
+    assert [x[0] for x in selected] == [2, 3]
+    assert import_reads.completed(db, 1, selected[0][4]) is False
+    import_files(db, samples(db), args)
+    rows = lambda d: d.execute('SELECT sample_id, read, unique_id FROM reads ORDER BY sample_id, read_id').fetchall()
+    assert rows(db) == rows(expected)
+    assert [x[0] for x in import_reads.select_files(db, samples(db), args)] == [ ]
+
+def test_resume_needs_safe_journal():
+    with pytest.raises(SystemExit):
+        validate_options(options(resume=True, journal='memory'))
+    validate_options(options(resume=True, journal='wal'))
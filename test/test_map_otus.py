@@ -0,0 +1,63 @@
+# Tests for the parts of map_otus.py that don't run usearch
+
+import argparse
+import os
+import sqlite3
+
+import map_otus
+
+def make_database():
+    "Make a workflow database with two samples that share one unique sequence"
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE panda (panda_id INTEGER PRIMARY KEY, sample_id INTEGER, unique_id TEXT, defline TEXT, sequence TEXT)')
+    db.execute('CREATE TABLE uniq (panda_id INTEGER, sample_id INTEGER, n INTEGER)')
+    db.execute('CREATE TABLE otus (otu_id INTEGER, sample_id INTEGER, count INTEGER)')
+    db.execute('CREATE TABLE log (time timestamp, script text, event text, message text)')
+    rows = [(1, 'ACGTACGT', 10), (1, 'TTTTGGGG', 3), (1, 'CCCCAAAA', 1), (2, 'ACGTACGT', 7)]
+    for sid, seq, n in rows:
+        pid = db.execute('INSERT INTO panda (sample_id, defline, sequence) VALUES (?, ?, ?)', (sid, 'r{}'.format(n), seq)).lastrowid
+        db.execute('INSERT INTO uniq VALUES (?, ?, ?)', (pid, sid, n))
+    return db
+
+def uc_line(rec, label, target):
+    return '\t'.join([rec, '0', '8', '100.0', '+', '0', '0', '8M', label, target]) + '\n'
+
+def test_sample_sequences_from_database(tmp_path):
+    # the built-in dereplicator only fills the uniq table, so the per-sample input
+    # file has to come from the database
+    db = make_database()
+    args = argparse.Namespace(workspace=str(tmp_path))
+    map_otus.print_sample_sequences(db, args, 1)
+    lines = open(os.path.join(args.workspace, 'unique.1.fasta')).read().split('\n')
+    assert lines == ['>S1_1;size=10;', 'ACGTACGT', '>S1_2;size=3;', 'TTTTGGGG', '>S1_3;size=1;', 'CCCCAAAA', '']
+
+    with open(os.path.join(args.workspace, 'readmap.1.uc'), 'w') as f:
+        f.write(uc_line('H', 'S1_1;size=10;', 'OTU_4'))
+        f.write(uc_line('H', 'S1_2;size=3;', 'OTU_4'))
+        f.write(uc_line('N', 'S1_3;size=1;', '*'))
+    map_otus.import_results(db, args, 1)
+    assert db.execute('SELECT otu_id, sample_id, count FROM otus').fetchall() == [(0, 1, 1), (4, 1, 13)]
+
+def test_combined_run(tmp_path, monkeypatch):
+    # --single: one input file for all samples, one usearch run, and the counts in the
+    # .uc file are added up by sample and OTU
+    db = make_database()
+    args = argparse.Namespace(workspace=str(tmp_path), sample=None, threads=4)
+    commands = [ ]
+    def fake_usearch(cmnd):
+        commands.append(cmnd)
+        labels = [x[1:] for x in open(os.path.join(args.workspace, 'unique.all.fasta')).read().split() if x[0] == '>']
+        assert labels == ['S1_1;size=10;', 'S1_2;size=3;', 'S1_3;size=1;', 'S2_4;size=7;']
+        with open(os.path.join(args.workspace, 'readmap.all.uc'), 'w') as f:
+            f.write(uc_line('H', labels[0], 'OTU_4'))
+            f.write(uc_line('H', labels[1], 'OTU_2'))
+            f.write(uc_line('N', labels[2], '*'))
+            f.write(uc_line('H', labels[3], 'OTU_4'))
+        return 0
+    monkeypatch.setattr(map_otus, 'db', db, raising=False)
+    monkeypatch.setattr(map_otus.os, 'system', fake_usearch)
+    map_otus.print_all_sequences(db, args)
+    map_otus.run_usearch_combined(args)
+    assert len(commands) == 1 and ' -threads 4 ' in commands[0]
+    map_otus.import_combined_results(db, args)
+    assert db.execute('SELECT otu_id, sample_id, count FROM otus').fetchall() == [(0, 1, 1), (2, 1, 3), (4, 1, 10), (4, 2, 7)]
@@ -0,0 +1,46 @@
+# Tests for the built-in pair merger
+
+from FASTQ import FASTQBatch
+from merger import merge_pair, merge_batch, reverse_complement, expected_errors, mismatches
+
+fragment = b'ACGTTGCAAGGCTTACCGATGGCATTCAGGATCCATGCAAGTTGCCAGTAGGCTTAAC'
+
+def make_pair(qual=b'I'):
+    r1 = fragment[:40]
+    r2 = reverse_complement(fragment[-40:])
+    return r1, qual * len(r1), r2, qual * len(r2)
+
+def test_mismatches():
+    assert mismatches(b'ACGT', b'ACGT') == 0
+    assert mismatches(b'ACGT', b'TCGA') == 2
+
+def test_merge_pair():
+    s1, q1, s2, q2 = make_pair()
+    seq, qual = merge_pair(s1, q1, s2, q2, 10)
+    assert seq == fragment
+    assert len(qual) == len(seq)
+    assert qual[30] > q1[30]            # matching bases in the overlap get a higher quality
+
+def test_no_overlap():
+    s1, q1, s2, q2 = make_pair()
+    assert merge_pair(s1[:20], q1[:20], s2[:20], q2[:20], 10) is None
+
+def test_merge_batch():
+    s1, q1, s2, q2 = make_pair()
+    b1 = FASTQBatch([b'@M1:1:FC:1:1101:100:200 1:N:0:1'], [s1], [q1])
+    b2 = FASTQBatch([b'@M1:1:FC:1:1101:100:200 2:N:0:1'], [s2], [q2])
+    res = merge_batch(b1, b2)
+    assert len(res) == 1
+    assert res[0][0] is not None
+    assert res[0][1:] == ('>M1:1:FC:1:1101:100:200:1', fragment.decode())
+    assert merge_batch(b1, b2, minlength=len(fragment) + 1) == []
+
+def test_maxee():
+    s1, q1, s2, q2 = make_pair(b'+')        # Q10, 0.1 errors per base outside the overlap
+    b1 = FASTQBatch([b'@r1 1:N:0:1'], [s1], [q1])
+    b2 = FASTQBatch([b'@r1 2:N:0:1'], [s2], [q2])
+    qual = merge_pair(s1, q1, s2, q2, 10)[1]
+    ee = expected_errors(qual)
+    assert 3.6 < ee < 4.0
+    assert len(merge_batch(b1, b2, maxee=ee + 0.01)) == 1
+    assert merge_batch(b1, b2, maxee=1.0) == []
@@ -0,0 +1,37 @@
+# Tests for PrimerMatcher (primers.py)
+
+from primers import PrimerMatcher
+
+def test_exact_match():
+    m = PrimerMatcher('GTGCCAGC')
+    assert len(m) == 8
+    assert m.match(b'GTGCCAGCTTAA') == 8
+    assert m.match(b'GTGCCAGA') is None
+
+def test_ambiguity_codes():
+    m = PrimerMatcher('GTGYCAGN')
+    assert m.match(b'GTGCCAGA') == 8
+    assert m.match(b'GTGTCAGT') == 8
+    assert m.match(b'GTGACAGT') is None
+
+def test_n_never_matches():
+    m = PrimerMatcher('GTGNCAGC')
+    assert m.mismatches(b'GTGNCAGC') == 1
+    assert m.match(b'GTGNCAGC') is None
+
+def test_mismatches():
+    m = PrimerMatcher('GTGCCAGC', mismatches=1)
+    assert m.mismatches(b'GTGACAGC') == 1
+    assert m.match(b'GTGACAGCTT') == 8
+    assert m.match(b'GAGACAGCTT') is None
+
+def test_shift():
+    m = PrimerMatcher('GTGCCAGC', shift=2)
+    assert m.match(b'AGTGCCAGCTT') == 9
+    assert m.match(b'AAAGTGCCAGC') is None
+    assert m.match(b'GTG') is None
+
+def test_lower_case():
+    m = PrimerMatcher('gtgccagc')
+    assert m.primer() == 'GTGCCAGC'
+    assert m.match(b'gtgccagc') == 8
@@ -0,0 +1,30 @@
+# Tests for the expected error filter (quality_filter.py)
+
+import random
+
+from quality_filter import check_batch
+
+def expected_errors(q):
+    "The per-read loop the filter replaces"
+    total = 0.0
+    for ch in q.decode():
+        total += 10 ** (-(ord(ch) - 33) / 10)
+    return total
+
+def test_check_batch_matches_per_read_loop():
+    rng = random.Random(1)
+    quals = [bytes(rng.choice(range(50, 75)) for _ in range(rng.randint(50, 150))) for _ in range(400)]
+    # add reads right at the cutoff
+    quals += [b'+' * 3, b'+' * 4]
+    maxee = 0.3
+    pairs = list(zip(quals, reversed(quals)))
+    flags = check_batch([x for x, y in pairs], [y for x, y in pairs], maxee)
+    expected = [expected_errors(x) <= maxee and expected_errors(y) <= maxee for x, y in pairs]
+    assert flags == expected
+    assert any(flags) and not all(flags)
+
+def test_quality_cutoff():
+    # '+' is Q10, an error probability of 0.1
+    assert check_batch([b'+' * 3], [b'I' * 10], 0.31) == [True]
+    assert check_batch([b'+' * 4], [b'I' * 10], 0.31) == [False]
+    assert check_batch([b'I' * 10], [b'+' * 4], 0.31) == [False]
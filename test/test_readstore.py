@@ -0,0 +1,51 @@
+# Tests for ReadStore (readstore.py)
+
+from readstore import ReadStore, read_store_name
+
+blobs = [b'\x01\x02\x03', None, b'', b'\xff' * 10]
+
+def make_store(tmp_path):
+    fn = read_store_name(str(tmp_path / 'project.db'))
+    store = ReadStore(fn, 'a')
+    locs = store.append_many(blobs)
+    store.flush()
+    store.close()
+    return fn, locs
+
+def test_append_and_get(tmp_path):
+    fn, locs = make_store(tmp_path)
+    assert locs[1] == (None, None)
+    store = ReadStore(fn)
+    for blob, (offset, length) in zip(blobs, locs):
+        if blob is not None:
+            assert bytes(store.get(offset, length)) == blob
+    store.close()
+
+def test_append_to_existing_store(tmp_path):
+    fn, locs = make_store(tmp_path)
+    store = ReadStore(fn, 'a')
+    offset, length = store.append_many([b'abc'])[0]
+    store.close()
+    assert offset == sum(len(x) for x in blobs if x)
+    store = ReadStore(fn)
+    assert bytes(store.get(offset, length)) == b'abc'
+    store.close()
+
+def test_close_with_live_views(tmp_path):
+    fn, locs = make_store(tmp_path)
+    store = ReadStore(fn)
+    view = store.get(*locs[3])
+    store.close()
+    assert bytes(view) == blobs[3]
+
+def test_empty_store(tmp_path):
+    fn = str(tmp_path / 'empty.reads')
+    ReadStore(fn, 'a').close()
+    ReadStore(fn).close()
+
+def test_truncate(tmp_path):
+    fn, locs = make_store(tmp_path)
+    store = ReadStore(fn, 'a')
+    store.truncate()
+    assert store.append_many([b'x']) == [(0, 1)]
+    store.close()
@@ -0,0 +1,78 @@
+# Tests for integer sequence IDs (FASTQ.defline_id and friends, common.unique_id_map)
+
+import sqlite3
+
+import pytest
+
+from FASTQ import FASTQ, CompactFASTQ, FASTQView
+from common import ensure_unique_ids, unique_id_map
+
+illumina = '@NS500451:4:H04JNAFXX:1:11101:6946:1002 1:N:0:TAAGGCGA'
+sra = '@SRR1234.1 1 length=150'
+
+def test_defline_id_round_trip():
+    n = FASTQ.defline_id(illumina)
+    assert FASTQ.id_defline(n) == '1:11101:6946:1002'
+    assert FASTQ.defline_id('1:11101:6946:1002') == n
+    assert FASTQ.defline_id('>NS500451:4:H04JNAFXX:1:11101:6946:1002:TAAGGCGA') == n
+
+def test_out_of_range():
+    with pytest.raises(ValueError):
+        FASTQ.defline_id('1:11101:9999999:1002')
+    assert FASTQ.try_defline_id('1:11101:9999999:1002') is None
+
+def test_non_illumina_deflines():
+    with pytest.raises(ValueError):
+        FASTQ.defline_id(sra)
+    assert FASTQ.try_defline_id(sra) is None
+    assert FASTQ.parse_defline(sra) == 'SRR1234.1'
+    assert FASTQ.defline_key(sra) == 'SRR1234.1'
+    assert FASTQ.defline_key('>SRR1234.1') == 'SRR1234.1'
+    assert FASTQ.defline_key(illumina) == FASTQ.defline_id(illumina)
+
+def test_too_few_fields():
+    for s in ['@1:2', '@a:b:c:1:2', '>a:b:c:1:2:3']:
+        with pytest.raises(ValueError):
+            FASTQ.defline_id(s)
+        assert FASTQ.try_defline_id(s) is None
+    assert FASTQ.defline_key('@1:2') != FASTQ.defline_key('@a:b:c:1:2')
+
+def test_unique_id_methods():
+    rec = '\n'.join([sra, 'ACGT', '+', 'FFFF'])
+    assert FASTQ(rec).unique_id() is None
+    assert CompactFASTQ(rec).unique_id() is None
+    assert FASTQView(sra.encode(), b'ACGT', b'FFFF').unique_id() is None
+    rec = '\n'.join([illumina, 'ACGT', '+', 'FFFF'])
+    assert CompactFASTQ(rec).unique_id() == FASTQ.defline_id(illumina)
+
+def old_database():
+    "Make a panda table the way an earlier version of the pipeline did (no unique_id column)"
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE log (time timestamp, script text, event text, message text)')
+    db.execute('CREATE TABLE panda (panda_id INTEGER PRIMARY KEY, sample_id INTEGER, defline TEXT, sequence TEXT)')
+    db.executemany('INSERT INTO panda VALUES (?,?,?,?)', [(1, 1, '1:11101:6946:1002', 'ACGT'), (2, 1, 'SRR1234.1', 'ACGG'), (3, 2, '1:11101:6946:1003', 'ACGT')])
+    return db
+
+def test_ensure_unique_ids():
+    db = old_database()
+    ensure_unique_ids(db, 'panda')
+    rows = db.execute('SELECT panda_id, unique_id FROM panda ORDER BY panda_id').fetchall()
+    assert rows == [(1, FASTQ.defline_id('1:11101:6946:1002')), (2, None), (3, FASTQ.defline_id('1:11101:6946:1003'))]
+    assert db.execute("SELECT name FROM sqlite_master WHERE name = 'panda_uidx'").fetchall()
+
+def test_unique_id_map_falls_back_to_deflines():
+    db = old_database()
+    ensure_unique_ids(db, 'panda')
+    dm = unique_id_map(db, 1)
+    assert dm[FASTQ.defline_key('>NS500451:4:H04JNAFXX:1:11101:6946:1002:TAAGGCGA')] == 1
+    assert dm[FASTQ.defline_key('>SRR1234.1')] == 2
+    assert len(dm) == 2
+
+def test_import_rows_with_sra_deflines():
+    import argparse
+    from import_reads import make_rows
+    seqs = [FASTQView(sra.encode(), b'ACGT', b'FFFF'), FASTQView(illumina.encode(), b'ACGT', b'FFFF')]
+    args = argparse.Namespace(quality=False, deflines=True)
+    rows = make_rows(seqs, 1, args)
+    assert [row[2] for row in rows] == [None, FASTQ.defline_id(illumina)]
+    assert rows[0][3] == sra